@@ -0,0 +1,210 @@
+"""
+Check every CelebA attribute for correlations
+leaking into the splits, not just the ones
+planted by make_celeba_split.py (age with sex
+and smiling, see TRAIN_LIMS_2_CORR).
+
+The attribute table (utils.attr_table) is loaded
+once, and a boolean membership mask over its
+rows is built for each split: CelebA's own
+partitions (list_eval_partition.txt) and our
+TRAIN_DIR/VAL_DIR/TEST_DIR (from their
+manifests). For a split, the correlation and
+mutual information of every pair of attributes
+are each a single matrix multiply over the
+split's rows, so all 40 attributes over all
+202k images take well under a second.
+
+audit() prints, for each split:
+    - the attributes whose correlation with
+      Young differs most from all of CelebA's
+    - the attribute pairs whose correlation
+      changed most (side effects of the split)
+    - the model's error lift for each attribute
+      (error rate with the attribute / overall
+      error rate), from the correctness saved
+      by test_evals.py (utils.load_results)
+
+Run from the repo root, ex:
+    python3 attr_audit.py
+    python3 attr_audit.py --results test_evals_test
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from settings import CELEBA_ATTRS_CSV, CELEBA_PART_TXT, TRAIN_DIR, VAL_DIR, TEST_DIR, RESULTS_DIR
+from utils import attr_table, attr_rows, load_results
+import instrument
+
+TARGET = 'Young'
+TOP_N = 10 # rows printed per table
+PARTITIONS = {'celeba_train': 0, 'celeba_val': 1, 'celeba_test': 2}
+SPLIT_DIRS = {'train': TRAIN_DIR, 'val': VAL_DIR, 'test': TEST_DIR}
+
+def split_masks() -> dict:
+    """
+    Boolean mask over the rows of attr_table
+    for each split: "all", CelebA's partitions,
+    and whichever of train/val/test exist
+    """
+    # pylint:disable=import-outside-toplevel
+    from manifest import load_manifest
+    filenames = attr_table(CELEBA_ATTRS_CSV)[0]
+    masks = {'all': np.ones(len(filenames), dtype=bool)}
+    if os.path.exists(CELEBA_PART_TXT):
+        parts = pd.read_csv(CELEBA_PART_TXT, sep=r'\s+', header=None,
+                            names=['filename', 'partition'])
+        rows = attr_rows(parts['filename'].to_numpy())
+        for name, partition in PARTITIONS.items():
+            masks[name] = np.zeros(len(filenames), dtype=bool)
+            masks[name][rows[parts['partition'].to_numpy() == partition]] = True
+    for name, data_dir in SPLIT_DIRS.items():
+        if os.path.isdir(data_dir):
+            masks[name] = np.zeros(len(filenames), dtype=bool)
+            masks[name][attr_rows(load_manifest(data_dir).paths)] = True
+    return masks
+
+def correlations(attrs:np.ndarray) -> np.ndarray:
+    """
+    Pearson correlation of every pair of
+    columns of attrs (num_rows, num_attrs),
+    as a (num_attrs, num_attrs) matrix.
+    Constant columns get 0.
+    """
+    values = attrs.astype(np.float32)
+    values -= values.mean(0)
+    std = values.std(0)
+    std[std == 0] = np.inf
+    values /= std
+    return (values.T @ values) / len(values)
+
+def mutual_info(attrs:np.ndarray) -> np.ndarray:
+    """
+    Mutual information (in bits) of every
+    pair of binary (-1/1) columns of attrs,
+    from their 2x2 joint counts, which are
+    all found with one matrix multiply
+    """
+    has = (attrs == 1).astype(np.float32)
+    both = np.concatenate([has, 1 - has], axis=1)
+    joint = (both.T @ both) / len(attrs) # (2 * num_attrs, 2 * num_attrs)
+    marginal = np.diag(joint)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = joint * np.log2(joint / np.outer(marginal, marginal))
+    terms = np.nan_to_num(terms) # 0 log 0 = 0
+    num_attrs = attrs.shape[1]
+    # Sum the four (has/doesn't have) x (has/doesn't have) blocks
+    return terms[:num_attrs, :num_attrs] + terms[:num_attrs, num_attrs:] + \
+        terms[num_attrs:, :num_attrs] + terms[num_attrs:, num_attrs:]
+
+def target_table(corr:np.ndarray, ref_corr:np.ndarray, info:np.ndarray,
+                 attr_names:list[str]) -> pd.DataFrame:
+    """
+    Each attribute's correlation and mutual
+    information with TARGET, and how far its
+    correlation is from the reference's
+    """
+    target = attr_names.index(TARGET)
+    table = pd.DataFrame({'corr': corr[target], 'ref_corr': ref_corr[target],
+                          'mutual_info': info[target]}, index=attr_names)
+    table['shift'] = table['corr'] - table['ref_corr']
+    return table.drop(TARGET).sort_values('shift', key=np.abs, ascending=False)
+
+def pair_table(corr:np.ndarray, ref_corr:np.ndarray, attr_names:list[str]) -> pd.DataFrame:
+    """
+    Every pair of attributes whose
+    correlation differs from the reference's,
+    largest change first
+    """
+    first, second = np.triu_indices(len(attr_names), k=1)
+    table = pd.DataFrame({'attr': np.array(attr_names)[first],
+                          'other_attr': np.array(attr_names)[second],
+                          'corr': corr[first, second], 'ref_corr': ref_corr[first, second]})
+    table['shift'] = table['corr'] - table['ref_corr']
+    return table.sort_values('shift', key=np.abs, ascending=False, ignore_index=True)
+
+def error_lift(results_prefix:str) -> pd.DataFrame:
+    """
+    For each attribute, the model's error rate
+    on images with and without it divided by
+    its overall error rate, from the latest
+    run saved with results_prefix. Works with
+    0/1 or -1/1 'correct' columns.
+    """
+    results = load_results(results_prefix)
+    # Run names end with their save time and counter,
+    # ex: test_evals_test_frozen_20230412-101500_00
+    latest = max(results['run'].unique(), key=lambda run: run[-len('YYYYmmdd-HHMMSS_NN'):])
+    results = results[results['run'] == latest]
+    _, _, attr_names = attr_table(CELEBA_ATTRS_CSV)
+    has = (results[attr_names].to_numpy() == 1).astype(np.float32)
+    errors = (results['correct'].to_numpy() <= 0).astype(np.float32)
+    num_with = has.sum(0)
+    err_with = (errors @ has) / np.maximum(num_with, 1)
+    err_without = (errors @ (1 - has)) / np.maximum(len(has) - num_with, 1)
+    overall = max(errors.mean(), 1e-12)
+    table = pd.DataFrame({'num_with': num_with.astype(int), 'err_with': err_with,
+                          'err_without': err_without, 'lift_with': err_with / overall,
+                          'lift_without': err_without / overall}, index=attr_names)
+    print(f"Error lift from {results['run'].iloc[0]} ({len(results)} images, " +\
+          f"overall error {errors.mean():.4f})")
+    return table.sort_values('lift_with', ascending=False)
+
+def audit(splits:list[str]=None, results_prefix:str=None, ref:str='all',
+          top_n:int=TOP_N) -> dict:
+    """
+    Print and return the TARGET and pair
+    tables for each split (compared against
+    the ref split) and, if results_prefix is
+    given, the error lift table
+    """
+    with instrument.stage("load_attrs"):
+        _, attrs, attr_names = attr_table(CELEBA_ATTRS_CSV)
+        masks = split_masks()
+    splits = splits or [name for name in masks if name != ref]
+    with instrument.stage("correlations", items=len(attrs) * (len(splits) + 1)):
+        ref_corr = correlations(attrs[masks[ref]])
+        tables = {}
+        for split in splits:
+            split_attrs = attrs[masks[split]]
+            corr = correlations(split_attrs)
+            tables[split] = {
+                'target': target_table(corr, ref_corr, mutual_info(split_attrs), attr_names),
+                'pairs': pair_table(corr, ref_corr, attr_names)}
+
+    with pd.option_context('display.width', 120, 'display.float_format', '{:.4f}'.format):
+        for split, split_tables in tables.items():
+            print(f"\n{split.upper()} ({masks[split].sum()} images) vs {ref}")
+            print(f"Correlation with {TARGET}, largest shifts:")
+            print(split_tables['target'].head(top_n))
+            print("Attribute pairs, largest correlation shifts:")
+            print(split_tables['pairs'].head(top_n).to_string(index=False))
+        if results_prefix is not None:
+            with instrument.stage("error_lift"):
+                tables['error_lift'] = error_lift(results_prefix)
+            print(tables['error_lift'].head(top_n))
+    return tables
+
+def main():
+    """
+    Audit the splits named on the command
+    line (default: every split found)
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("splits", nargs="*",
+                        help=f"splits to audit, from all, {', '.join(PARTITIONS)}, " +\
+                             f"{', '.join(SPLIT_DIRS)} (default: all of them)")
+    parser.add_argument("--ref", default="all", help="split to compare against")
+    parser.add_argument("--results", metavar="PREFIX",
+                        help=f"also report error lift from the latest run in {RESULTS_DIR} " +\
+                             "starting with PREFIX, ex: test_evals_test")
+    parser.add_argument("--top", type=int, default=TOP_N)
+    args = parser.parse_args()
+    with instrument.run("attr_audit"):
+        audit(args.splits or None, args.results, args.ref, args.top)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Pick the batch size for each model on the
+current machine instead of hard-coding one.
+
+The first time a model's batch size is asked
+for, random batches of increasing size are run
+through it to measure throughput (images/s) and
+peak memory. The fastest size whose peak memory
+fits in BATCH_MEMORY_FRAC of the free memory is
+chosen and cached in BATCH_SIZE_CACHE, keyed by
+(model, device, host), so later runs on the
+same machine reuse it without probing.
+
+If a batch still runs out of memory mid-run
+(ex: other jobs on the node), it is split in
+half and retried, and the smaller size is
+used from then on and saved to the cache.
+
+Re-tune a model from the repo root with, ex:
+    python3 batch_tuner.py clip resnet
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from settings import AUTOTUNE_BATCH, BATCH_SIZE_CACHE, BATCH_MEMORY_FRAC, INFERENCE_MODE, \
+    IMG_WIDTH, IMG_HEIGHT
+
+DEFAULT_BATCH = 64 # used when AUTOTUNE_BATCH is False
+CANDIDATES = [8, 16, 32, 64, 128, 256, 512, 1024]
+TUNE_ITERS = 3 # timed batches per candidate, after one warm-up batch
+MIN_GAIN = 0.05 # stop growing once a bigger batch is less than 5% faster
+PATIENCE = 2 # candidates in a row without MIN_GAIN before stopping
+
+class BatchSize:
+
+    """
+    A model's current batch size. Read it with
+    int(), so loops pick up a back-off as soon
+    as it happens.
+    """
+
+    def __init__(self, key:str, value:int):
+        self.key = key
+        self.value = value
+
+    def __int__(self) -> int:
+        return self.value
+
+    def back_off(self, value:int):
+        """
+        Use a smaller batch size from now on,
+        and remember it for later runs
+        """
+        if value >= self.value:
+            return
+        print(f"Out of memory with batch size {self.value} for {self.key}, " +\
+              f"backing off to {value}")
+        self.value = value
+        cache = _read_cache()
+        entry = cache.get(self.key, {})
+        entry.update({"batch_size": value, "backed_off": True})
+        cache[self.key] = entry
+        _write_cache(cache)
+
+def _read_cache() -> dict:
+    if not os.path.exists(BATCH_SIZE_CACHE):
+        return {}
+    with open(BATCH_SIZE_CACHE, encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_cache(cache:dict):
+    tmp_path = BATCH_SIZE_CACHE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, BATCH_SIZE_CACHE)
+
+def _probe_setup(name:str):
+    """
+    (forward function, input shape, input
+    dtype, device) for a model in the registry
+    """
+    # pylint:disable=import-outside-toplevel
+    import torch
+    from model_registry import get_model, get_device, classifier_device
+    if name == "clip":
+        clip_model, _ = get_model("clip")
+        res = clip_model.visual.input_resolution
+        return clip_model.encode_image, (3, res, res), clip_model.dtype, get_device()
+    return get_model("resnet"), (3, IMG_HEIGHT, IMG_WIDTH), torch.float32, classifier_device()
+
+def cache_key(name:str) -> str:
+    """
+    ex: "resnet-frozen|cpu|node12"
+    """
+    from model_registry import get_device, classifier_device # pylint:disable=import-outside-toplevel
+    device = get_device() if name == "clip" else classifier_device()
+    if name == "resnet":
+        name = f"resnet-{INFERENCE_MODE}"
+    return f"{name}|{device}|{socket.gethostname()}"
+
+def is_oom(err:BaseException) -> bool:
+    """
+    Whether err is torch failing to allocate
+    memory, on the GPU or the CPU
+    """
+    msg = str(err)
+    return "out of memory" in msg or "can't allocate memory" in msg
+
+def _free_memory(device) -> int:
+    """
+    Bytes of memory free on device
+    """
+    import torch # pylint:disable=import-outside-toplevel
+    if str(device).startswith("cuda"):
+        return torch.cuda.mem_get_info()[0]
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def _current_rss() -> int:
+    """
+    Resident memory of this process right
+    now, in bytes (not ru_maxrss, which is
+    the high-water mark over its lifetime)
+    """
+    try:
+        import psutil # pylint:disable=import-outside-toplevel
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    # Last resort, can overstate a probe's memory
+    # if the process peaked earlier
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def tune(name:str) -> dict:
+    """
+    Probe batch sizes for the named model
+    ("clip" or "resnet") and cache the best.
+    On the CPU, a probe's peak memory is the
+    most its current RSS grew over the RSS just
+    before the probe, sampled after each batch.
+    Memory freed by a forward pass before the
+    sample is missed, so this can understate
+    the true peak; BATCH_MEMORY_FRAC leaves
+    headroom for that.
+    """
+    import torch # pylint:disable=import-outside-toplevel
+    forward, shape, dtype, device = _probe_setup(name)
+    on_cuda = str(device).startswith("cuda")
+    budget = _free_memory(device) * BATCH_MEMORY_FRAC
+    probes, best, misses = [], None, 0
+    print(f"Tuning batch size for {name} on {device} (memory budget {budget / 2**20:.0f} MB)")
+    with torch.no_grad():
+        for size in CANDIDATES:
+            base_mem = torch.cuda.memory_allocated() if on_cuda else _current_rss()
+            cpu_peak = base_mem
+            inputs = torch.randn(size, *shape).to(device=device, dtype=dtype)
+            try:
+                if on_cuda:
+                    torch.cuda.reset_peak_memory_stats()
+                out = forward(inputs) # warm-up
+                if on_cuda:
+                    torch.cuda.synchronize()
+                else:
+                    cpu_peak = max(cpu_peak, _current_rss())
+                del out
+                start = time.perf_counter()
+                for _ in range(TUNE_ITERS):
+                    out = forward(inputs)
+                    if not on_cuda:
+                        cpu_peak = max(cpu_peak, _current_rss())
+                    del out
+                if on_cuda:
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - start
+            except RuntimeError as err:
+                if not is_oom(err):
+                    raise
+                print(f"  batch {size}: out of memory")
+                break
+            finally:
+                del inputs
+                if on_cuda:
+                    torch.cuda.empty_cache()
+            peak = (torch.cuda.max_memory_allocated() if on_cuda else cpu_peak) - base_mem
+            probe = {"batch_size": size, "items_per_s": TUNE_ITERS * size / elapsed,
+                     "peak_mb": peak / 2**20}
+            probes.append(probe)
+            print(f"  batch {size}: {probe['items_per_s']:.1f} images/s, " +\
+                  f"peak {probe['peak_mb']:.0f} MB")
+            if peak > budget:
+                break
+            if best is None or probe["items_per_s"] > best["items_per_s"] * (1 + MIN_GAIN):
+                best, misses = probe, 0
+            else:
+                misses += 1
+                if misses >= PATIENCE:
+                    break
+    best = best or {"batch_size": 1}
+    entry = {**best, "device": str(device), "host": socket.gethostname(),
+             "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S"), "probes": probes}
+    cache = _read_cache()
+    cache[cache_key(name)] = entry
+    _write_cache(cache)
+    print(f"Using batch size {best['batch_size']} for {name}")
+    return entry
+
+def batch_size_for(name:str) -> BatchSize:
+    """
+    The batch size to use for the named
+    model, tuning it first if it isn't
+    cached for this device and host
+    """
+    if not AUTOTUNE_BATCH:
+        return BatchSize(name, DEFAULT_BATCH)
+    key = cache_key(name)
+    entry = _read_cache().get(key) or tune(name)
+    return BatchSize(key, entry["batch_size"])
+
+def forward_with_backoff(forward, inputs, batch_size:BatchSize):
+    """
+    forward(inputs), but if it runs out of
+    memory, run each half of the batch
+    separately and back off batch_size
+    """
+    import torch # pylint:disable=import-outside-toplevel
+    try:
+        return forward(inputs)
+    except RuntimeError as err:
+        if not is_oom(err) or len(inputs) == 1:
+            raise
+    if inputs.is_cuda:
+        torch.cuda.empty_cache()
+    half = len(inputs) // 2
+    if isinstance(batch_size, BatchSize):
+        batch_size.back_off(half)
+    return torch.cat([forward_with_backoff(forward, inputs[:half], batch_size),
+                      forward_with_backoff(forward, inputs[half:], batch_size)])
+
+if __name__ == "__main__":
+    for model_name in sys.argv[1:] or ["clip", "resnet"]:
+        tune(model_name)
@@ -0,0 +1,55 @@
+"""
+Compare the embedding codecs in embed_codes.py
+(float16, int8, product quantization) against
+float32 on synthetic CLIP-sized embeddings:
+memory used, time to score and search, and
+agreement with float32 on the top-k decision
+scores and nearest neighbors.
+
+To run the same report on real embeddings and
+a real SVM, set CODEC_REPORT in experiments/gmm.py.
+
+Run from the repo root, ex:
+    python3 benchmarks/bench_embed_codes.py --num 200000
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint:disable=wrong-import-position
+from embed_codes import CODECS, report
+from bench_pipeline import make_embeds
+
+NUM_EMBEDS = 100000
+NUM_FIT = 5000 # embeddings the SVM direction is fit on
+NUM_QUERIES = 200
+K = 1000
+
+def main():
+    """
+    Fit a linear SVM on a sample of synthetic
+    embeddings and report each codec
+    """
+    from sklearn import svm # pylint:disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num", type=int, default=NUM_EMBEDS)
+    parser.add_argument("--k", type=int, default=K)
+    parser.add_argument("--codecs", nargs="*", default=CODECS)
+    args = parser.parse_args()
+
+    embeds, labels = make_embeds(args.num)
+    svm_c = svm.LinearSVC().fit(embeds[:NUM_FIT], labels[:NUM_FIT])
+    rng = np.random.default_rng(1)
+    # Query points between pairs of embeddings, like gmm.py's paths
+    pairs = rng.integers(0, args.num, (NUM_QUERIES, 2))
+    queries = (embeds[pairs[:, 0]] + embeds[pairs[:, 1]]) / 2
+    report(embeds, svm_c.coef_[0], float(svm_c.intercept_[0]), queries, args.k, args.codecs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark the reduced-size JPEG decode
+(FAST_DECODE in settings.py, see
+manifest.load_image) against decoding at
+full size, through the classifier's
+data transforms.
+
+Prints the wall and CPU time per image for
+both, and how much the transformed tensors
+differ. With --accuracy, the classifier's
+per-subgroup val accuracy is also compared
+between the two decodes (needs trained
+weights at MODEL_PATH).
+
+Run from the repo root, ex:
+    python3 benchmarks/bench_fast_decode.py
+    python3 benchmarks/bench_fast_decode.py --split val --accuracy
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint:disable=wrong-import-position
+from settings import IMG_WIDTH, IMG_HEIGHT, TRAIN_DIR, VAL_DIR, TEST_DIR
+from bench_pipeline import make_jpegs
+
+NUM_IMGS = 2000
+REPEATS = 3
+SPLIT_DIRS = {"train": TRAIN_DIR, "val": VAL_DIR, "test": TEST_DIR}
+
+def time_decode(paths:list[str], draft_size, repeats:int=REPEATS) -> dict:
+    """
+    Best-of-repeats wall and CPU time per image
+    to decode and transform every image in paths
+    """
+    # pylint:disable=import-outside-toplevel
+    from manifest import load_image
+    from model_registry import get_data_transforms
+    transforms = get_data_transforms()
+    best_wall, best_cpu = np.inf, np.inf
+    for _ in range(repeats):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        for path in paths:
+            transforms(load_image(path, draft_size))
+        best_wall = min(best_wall, time.perf_counter() - start_wall)
+        best_cpu = min(best_cpu, time.process_time() - start_cpu)
+    return {"wall_ms": 1000 * best_wall / len(paths), "cpu_ms": 1000 * best_cpu / len(paths)}
+
+def tensor_diff(paths:list[str], draft_size) -> dict:
+    """
+    How much the transformed images differ
+    between full and draft decoding
+    """
+    # pylint:disable=import-outside-toplevel
+    from manifest import load_image
+    from model_registry import get_data_transforms
+    transforms = get_data_transforms()
+    diffs = np.array([(transforms(load_image(path)) -
+                       transforms(load_image(path, draft_size))).abs().mean().item()
+                      for path in paths])
+    decoded = load_image(paths[0], draft_size).size
+    return {"mean_abs_diff": float(diffs.mean()), "max_image_diff": float(diffs.max()),
+            "decoded_size": decoded}
+
+def compare_accuracy():
+    """
+    Per-subgroup val accuracy of the
+    classifier with each decode
+    """
+    # pylint:disable=import-outside-toplevel
+    from test_evals import loader, test_acc, print_comparison
+    print("Full decode:")
+    full = test_acc(loader(VAL_DIR, fast_decode=False), "val")
+    print("Draft decode:")
+    draft = test_acc(loader(VAL_DIR, fast_decode=True), "val")
+    print_comparison(full, draft, "full decode", "draft decode")
+
+def main():
+    """
+    Time both decodes on a split's
+    images, or on synthetic JPEGs
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--split", choices=list(SPLIT_DIRS),
+                        help="time images from this split (default: synthetic JPEGs)")
+    parser.add_argument("--num", type=int, default=NUM_IMGS)
+    parser.add_argument("--accuracy", action="store_true",
+                        help="also compare val accuracy with each decode")
+    args = parser.parse_args()
+
+    draft_size = (IMG_WIDTH, IMG_HEIGHT)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.split:
+            from manifest import load_manifest # pylint:disable=import-outside-toplevel
+            all_paths = load_manifest(SPLIT_DIRS[args.split]).paths
+            idxs = np.random.default_rng(0).choice(len(all_paths), min(args.num, len(all_paths)),
+                                                   replace=False)
+            paths = all_paths[np.sort(idxs)].tolist()
+        else:
+            paths = make_jpegs(tmp_dir, args.num)
+
+        full = time_decode(paths, None)
+        draft = time_decode(paths, draft_size)
+        diff = tensor_diff(paths, draft_size)
+    print(f"{len(paths)} images, decoded at {diff['decoded_size']} instead of full size")
+    print(f"full decode:  {full['wall_ms']:.3f} ms/image wall, {full['cpu_ms']:.3f} ms/image CPU")
+    print(f"draft decode: {draft['wall_ms']:.3f} ms/image wall, {draft['cpu_ms']:.3f} ms/image CPU " +\
+          f"({full['cpu_ms'] / draft['cpu_ms']:.2f}x less CPU)")
+    print(f"Mean abs difference of the normalized inputs: {diff['mean_abs_diff']:.4f} " +\
+          f"(worst image {diff['max_image_diff']:.4f})")
+    if args.accuracy:
+        compare_accuracy()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""
+Micro-benchmarks for each stage of the
+pipeline. Everything runs on synthetic data
+(random JPEGs, random embeddings, randomly
+initialized models), so neither CelebA,
+trained weights, nor a GPU is needed.
+
+Each stage is timed separately, REPEATS
+times, and the results are written as JSON.
+Passing a saved baseline compares every
+stage against it and flags regressions.
+
+Run from the repo root, ex:
+    python3 benchmarks/bench_pipeline.py --out bench.json
+    python3 benchmarks/bench_pipeline.py --baseline bench.json
+    python3 benchmarks/bench_pipeline.py --stages svc_fit gmm_fit
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "experiments"))
+
+# Vars - Modify these to change benchmark sizes
+REPEATS = 5
+NUM_JPEGS = 256 # synthetic 178x218 JPEGs, the size of CelebA's aligned images
+NUM_EMBEDS = 2000 # synthetic CLIP embeddings for the SVM/GMM/top-k stages
+NUM_NN_EMBEDS = 500 # embeddings searched by gmm.py's path nearest-neighbor stage
+MODEL_BATCH = 64 # images per model forward pass
+CLIP_BATCH = 16 # images per CLIP forward pass
+REGRESSION_TOL = 0.10 # flag stages more than 10% slower than the baseline
+CELEBA_SIZE = (178, 218)
+# Which implementation a stage times, saved with its results, for
+# stages whose code was rewritten. compare() prints both when a
+# baseline timed a different one, so before/after runs still line up.
+STAGE_IMPLS = {
+    "save_to_csv": "attr_table join", # was a per-row DataFrame lookup
+}
+
+def make_jpegs(out_dir:str, num:int, seed:int=0) -> list[str]:
+    """
+    Write num random CelebA-sized
+    JPEGs to out_dir and return their paths.
+    """
+    from PIL import Image # pylint:disable=import-outside-toplevel
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(num):
+        # Smooth noise compresses more like a real photo than white noise
+        small = rng.integers(0, 256, (CELEBA_SIZE[1] // 8, CELEBA_SIZE[0] // 8, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(CELEBA_SIZE, Image.BILINEAR)
+        path = os.path.join(out_dir, f"{i+1:06d}.jpg")
+        img.save(path, quality=95)
+        paths.append(path)
+    return paths
+
+def make_embeds(num:int, dim:int=512, seed:int=0):
+    """
+    Random embeddings with correctness
+    labels (1/-1) that depend on a hidden
+    direction, so the SVM has something
+    to find.
+    """
+    rng = np.random.default_rng(seed)
+    embeds = rng.standard_normal((num, dim)).astype(np.float32)
+    direction = rng.standard_normal(dim)
+    noise = rng.standard_normal(num) * 5
+    labels = np.where(embeds @ direction + noise > -8, 1, -1).astype(np.int8)
+    return embeds, labels
+
+def make_attrs_csv(path:str, file_names:list[str], seed:int=0):
+    """
+    Write a list_attr_celeba.csv style file
+    with random +-1 attributes for file_names.
+    """
+    import pandas as pd # pylint:disable=import-outside-toplevel
+    from settings import CELEBA_HEADER
+    rng = np.random.default_rng(seed)
+    attrs = rng.choice([-1, 1], size=(len(file_names), len(CELEBA_HEADER) - 1))
+    df = pd.DataFrame(attrs, columns=CELEBA_HEADER[1:])
+    df.insert(0, "filename", file_names)
+    df.to_csv(path, index=False)
+
+def random_clip():
+    """
+    A randomly initialized CLIP ViT-B/32,
+    built directly so no weights are downloaded.
+    """
+    from clip.model import CLIP # pylint:disable=import-outside-toplevel
+    return CLIP(embed_dim=512, image_resolution=224, vision_layers=12,
+                vision_width=768, vision_patch_size=32, context_length=77,
+                vocab_size=49408, transformer_width=512, transformer_heads=8,
+                transformer_layers=12).eval()
+
+def build_stages(tmp_dir:str) -> dict:
+    """
+    Create the synthetic inputs and return
+    {stage name: (setup fn, run fn, items per run)}.
+    setup is called once, run is timed.
+    """
+    # pylint:disable=import-outside-toplevel
+    state = {}
+
+    def setup_jpegs():
+        if "paths" not in state:
+            state["paths"] = make_jpegs(tmp_dir, NUM_JPEGS)
+
+    def run_decode():
+        from PIL import Image
+        for path in state["paths"]:
+            Image.open(path).convert("RGB").resize((75, 75), Image.BILINEAR)
+
+    def run_draft_decode():
+        from PIL import Image
+        from manifest import load_image
+        for path in state["paths"]:
+            load_image(path, (75, 75)).resize((75, 75), Image.BILINEAR)
+
+    def setup_transforms():
+        from PIL import Image
+        from model_registry import get_data_transforms
+        setup_jpegs()
+        state["pil_images"] = [Image.open(path).convert("RGB") for path in state["paths"]]
+        state["data_transforms"] = get_data_transforms()
+
+    def run_transforms():
+        for img in state["pil_images"]:
+            state["data_transforms"](img)
+
+    def setup_resnet():
+        import torch
+        from torch import nn
+        import torchvision
+        model = torchvision.models.resnet18()
+        model.fc = nn.Linear(in_features=512, out_features=2, bias=True)
+        state["resnet"] = model.eval()
+        state["resnet_input"] = torch.randn(MODEL_BATCH, 3, 75, 75)
+
+    def run_resnet():
+        import torch
+        with torch.no_grad():
+            state["resnet"](state["resnet_input"])
+
+    def setup_age_net():
+        import torch
+        from custom_age_model.age_model import CustomAgeNetwork
+        state["age_net"] = CustomAgeNetwork().eval()
+        state["age_net_input"] = torch.randn(MODEL_BATCH, 3, 82, 100)
+
+    def run_age_net():
+        import torch
+        with torch.no_grad():
+            state["age_net"](state["age_net_input"])
+
+    def setup_clip():
+        import torch
+        state["clip"] = random_clip()
+        state["clip_input"] = torch.randn(CLIP_BATCH, 3, 224, 224)
+
+    def run_clip():
+        import torch
+        with torch.no_grad():
+            state["clip"].encode_image(state["clip_input"])
+
+    def setup_embeds():
+        if "embeds" not in state:
+            state["embeds"], state["labels"] = make_embeds(NUM_EMBEDS)
+
+    def run_svc():
+        from sklearn import svm
+        state["svm"] = svm.SVC(kernel="linear").fit(state["embeds"], state["labels"])
+
+    def run_gmm():
+        from sklearn.mixture import GaussianMixture
+        import gmm
+        GaussianMixture(n_components=gmm.NUM_CLUSTS, random_state=0).fit(state["embeds"])
+
+    def setup_nn():
+        from sklearn.mixture import GaussianMixture
+        import gmm
+        setup_embeds()
+        embeds = state["embeds"][:NUM_NN_EMBEDS]
+        half = NUM_NN_EMBEDS // 2
+        state["nn_embeds"] = embeds
+        state["easy_gm"] = GaussianMixture(n_components=gmm.NUM_CLUSTS, random_state=0).fit(embeds[:half])
+        state["diff_gm"] = GaussianMixture(n_components=gmm.NUM_CLUSTS, random_state=0).fit(embeds[half:])
+
+    def run_nn():
+        import gmm
+        gmm.find_paths(state["nn_embeds"], state["easy_gm"], state["diff_gm"])
+
+    def setup_top_k():
+        rng = np.random.default_rng(0)
+        state["scores"] = rng.standard_normal(NUM_EMBEDS)
+        state["sexes"] = rng.integers(0, 2, NUM_EMBEDS)
+
+    def run_top_k():
+        import top_k
+        sorted_idxs = np.flip(np.argsort(state["scores"]))
+        top_k.top_k_fractions(state["sexes"][sorted_idxs])
+
+    def setup_csv():
+        import utils
+        setup_jpegs()
+        state["file_names"] = [os.path.basename(path) for path in state["paths"]]
+        attrs_csv = os.path.join(tmp_dir, "list_attr_celeba.csv")
+        make_attrs_csv(attrs_csv, state["file_names"])
+        utils.CELEBA_ATTRS_CSV = attrs_csv
+        state["csv_scores"] = np.random.default_rng(0).standard_normal(len(state["file_names"]))
+
+    def run_csv():
+        import utils
+        utils.save_to_csv(os.path.join(tmp_dir, "results.csv"), state["file_names"],
+                          scores=state["csv_scores"])
+
+    def run_results():
+        import utils
+        utils.save_results("bench", state["file_names"], results_dir=os.path.join(tmp_dir, "results"),
+                           scores=state["csv_scores"])
+
+    return {
+        "jpeg_decode_resize": (setup_jpegs, run_decode, NUM_JPEGS),
+        "jpeg_draft_decode_resize": (setup_jpegs, run_draft_decode, NUM_JPEGS),
+        "data_transforms": (setup_transforms, run_transforms, NUM_JPEGS),
+        "resnet18_forward": (setup_resnet, run_resnet, MODEL_BATCH),
+        "custom_age_net_forward": (setup_age_net, run_age_net, MODEL_BATCH),
+        "clip_encode": (setup_clip, run_clip, CLIP_BATCH),
+        "svc_fit": (setup_embeds, run_svc, NUM_EMBEDS),
+        "gmm_fit": (setup_embeds, run_gmm, NUM_EMBEDS),
+        "gmm_path_nn_search": (setup_nn, run_nn, NUM_NN_EMBEDS),
+        "top_k_curves": (setup_top_k, run_top_k, NUM_EMBEDS),
+        "save_to_csv": (setup_csv, run_csv, NUM_JPEGS),
+        "save_results": (setup_csv, run_results, NUM_JPEGS),
+    }
+
+def time_stage(setup, run, num_items:int, repeats:int) -> dict:
+    """
+    Run setup once and a warm-up run,
+    then time repeats runs of the stage.
+    """
+    setup()
+    run() # warm-up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+    return {"median_s": median, "min_s": float(np.min(times)),
+            "max_s": float(np.max(times)), "items": num_items,
+            "items_per_s": num_items / median if median > 0 else None}
+
+def machine_info() -> dict:
+    """
+    Where the benchmark was run, since
+    timings are only comparable on the
+    same machine.
+    """
+    info = {"host": socket.gethostname(), "platform": platform.platform(),
+            "python": platform.python_version(), "cpu_count": os.cpu_count(),
+            "numpy": np.__version__}
+    try:
+        import torch # pylint:disable=import-outside-toplevel
+        info["torch"] = torch.__version__
+        info["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+def compare(results:dict, baseline:dict, tol:float=REGRESSION_TOL) -> list[str]:
+    """
+    Print each stage's time relative to the
+    baseline and return the names of stages
+    that got more than tol slower.
+    """
+    regressions = []
+    print(f"{'stage':<24}{'baseline (s)':>14}{'now (s)':>12}{'ratio':>8}")
+    for name, res in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            print(f"{name:<24}{'-':>14}{res['median_s']:>12.4f}{'new':>8}")
+            continue
+        ratio = res["median_s"] / base["median_s"] if base["median_s"] > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + tol:
+            flag = "  SLOWER"
+            regressions.append(name)
+        elif ratio < 1 - tol:
+            flag = "  faster"
+        print(f"{name:<24}{base['median_s']:>14.4f}{res['median_s']:>12.4f}{ratio:>8.2f}{flag}")
+        if base.get("impl") != res.get("impl"):
+            print(f"{'':<24}implementation changed: {base.get('impl', 'original')} -> " +\
+                  f"{res.get('impl', 'original')}")
+    if baseline.get("machine", {}).get("host") != results["machine"]["host"]:
+        print("WARNING: baseline was recorded on a different host")
+    return regressions
+
+def main():
+    """
+    Run the requested stages, save
+    the results, and compare to a
+    baseline if one is given.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default="bench_results.json",
+                        help="where to write the JSON results")
+    parser.add_argument("--baseline", help="saved results JSON to compare against")
+    parser.add_argument("--stages", nargs="*", help="only run these stages")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    args = parser.parse_args()
+
+    results = {"machine": machine_info(), "repeats": args.repeats, "stages": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stages = build_stages(tmp_dir)
+        names = args.stages or list(stages)
+        for name in names:
+            assert name in stages, f"Unknown stage {name}, expected one of {list(stages)}"
+            setup, run, num_items = stages[name]
+            res = time_stage(setup, run, num_items, args.repeats)
+            if name in STAGE_IMPLS:
+                res["impl"] = STAGE_IMPLS[name]
+            results["stages"][name] = res
+            rate = "-" if res['items_per_s'] is None else f"{res['items_per_s']:.1f}"
+            print(f"{name:<24} median {res['median_s']:.4f}s ({rate} items/s)")
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        if regressions:
+            print(f"Regressed stages: {regressions}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
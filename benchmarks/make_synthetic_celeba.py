@@ -0,0 +1,158 @@
+"""
+Write a synthetic, CelebA-shaped dataset of
+any size so the pipeline can be run (and
+timed) without the real CelebA download.
+
+The output root gets the same layout the
+pipeline expects relative to its working dir:
+    img_align_celeba/000001.jpg ...
+    celeba_info/list_attr_celeba.csv
+    celeba_info/list_eval_partition.txt
+    settings.py
+The images are hard links to a small pool of
+random 178x218 JPEGs, so even 1M images are
+quick to write and take little disk space.
+Attributes are random with roughly CelebA's
+marginals, and partitions use CelebA's
+train/val/test proportions.
+
+The generated settings.py loads the repo's
+settings.py and scales the train/val limits
+down to what this dataset can fill, so the
+pipeline scripts can be run with this root as
+the working directory and first on PYTHONPATH.
+
+Run from the repo root, ex:
+    python3 benchmarks/make_synthetic_celeba.py synth_10k 10000
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint:disable=wrong-import-position
+from settings import CELEBA_HEADER, CELEBA_DIR, CELEBA_ATTRS_CSV, CELEBA_PART_TXT, \
+    NUM_CORRS, TRAIN_LIMS_1_CORR, TRAIN_LIMS_2_CORR, VAL_LIMS_1_CORR, VAL_LIMS_2_CORR
+from bench_pipeline import make_jpegs
+
+NUM_UNIQUE_JPEGS = 64
+# Approximate fraction of CelebA images with each attribute
+ATTR_PROBS = {"Young": 0.77, "Male": 0.42, "Smiling": 0.48}
+DEFAULT_ATTR_PROB = 0.2
+# CelebA's partition sizes are 162770/19867/19962
+PART_FRACS = (0.8148, 0.0994, 0.0858)
+FILL_FRAC = 0.7 # fraction of each subgroup the scaled train+val limits may use
+
+SETTINGS_TEMPLATE = '''"""
+Generated by benchmarks/make_synthetic_celeba.py.
+Loads the repo settings, then scales the
+train/val limits to fit this synthetic dataset.
+"""
+import os
+_REPO_SETTINGS = {repo_settings!r}
+exec(compile(open(_REPO_SETTINGS, encoding="utf-8").read(), _REPO_SETTINGS, "exec"))
+TRAIN_LIMS_1_CORR = {train_lims_1!r}
+VAL_LIMS_1_CORR = {val_lims_1!r}
+TRAIN_LIMS_2_CORR = {train_lims_2!r}
+VAL_LIMS_2_CORR = {val_lims_2!r}
+'''
+
+def make_attrs(num:int, rng) -> np.ndarray:
+    """
+    Random +-1 attributes, one column
+    per CelebA attribute.
+    """
+    probs = np.array([ATTR_PROBS.get(name, DEFAULT_ATTR_PROB) for name in CELEBA_HEADER[1:]])
+    return np.where(rng.random((num, len(probs))) < probs, 1, -1).astype(np.int8)
+
+def scaled_lims(attrs:np.ndarray, train_lims:dict, val_lims:dict):
+    """
+    Shrink the train/val limits by a single
+    factor (keeping the planted correlations)
+    so every subgroup can be filled using at
+    most FILL_FRAC of its images. Limits are
+    never scaled up past the real settings.
+    """
+    cols = {name: CELEBA_HEADER[1:].index(name) for name in ATTR_PROBS}
+    young = attrs[:, cols["Young"]] == 1
+    male = attrs[:, cols["Male"]] == 1
+    smiling = attrs[:, cols["Smiling"]] == 1
+    scale = 1.0
+    for key in train_lims:
+        parts = key.split("_", 2)
+        mask = (young if parts[0] == "young" else ~young) & \
+            (male if parts[1] == "male" else ~male)
+        if len(parts) == 3:
+            mask &= smiling if parts[2] == "smile" else ~smiling
+        needed = train_lims[key] + val_lims[key]
+        scale = min(scale, FILL_FRAC * mask.sum() / needed)
+    return {k: max(1, int(v * scale)) for k, v in train_lims.items()}, \
+        {k: max(1, int(v * scale)) for k, v in val_lims.items()}
+
+def generate(out_root:str, num:int, seed:int=0):
+    """
+    Write a synthetic CelebA tree
+    with num images to out_root.
+    """
+    rng = np.random.default_rng(seed)
+    img_dir = os.path.join(out_root, CELEBA_DIR)
+    pool_dir = os.path.join(out_root, "jpeg_pool")
+    info_dir = os.path.dirname(os.path.join(out_root, CELEBA_ATTRS_CSV))
+    for dirn in (img_dir, pool_dir, info_dir):
+        os.makedirs(dirn, exist_ok=True)
+
+    print(f"Writing {num} images to {img_dir}")
+    pool = make_jpegs(pool_dir, NUM_UNIQUE_JPEGS, seed)
+    file_names = [f"{i+1:06d}.jpg" for i in range(num)]
+    for i, f_name in enumerate(file_names):
+        dst = os.path.join(img_dir, f_name)
+        if os.path.exists(dst):
+            continue
+        src = pool[i % NUM_UNIQUE_JPEGS]
+        try:
+            os.link(src, dst)
+        except OSError: # filesystem without hard links
+            with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+                f_dst.write(f_src.read())
+
+    print("Writing attribute and partition files")
+    attrs = make_attrs(num, rng)
+    with open(os.path.join(out_root, CELEBA_ATTRS_CSV), "w", encoding="utf-8") as f:
+        f.write(",".join(CELEBA_HEADER) + "\n")
+        for f_name, row in zip(file_names, attrs):
+            f.write(f_name + "," + ",".join(map(str, row)) + "\n")
+    bounds = np.cumsum(PART_FRACS) * num
+    partitions = np.searchsorted(bounds, np.arange(num), side="right")
+    with open(os.path.join(out_root, CELEBA_PART_TXT), "w", encoding="utf-8") as f:
+        for f_name, part in zip(file_names, partitions):
+            f.write(f"{f_name} {part}\n")
+
+    train_lims_1, val_lims_1 = scaled_lims(attrs, TRAIN_LIMS_1_CORR, VAL_LIMS_1_CORR)
+    train_lims_2, val_lims_2 = scaled_lims(attrs, TRAIN_LIMS_2_CORR, VAL_LIMS_2_CORR)
+    with open(os.path.join(out_root, "settings.py"), "w", encoding="utf-8") as f:
+        f.write(SETTINGS_TEMPLATE.format(
+            repo_settings=os.path.join(ROOT, "settings.py"),
+            train_lims_1=train_lims_1, val_lims_1=val_lims_1,
+            train_lims_2=train_lims_2, val_lims_2=val_lims_2))
+    lims = train_lims_1 if NUM_CORRS == 1 else train_lims_2
+    print(f"Scaled train limits: {lims}")
+
+def main():
+    """
+    Parse the output root and size
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_root", help="directory to write the dataset to")
+    parser.add_argument("num_images", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.out_root, args.num_images, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Run the full pipeline
+    make_celeba_split.py -> train_resnet.py ->
+    test_evals.py -> top_k.py -> gmm.py
+on synthetic CelebA-shaped datasets of
+increasing size and record each stage's
+wall time, peak RSS, and throughput, then
+plot how every stage scales.
+
+Each dataset is written by make_synthetic_celeba.py
+and each stage runs in its own process with the
+dataset root as its working directory (and first
+on PYTHONPATH, so its generated settings.py is
+used), exactly as the scripts would be run by hand.
+top_k.py and gmm.py need the CLIP weights, which
+clip.load downloads on first use.
+
+Run from the repo root, ex:
+    python3 benchmarks/scaling_harness.py --sizes 10000 100000 1000000
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint:disable=wrong-import-position
+from settings import TRAIN_DIR, VAL_DIR, TEST_DIR
+from make_synthetic_celeba import generate
+
+DEFAULT_SIZES = [10_000, 30_000, 100_000, 300_000, 1_000_000]
+TRAIN_EPOCHS = 1 # enough to time an epoch without training a real model
+# stage name -> (dir to import from, python statement that runs it)
+STAGES = {
+    "make_celeba_split": ("dataset_utils", "import make_celeba_split; make_celeba_split.main()"),
+    "train_resnet": ("resnet_models", "import train_resnet; train_resnet.main(epochs={epochs})"),
+    "test_evals": ("", "import test_evals; test_evals.main()"),
+    "top_k": ("", "import top_k; top_k.main()"),
+    "gmm": ("experiments", "import gmm; gmm.main()"),
+}
+
+def count_images(data_dir:str) -> int:
+    """
+    Number of files under data_dir
+    """
+    return sum(len(files) for _, _, files in os.walk(data_dir))
+
+def stage_items(stage:str, data_root:str, num_images:int, epochs:int) -> int:
+    """
+    Number of images the stage processes,
+    used to calculate its throughput.
+    """
+    def count(dirn):
+        return count_images(os.path.join(data_root, dirn))
+    if stage == "make_celeba_split":
+        return num_images
+    if stage == "train_resnet":
+        return count(TRAIN_DIR) * epochs
+    if stage in ("test_evals", "top_k"):
+        return count(VAL_DIR) + count(TEST_DIR)
+    return count(os.path.join(VAL_DIR, "old")) # gmm.py MODES
+
+def run_stage(stage:str, data_root:str, log_dir:str, epochs:int) -> dict:
+    """
+    Run a single stage in a child process and
+    return its wall time, peak RSS, and exit code.
+    """
+    import_dir, statement = STAGES[stage]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.abspath(data_root),
+                                        os.path.join(ROOT, import_dir), ROOT])
+    env["MPLBACKEND"] = "Agg" # in case anything plots outside report.py
+    log_path = os.path.join(log_dir, f"{stage}.log")
+    with open(log_path, "w", encoding="utf-8") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-c", statement.format(epochs=epochs)],
+                                cwd=data_root, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child alone
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {"wall_s": wall, "cpu_s": rusage.ru_utime + rusage.ru_stime,
+            "peak_rss_mb": rusage.ru_maxrss / 1024, # ru_maxrss is in KB on Linux
+            "returncode": proc.returncode, "log": log_path}
+
+def run_size(num_images:int, work_dir:str, stages:list[str], epochs:int) -> list[dict]:
+    """
+    Generate a dataset of num_images
+    and run every stage on it in order.
+    A failed stage skips the rest, since
+    each one needs the previous one's output.
+    """
+    data_root = os.path.join(work_dir, f"synth_{num_images}")
+    generate(data_root, num_images)
+    os.makedirs(os.path.join(data_root, "resnet_models"), exist_ok=True)
+    log_dir = os.path.join(data_root, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    records = []
+    for stage in stages:
+        print(f"[{num_images}] running {stage}")
+        res = run_stage(stage, data_root, log_dir, epochs)
+        res.update({"num_images": num_images, "stage": stage})
+        if res["returncode"] == 0:
+            res["items"] = stage_items(stage, data_root, num_images, epochs)
+            res["items_per_s"] = res["items"] / res["wall_s"]
+        records.append(res)
+        print(f"[{num_images}] {stage}: {res['wall_s']:.1f}s, " +\
+              f"{res['peak_rss_mb']:.0f} MB peak RSS, exit code {res['returncode']}")
+        if res["returncode"] != 0:
+            print(f"[{num_images}] {stage} failed, see {res['log']}. Skipping later stages.")
+            break
+    return records
+
+def plot_scaling(records:list[dict], out_dir:str):
+    """
+    Log-log plots of wall time, peak RSS,
+    and throughput vs dataset size per stage.
+    """
+    # pylint:disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    metrics = [("wall_s", "Wall Time (s)"), ("peak_rss_mb", "Peak RSS (MB)"),
+               ("items_per_s", "Images / s")]
+    for key, label in metrics:
+        for stage in STAGES:
+            pts = sorted((rec["num_images"], rec[key]) for rec in records \
+                         if rec["stage"] == stage and rec.get(key) is not None)
+            if pts:
+                plt.plot(*zip(*pts), marker="o", label=stage)
+        plt.xscale("log")
+        plt.yscale("log")
+        plt.xlabel("Dataset Size (images)")
+        plt.ylabel(label)
+        plt.legend(loc="upper left")
+        plt.title(f"{label} by Stage")
+        plt.savefig(os.path.join(out_dir, f"scaling_{key}.png"))
+        plt.clf()
+        plt.close()
+
+def main():
+    """
+    Run every size, saving results as
+    they come in so a long sweep that
+    dies part way still leaves data.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES)
+    parser.add_argument("--work-dir", default="scaling_runs")
+    parser.add_argument("--stages", nargs="*", default=list(STAGES))
+    parser.add_argument("--epochs", type=int, default=TRAIN_EPOCHS,
+                        help="epochs for train_resnet.py")
+    args = parser.parse_args()
+    for stage in args.stages:
+        assert stage in STAGES, f"Unknown stage {stage}, expected one of {list(STAGES)}"
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    records = []
+    json_path = os.path.join(args.work_dir, "scaling_results.json")
+    for num_images in sorted(args.sizes):
+        records.extend(run_size(num_images, args.work_dir, args.stages, args.epochs))
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(records, f, indent=2)
+
+    csv_path = os.path.join(args.work_dir, "scaling_results.csv")
+    fields = ["num_images", "stage", "wall_s", "cpu_s", "peak_rss_mb",
+              "items", "items_per_s", "returncode"]
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+    plot_scaling(records, args.work_dir)
+    print(f"Saved results and plots to {args.work_dir}")
+
+if __name__ == "__main__":
+    main()
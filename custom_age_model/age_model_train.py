@@ -1,3 +1,29 @@
+"""
+Train a young/old classifier, either my
+CustomAgeNetwork or a small fc head on top
+of a frozen, pretrained ShuffleNet backbone
+(USE_PRETRAINED).
+
+When the backbone is frozen its output never
+changes, so with USE_FEATURE_CACHE the backbone
+features of every train/val image are computed
+once, cached to memmapped .npy files in
+FEATURE_CACHE_DIR, and the head is trained and
+validated directly on the cached features.
+The cache is rebuilt whenever the images in
+a split change.
+
+`python3 age_model_train.py eval` reports the
+val accuracy of the saved CustomAgeNetwork,
+using its frozen TorchScript export from
+resnet_models/export_inference.py if it's up
+to date (see load_inference_model).
+"""
+
+import os
+import sys
+import json
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
@@ -15,85 +41,233 @@ VAL_DIR = './val'
 BEST_ACC_ALLOWANCE = 0.005 # How low below best acc to still save model
 EPOCH_LOSS_ALLOWANCE = 100 # How high above previous loss to still save model
 USE_PRETRAINED = False
+USE_FEATURE_CACHE = True # Only used with USE_PRETRAINED. Train the fc head on cached backbone features
+FEATURE_CACHE_DIR = './feature_cache'
+LR = 0.001
+WEIGHT_DECAY = 0.0001
+BATCH_SIZE = 64
+FEATURE_BATCH_SIZE = 256 # images per backbone forward pass when building the cache
 
-if USE_PRETRAINED:
-    model = shufflenet_v2_x0_5(weights = ShuffleNet_V2_X0_5_Weights.DEFAULT)
-    # Overwrite last fc layer in pretrained model for new linear layers
-    model.fc = nn.Sequential(nn.Linear(1024, 256),
-                            nn.ReLU(),
-                            nn.Linear(256, 2),
-                            nn.Softmax())
-    # Freeze all params
-    for param in model.parameters():
-        param.requires_grad = False
-    # Unfreeze my fc layers
-    for layer in model.fc:
-        if isinstance(layer, nn.modules.linear.Linear):
-            layer.weight.requires_grad = True
-            layer.bias.requires_grad = True
-    data_transforms = ShuffleNet_V2_X0_5_Weights.DEFAULT.transforms()
-    # Only optimize parameters that aren't frozen
-    optimizer = optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=0.001, weight_decay=0.0001)
-else:
-    model = CustomAgeNetwork()
-    data_transforms = transforms.Compose([
-        transforms.Resize((82, 100)),
-        transforms.ToTensor()
-    ])
-    optimizer = optim.Adam(model.parameters(), lr=0.001, weight_decay=0.0001)
-
-loss_fn = nn.CrossEntropyLoss()
-train_data = datasets.ImageFolder(TRAIN_DIR, transform=data_transforms)
-val_data = datasets.ImageFolder(VAL_DIR, transform=data_transforms)
-train_loader = DataLoader(train_data, batch_size=64, shuffle=True)
-val_loader = DataLoader(val_data, batch_size=64)
-
-def val_accuracy():
-    """
-    Loop through every image in the
-    validation dataloader to calculate 
-    the accuracy over the validation set.
+def build_model():
     """
-    val_correct = 0
-    val_total = 0
+    Create the model and the transforms
+    for its input images
+    """
+    if USE_PRETRAINED:
+        model = shufflenet_v2_x0_5(weights = ShuffleNet_V2_X0_5_Weights.DEFAULT)
+        # Overwrite last fc layer in pretrained model for new linear layers
+        model.fc = nn.Sequential(nn.Linear(1024, 256),
+                                nn.ReLU(),
+                                nn.Linear(256, 2),
+                                nn.Softmax())
+        # Freeze all params
+        for param in model.parameters():
+            param.requires_grad = False
+        # Unfreeze my fc layers
+        for layer in model.fc:
+            if isinstance(layer, nn.modules.linear.Linear):
+                layer.weight.requires_grad = True
+                layer.bias.requires_grad = True
+        data_transforms = ShuffleNet_V2_X0_5_Weights.DEFAULT.transforms()
+    else:
+        model = CustomAgeNetwork()
+        data_transforms = transforms.Compose([
+            transforms.Resize((82, 100)),
+            transforms.ToTensor()
+        ])
+    return model, data_transforms
+
+def backbone_features(model, images):
+    """
+    ShuffleNetV2's forward pass up to (but
+    not including) the fc layer
+    """
+    x = model.maxpool(model.conv1(images))
+    x = model.stage4(model.stage3(model.stage2(x)))
+    x = model.conv5(x)
+    return x.mean([2, 3]) # global pool
+
+def cached_features(model, data_dir:str, data_transforms, split:str):
+    """
+    Get the backbone features and labels of every
+    image in data_dir, computing and caching them
+    first if the cache is missing or was built from
+    a different set of images. Features are returned
+    as a read-only memmap of shape (num_images, 1024).
+    """
+    data = datasets.ImageFolder(data_dir, transform=data_transforms)
+    # Fingerprint the image list so adding/removing
+    # images or relabelling them rebuilds the cache
+    fingerprint = hashlib.sha1(json.dumps(data.samples).encode()).hexdigest()
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    feats_path = os.path.join(FEATURE_CACHE_DIR, f'{split}_feats.npy')
+    labels_path = os.path.join(FEATURE_CACHE_DIR, f'{split}_labels.npy')
+    meta_path = os.path.join(FEATURE_CACHE_DIR, f'{split}_meta.json')
+
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            if json.load(f)['fingerprint'] == fingerprint:
+                print(f'Using cached {split} features from {feats_path}')
+                return np.load(feats_path, mmap_mode='r'), np.load(labels_path)
+        os.remove(meta_path) # stale
+
+    print(f'Caching backbone features for {len(data)} {split} images')
+    model.eval()
+    tmp_path = feats_path + '.tmp.npy'
+    feats = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                      shape=(len(data), model.fc[0].in_features))
+    labels = np.empty(len(data), dtype=np.int64)
+    cur_idx = 0
     with torch.no_grad():
-        for val_imgs, val_labels in val_loader:
-            val_out = model(val_imgs)
-            _, predicted = torch.max(val_out.data, 1)
-            val_correct += (predicted == val_labels).sum().item()
-            val_total += data.size(0)
-    val_acc = val_correct / val_total
-    print(f'Test accuracy: {val_acc}')
-    return accuracy
+        for images, batch_labels in DataLoader(data, batch_size=FEATURE_BATCH_SIZE):
+            b_size = batch_labels.size(0)
+            feats[cur_idx:cur_idx+b_size] = backbone_features(model, images).numpy()
+            labels[cur_idx:cur_idx+b_size] = batch_labels.numpy()
+            cur_idx += b_size
+    feats.flush()
+    del feats
+    os.replace(tmp_path, feats_path)
+    np.save(labels_path, labels)
+    # Written last, so the cache only counts as
+    # valid once the features are complete
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': fingerprint, 'num_images': len(data)}, f)
+    return np.load(feats_path, mmap_mode='r'), labels
 
-def train(epochs, early_stop):
+def feature_batches(feats, labels, batch_size:int, shuffle:bool):
+    """
+    Yield (features, labels) tensor batches
+    from the cached features. Indices within a
+    shuffled batch are sorted so each read from
+    the memmap moves forward through the file.
+    """
+    order = np.random.permutation(len(labels)) if shuffle else np.arange(len(labels))
+    for start_i in range(0, len(labels), batch_size):
+        idxs = np.sort(order[start_i:start_i+batch_size])
+        yield torch.from_numpy(np.ascontiguousarray(feats[idxs])), \
+            torch.from_numpy(labels[idxs])
+
+class Trainer:
+
+    """
+    Holds the model, optimizer, and data
+    for a single training configuration
+    """
+
+    def __init__(self, lr:float=LR, weight_decay:float=WEIGHT_DECAY,
+                 batch_size:int=BATCH_SIZE, model_path:str=MODEL_PATH):
+        self.model, data_transforms = build_model()
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.use_cache = USE_PRETRAINED and USE_FEATURE_CACHE
+        # Only optimize parameters that aren't frozen
+        self.optimizer = optim.Adam(filter(lambda p: p.requires_grad, self.model.parameters()),
+                                    lr=lr, weight_decay=weight_decay)
+        self.loss_fn = nn.CrossEntropyLoss()
+        if self.use_cache:
+            self.train_feats, self.train_labels = \
+                cached_features(self.model, TRAIN_DIR, data_transforms, 'train')
+            self.val_feats, self.val_labels = \
+                cached_features(self.model, VAL_DIR, data_transforms, 'val')
+        else:
+            train_data = datasets.ImageFolder(TRAIN_DIR, transform=data_transforms)
+            val_data = datasets.ImageFolder(VAL_DIR, transform=data_transforms)
+            self.train_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True)
+            self.val_loader = DataLoader(val_data, batch_size=batch_size)
+
+    def forward(self, inputs):
+        """
+        Model output for a batch of images,
+        or of cached features
+        """
+        return self.model.fc(inputs) if self.use_cache else self.model(inputs)
+
+    def train_batches(self):
+        """
+        Shuffled training batches
+        """
+        if self.use_cache:
+            return feature_batches(self.train_feats, self.train_labels, self.batch_size, True)
+        return self.train_loader
+
+    def val_batches(self):
+        """
+        Validation batches, in order
+        """
+        if self.use_cache:
+            return feature_batches(self.val_feats, self.val_labels, self.batch_size, False)
+        return self.val_loader
+
+    def train_epoch(self) -> float:
+        """
+        One pass over the training data.
+        Returns the epoch's total loss.
+        """
+        self.model.train()
+        if USE_PRETRAINED:
+            self.model.eval() # keep the frozen backbone's BatchNorm stats fixed
+            self.model.fc.train()
+        epoch_loss = 0.0
+        for data, labels in self.train_batches():
+            self.optimizer.zero_grad() # zero out gradients
+            output = self.forward(data) # get model output on data
+            labels = F.one_hot(labels, num_classes = 2).float()
+            loss = self.loss_fn(output, labels) # calculate loss
+            loss.backward() # BPROP to calc gradients
+            self.optimizer.step() # update weights
+            epoch_loss += loss.item() * data.size(0) # add loss to running total
+        return epoch_loss
+
+    def val_accuracy(self) -> float:
+        """
+        Loop through every image in the
+        validation data to calculate
+        the accuracy over the validation set.
+        """
+        self.model.eval()
+        val_correct = 0
+        val_total = 0
+        with torch.no_grad():
+            for val_data, val_labels in self.val_batches():
+                val_out = self.forward(val_data)
+                _, predicted = torch.max(val_out.data, 1)
+                val_correct += (predicted == val_labels).sum().item()
+                val_total += val_data.size(0)
+        val_acc = val_correct / val_total
+        print(f'Validation accuracy: {val_acc}')
+        return val_acc
+
+    def save(self):
+        """
+        Save the model's weights to model_path
+        """
+        torch.save(self.model.state_dict(), self.model_path)
+
+def train(epochs, early_stop, trainer=None):
     """
     Train the model!
+    Returns the validation accuracy
+    after each epoch.
     """
+    trainer = trainer or Trainer()
     best_accuracy = 0.0
     epochs_without_improvement = 0
     prev_epoch_loss = np.inf
+    val_curve = []
     print("Beginning training!")
     for epoch_idx in range(epochs):
         print("----------")
-        epoch_loss = 0.0
-        for data, labels in train_loader:
-            optimizer.zero_grad() # zero out gradients
-            output = model(data) # get model output on data
-            labels = F.one_hot(labels, num_classes = 2).float()
-            loss = loss_fn(output, labels) # calculate loss
-            loss.backward() # BPROP to calc gradients
-            optimizer.step() # update weights
-            epoch_loss += loss.item() * data.size(0) # add loss to running total
+        epoch_loss = trainer.train_epoch()
         print(f'Epoch: {epoch_idx + 1} | Loss: {epoch_loss}')
-        accuracy = val_accuracy()
+        accuracy = trainer.val_accuracy()
+        val_curve.append(accuracy)
         if accuracy > best_accuracy - BEST_ACC_ALLOWANCE and \
             epoch_loss < prev_epoch_loss+EPOCH_LOSS_ALLOWANCE:
 
             if accuracy > best_accuracy:
                 best_accuracy = accuracy
             prev_epoch_loss = epoch_loss
-            torch.save(model.state_dict(), MODEL_PATH)
+            trainer.save()
             print('Saved model. Accuracy: ', accuracy)
             epochs_without_improvement = 0
         else:
@@ -104,6 +278,57 @@ def train(epochs, early_stop):
                     on test set. Stopping early at epoch \
                         {epoch_idx + 1}.")
                 break
+    return val_curve
+
+def frozen_path(model_path:str=MODEL_PATH) -> str:
+    """
+    Where resnet_models/export_inference.py saves
+    the frozen copy of model_path, ex:
+    ./smiling_age_model.frozen.pt
+    """
+    return os.path.splitext(model_path)[0] + '.frozen.pt'
+
+def load_inference_model(model_path:str=MODEL_PATH):
+    """
+    The CustomAgeNetwork saved at model_path, for
+    inference on the CPU: its frozen export if it
+    was made since model_path was last saved,
+    else the eager model
+    """
+    assert not USE_PRETRAINED, \
+        "Only CustomAgeNetwork is exported, see resnet_models/export_inference.py"
+    path = frozen_path(model_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model_path):
+        # CPU only, optimize_for_inference may have inserted MKLDNN ops
+        return torch.jit.load(path, map_location='cpu')
+    print(f'No up to date frozen model at {path}, using the eager model. Run ' +\
+          f'python3 resnet_models/export_inference.py custom_age --weights {model_path} ' +\
+          'to create it.')
+    model, _ = build_model()
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    return model.eval()
+
+def evaluate(model_path:str=MODEL_PATH) -> float:
+    """
+    Accuracy over VAL_DIR of the model
+    at model_path (see load_inference_model)
+    """
+    model = load_inference_model(model_path)
+    _, data_transforms = build_model()
+    val_loader = DataLoader(datasets.ImageFolder(VAL_DIR, transform=data_transforms),
+                            batch_size=BATCH_SIZE)
+    val_correct = 0
+    val_total = 0
+    with torch.no_grad():
+        for val_data, val_labels in val_loader:
+            val_correct += (model(val_data).argmax(1) == val_labels).sum().item()
+            val_total += val_data.size(0)
+    val_acc = val_correct / val_total
+    print(f'Validation accuracy: {val_acc}')
+    return val_acc
 
 if __name__ == "__main__":
-    train(NUM_EPOCHS, 10)
+    if sys.argv[1:] == ["eval"]:
+        evaluate()
+    else:
+        train(NUM_EPOCHS, 10)
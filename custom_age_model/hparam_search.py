@@ -0,0 +1,205 @@
+"""
+Parallel hyperparameter search for
+age_model_train.py using successive halving.
+
+NUM_TRIALS configs (lr, weight decay, batch
+size) are sampled from SEARCH_SPACE. Every
+trial is trained for MIN_EPOCHS, then only
+the best 1/ETA of them (by best validation
+accuracy so far) are trained further, to
+ETA times as many epochs, and so on until the
+survivors reach NUM_EPOCHS. Weak configs stop
+early, so most of the compute goes to the
+promising ones.
+
+Trials run as separate worker processes, each
+pinned to its own set of CORES_PER_TRIAL cores
+with a matching torch thread count, so the
+whole node is used without oversubscribing.
+Each trial checkpoints after every rung and
+resumes from there when promoted.
+
+Every trial's config, validation curve, and
+per-epoch wall time are written to
+HPARAM_DIR/trials.json, and the best model
+is copied to age_model_train.MODEL_PATH.
+
+Run from this directory:
+    python3 hparam_search.py
+"""
+
+import os
+import json
+import time
+import shutil
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+from age_model_train import Trainer, NUM_EPOCHS, MODEL_PATH, TRAIN_DIR, VAL_DIR, \
+    USE_PRETRAINED, USE_FEATURE_CACHE, build_model, cached_features
+
+NUM_TRIALS = 27
+MIN_EPOCHS = 2 # epochs every trial gets before the first cut
+ETA = 3 # keep the best 1/ETA trials at each rung
+CORES_PER_TRIAL = 2
+HPARAM_DIR = './hparam_runs'
+SEED = 0
+SEARCH_SPACE = {
+    'lr': (1e-4, 1e-2), # sampled log-uniformly
+    'weight_decay': (1e-6, 1e-3), # sampled log-uniformly
+    'batch_size': [32, 64, 128, 256],
+}
+
+def sample_configs(num:int, seed:int=SEED) -> list[dict]:
+    """
+    Randomly sample num configs from SEARCH_SPACE
+    """
+    rng = np.random.default_rng(seed)
+    def log_uniform(low, high):
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    return [{'lr': log_uniform(*SEARCH_SPACE['lr']),
+             'weight_decay': log_uniform(*SEARCH_SPACE['weight_decay']),
+             'batch_size': int(rng.choice(SEARCH_SPACE['batch_size']))}
+            for _ in range(num)]
+
+def rung_epochs() -> list[int]:
+    """
+    Total epochs trained by the end of each
+    rung, ex: [2, 6, 18, 50] for NUM_EPOCHS 50
+    """
+    rungs = [MIN_EPOCHS]
+    while rungs[-1] * ETA < NUM_EPOCHS:
+        rungs.append(rungs[-1] * ETA)
+    if rungs[-1] < NUM_EPOCHS:
+        rungs.append(NUM_EPOCHS)
+    return rungs
+
+def core_groups() -> list[list[int]]:
+    """
+    Split the cores this process may use
+    into groups of CORES_PER_TRIAL
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else list(range(os.cpu_count() or 1))
+    groups = [cores[i:i+CORES_PER_TRIAL] for i in range(0, len(cores), CORES_PER_TRIAL)]
+    # Don't leave a worker with fewer cores than the rest
+    if len(groups) > 1 and len(groups[-1]) < CORES_PER_TRIAL:
+        groups[-2].extend(groups.pop())
+    return groups
+
+def _init_worker(free_groups):
+    """
+    Claim a core group for this worker
+    process and pin it to those cores
+    """
+    cores = free_groups.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+def run_trial(trial_id:int, config:dict, end_epoch:int) -> dict:
+    """
+    Train one trial up to end_epoch total
+    epochs, resuming from its checkpoint.
+    Returns its updated record.
+    """
+    trial_dir = os.path.join(HPARAM_DIR, f'trial_{trial_id:03d}')
+    os.makedirs(trial_dir, exist_ok=True)
+    ckpt_path = os.path.join(trial_dir, 'checkpoint.pth')
+    trainer = Trainer(lr=config['lr'], weight_decay=config['weight_decay'],
+                      batch_size=config['batch_size'],
+                      model_path=os.path.join(trial_dir, 'best_model.pth'))
+    record = {'trial_id': trial_id, 'config': config, 'val_curve': [],
+              'epoch_times': [], 'best_acc': 0.0}
+    if os.path.exists(ckpt_path):
+        ckpt = torch.load(ckpt_path)
+        if ckpt['record']['config'] == config:
+            trainer.model.load_state_dict(ckpt['model'])
+            trainer.optimizer.load_state_dict(ckpt['optimizer'])
+            record = ckpt['record']
+        else:
+            # Left by a search with another SEED or NUM_TRIALS
+            print(f"Trial {trial_id}'s checkpoint was trained with {ckpt['record']['config']}, " +\
+                  f"restarting it with {config}")
+            best_path = os.path.join(trial_dir, 'best_model.pth')
+            if os.path.exists(best_path):
+                os.remove(best_path)
+
+    for _ in range(len(record['val_curve']), end_epoch):
+        start = time.perf_counter()
+        trainer.train_epoch()
+        accuracy = trainer.val_accuracy()
+        record['epoch_times'].append(time.perf_counter() - start)
+        record['val_curve'].append(accuracy)
+        if accuracy > record['best_acc']:
+            record['best_acc'] = accuracy
+            trainer.save()
+
+    torch.save({'model': trainer.model.state_dict(),
+                'optimizer': trainer.optimizer.state_dict(),
+                'record': record}, ckpt_path)
+    record['cores'] = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+    return record
+
+def save_records(records:dict):
+    """
+    Write every trial's record to trials.json
+    """
+    with open(os.path.join(HPARAM_DIR, 'trials.json'), 'w', encoding='utf-8') as f:
+        json.dump(sorted(records.values(), key=lambda rec: -rec['best_acc']), f, indent=2)
+
+def search():
+    """
+    Run successive halving over
+    NUM_TRIALS sampled configs
+    """
+    os.makedirs(HPARAM_DIR, exist_ok=True)
+    if USE_PRETRAINED and USE_FEATURE_CACHE:
+        # Build the feature cache once up front instead of
+        # having every worker race to build it
+        model, data_transforms = build_model()
+        cached_features(model, TRAIN_DIR, data_transforms, 'train')
+        cached_features(model, VAL_DIR, data_transforms, 'val')
+
+    configs = sample_configs(NUM_TRIALS)
+    groups = core_groups()
+    print(f'Running {NUM_TRIALS} trials over rungs {rung_epochs()} ' +\
+          f'with {len(groups)} parallel workers')
+
+    # spawn, since forking after torch has started
+    # its thread pools can deadlock the children
+    ctx = mp.get_context('spawn')
+    records = {}
+    alive = list(range(NUM_TRIALS))
+    search_start = time.perf_counter()
+    # Exiting the with shuts the manager's process down once the pool is done
+    with ctx.Manager() as manager:
+        free_groups = manager.Queue()
+        for group in groups:
+            free_groups.put(group)
+        with ProcessPoolExecutor(max_workers=len(groups), mp_context=ctx,
+                                 initializer=_init_worker, initargs=(free_groups,)) as pool:
+            for rung_idx, end_epoch in enumerate(rung_epochs()):
+                futures = [pool.submit(run_trial, trial_id, configs[trial_id], end_epoch) \
+                           for trial_id in alive]
+                for future in as_completed(futures):
+                    rec = future.result()
+                    rec['rung'] = rung_idx
+                    records[rec['trial_id']] = rec
+                    print(f"Trial {rec['trial_id']} reached epoch {end_epoch}: " +\
+                          f"best acc {rec['best_acc']:.4f} config {rec['config']}")
+                save_records(records)
+                # Promote the best 1/ETA to the next rung
+                alive.sort(key=lambda trial_id: -records[trial_id]['best_acc'])
+                alive = alive[:max(1, len(alive) // ETA)]
+
+    best = records[alive[0]]
+    print(f'Search took {time.perf_counter() - search_start:.1f}s')
+    print(f"Best trial {best['trial_id']}: acc {best['best_acc']:.4f} config {best['config']}")
+    best_path = os.path.join(HPARAM_DIR, f"trial_{best['trial_id']:03d}", 'best_model.pth')
+    shutil.copy(best_path, MODEL_PATH)
+    print(f'Copied best model to {MODEL_PATH}')
+
+if __name__ == "__main__":
+    search()
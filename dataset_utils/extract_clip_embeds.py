@@ -0,0 +1,151 @@
+"""
+Calculate the CLIP embedding of every image
+in a split and save them to disk in shards.
+The image list is split into shards of
+SHARD_SIZE images, and each shard is encoded
+by a separate worker process with its own
+intra-op thread count.
+
+Finished shards are written atomically
+(to a temp file that is then renamed), so
+an existing shard file is always complete.
+On restart, any shard that already exists
+is skipped, meaning a crash only costs the
+shard that was in progress.
+
+Run from the repo root, ex:
+    python3 dataset_utils/extract_clip_embeds.py val
+The embeddings can then be read back with
+utils.load_clip_embeds.
+"""
+
+import os
+import sys
+import json
+import time
+from multiprocessing import get_context
+import numpy as np
+import torch
+from settings import CLIP_VIS, EMBEDS_DIR, TRAIN_DIR, VAL_DIR, TEST_DIR
+from model_registry import get_device, get_model, encode_images_local
+from manifest import load_manifest
+import instrument
+
+# Vars - Modify these to change extraction behavior
+SHARD_SIZE = 2048 # images per shard (shard boundaries must not change between restarts)
+BATCH_SIZE = 256 # images per CLIP forward pass within a shard
+THREADS_PER_WORKER = 2 # torch intra-op threads for each worker process
+NUM_WORKERS = max(1, (os.cpu_count() or 1) // THREADS_PER_WORKER)
+SPLIT_DIRS = {"train": TRAIN_DIR, "val": VAL_DIR, "test": TEST_DIR}
+
+def shard_file(out_dir:str, shard_idx:int) -> str:
+    """
+    Path of the file holding
+    shard number shard_idx.
+    """
+    return os.path.join(out_dir, f"shard_{shard_idx:05d}.npz")
+
+def _init_worker(num_threads:int):
+    """
+    Load CLIP once per worker process
+    and limit its intra-op threads so the
+    workers don't oversubscribe the cores.
+    """
+    torch.set_num_threads(num_threads)
+    get_model("clip")
+
+def _encode_shard(job):
+    """
+    Encode a single shard and atomically
+    write its embeddings and paths to disk.
+    Returns the shard index and the time
+    taken so the parent can report progress.
+    """
+    shard_idx, paths, out_path = job
+    start = time.perf_counter()
+    embeds = encode_images_local(paths, BATCH_SIZE)
+
+    # Write to a temp file first, then rename so that
+    # a partially written shard is never mistaken for
+    # a finished one. os.replace is atomic on POSIX.
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, embeds=embeds, paths=np.array(paths))
+    os.replace(tmp_path, out_path)
+    return shard_idx, time.perf_counter() - start
+
+def extract(split:str, num_workers:int=NUM_WORKERS):
+    """
+    Encode every image in the given split
+    ("train", "val", or "test"), skipping
+    any shards that have already been saved.
+    """
+    data_dir = SPLIT_DIRS[split]
+    out_dir = os.path.join(EMBEDS_DIR, split)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # The manifest is sorted (like ImageFolder), so
+    # the shard boundaries are the same on every run
+    paths = load_manifest(data_dir).paths.tolist()
+    num_shards = int(np.ceil(len(paths) / SHARD_SIZE))
+
+    # Record how the split was sharded. A restart
+    # with a different image list or shard size
+    # would silently mix up embeddings, so refuse.
+    index = {"clip_model": CLIP_VIS, "data_dir": data_dir,
+             "num_images": len(paths), "shard_size": SHARD_SIZE,
+             "num_shards": num_shards}
+    index_path = os.path.join(out_dir, "index.json")
+    if os.path.exists(index_path):
+        with open(index_path, encoding="utf-8") as f:
+            prev_index = json.load(f)
+        assert prev_index == index, \
+            f"Existing shards in {out_dir} were made with {prev_index}, " +\
+            f"but current settings are {index}. Remove {out_dir} to start over."
+    else:
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+
+    jobs = []
+    for shard_idx in range(num_shards):
+        out_path = shard_file(out_dir, shard_idx)
+        if os.path.exists(out_path):
+            continue
+        shard_paths = paths[shard_idx*SHARD_SIZE:(shard_idx+1)*SHARD_SIZE]
+        jobs.append((shard_idx, shard_paths, out_path))
+    print(f"{split.upper()}: {len(paths)} images in {num_shards} shards, " +\
+          f"{num_shards - len(jobs)} already done")
+    if not jobs:
+        return
+
+    # Only one process should own the GPU
+    if get_device() == "cuda":
+        num_workers = 1
+    num_workers = min(num_workers, len(jobs))
+    print(f"Encoding {len(jobs)} shards with {num_workers} workers " +\
+          f"x {THREADS_PER_WORKER} threads")
+    ctx = get_context("spawn" if get_device() == "cuda" else "fork")
+    with ctx.Pool(num_workers, initializer=_init_worker,
+                  initargs=(THREADS_PER_WORKER,)) as pool, \
+            instrument.stage("encode_shards", items=sum(len(job[1]) for job in jobs)):
+        for num_done, (shard_idx, secs) in \
+                enumerate(pool.imap_unordered(_encode_shard, jobs), start=1):
+            print(f"Finished shard {shard_idx} in {secs:.1f}s " +\
+                  f"({num_done}/{len(jobs)})")
+
+def main():
+    """
+    Extract the splits named on the
+    command line (default val and test)
+    """
+    splits = sys.argv[1:] or ["val", "test"]
+    for split_name in splits:
+        assert split_name in SPLIT_DIRS, \
+            f"Split must be one of {list(SPLIT_DIRS)}, got {split_name}"
+    with instrument.run("extract_clip_embeds"):
+        for split_name in splits:
+            with instrument.stage(split_name):
+                extract(split_name)
+
+if __name__ == "__main__":
+    main()
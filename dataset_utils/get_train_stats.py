@@ -13,10 +13,10 @@ find them in settings.py.
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
-from torchvision import datasets, transforms
+from torchvision import transforms
 from settings import IMG_HEIGHT, IMG_WIDTH, TRAIN_DIR
-
-print('RUNNING')
+from manifest import load_manifest, ManifestDataset, decode_size
+import instrument
 
 NUM_CLASSES = 2
 BATCH_SIZE = 512
@@ -28,40 +28,53 @@ data_transforms = transforms.Compose([
     transforms.ToTensor()
 ])
 
-train_loader = DataLoader(datasets.ImageFolder(TRAIN_DIR, transform=data_transforms),
-                        batch_size=BATCH_SIZE, shuffle=False)
+def main():
+    """
+    Print the mean and stdev of
+    each color channel in TRAIN_DIR
+    """
+    print('RUNNING')
+    train_loader = DataLoader(ManifestDataset(load_manifest(TRAIN_DIR), transform=data_transforms,
+                                             draft_size=decode_size()),
+                            batch_size=BATCH_SIZE, shuffle=False)
+
+    with instrument.run("get_train_stats"):
+        # calculate the means
+        with instrument.stage("means", items=len(train_loader.dataset)):
+            red_sum, green_sum,blue_sum, rgb_sum, pixel_count = 0,0,0,0,0
+            for i, (images, _) in enumerate(instrument.timed_iter(train_loader)):
+                red_sum += torch.sum(images[:,0]).item()
+                green_sum += torch.sum(images[:,1]).item()
+                blue_sum += torch.sum(images[:,2]).item()
+                pixel_count += (AREA * images.size(0))
 
-# calculate the means
-red_sum, green_sum,blue_sum, rgb_sum, pixel_count = 0,0,0,0,0
-for i, (images, _) in enumerate(train_loader):
-    red_sum += torch.sum(images[:,0]).item()
-    green_sum += torch.sum(images[:,1]).item()
-    blue_sum += torch.sum(images[:,2]).item()
-    pixel_count += (AREA * images.size(0))
+            rgb_sum += (red_sum + green_sum + blue_sum)
 
-rgb_sum += (red_sum + green_sum + blue_sum)
+            red_mean = red_sum / pixel_count
+            green_mean = green_sum / pixel_count
+            blue_mean = blue_sum / pixel_count
 
-red_mean = red_sum / pixel_count
-green_mean = green_sum / pixel_count
-blue_mean = blue_sum / pixel_count
+        print('Means: ')
+        print('red_mean: ', red_mean)
+        print('green_mean: ', green_mean)
+        print('blue_mean: ', blue_mean)
 
-print('Means: ')
-print('red_mean: ', red_mean)
-print('green_mean: ', green_mean)
-print('blue_mean: ', blue_mean)
+        # calculate the stdevs
+        with instrument.stage("stdevs", items=len(train_loader.dataset)):
+            red_res, green_res, blue_res = 0,0,0
+            for i, (images, _) in enumerate(instrument.timed_iter(train_loader)):
+                red_res += torch.sum(torch.square(images[:,0] - red_mean)).item()
+                green_res += torch.sum(torch.square(images[:,1] - green_mean)).item()
+                blue_res += torch.sum(torch.square(images[:,2] - blue_mean)).item()
 
-# calculate the stdevs
-red_res, green_res, blue_res = 0,0,0
-for i, (images, _) in enumerate(train_loader):
-    red_res += torch.sum(torch.square(images[:,0] - red_mean)).item()
-    green_res += torch.sum(torch.square(images[:,1] - green_mean)).item()
-    blue_res += torch.sum(torch.square(images[:,2] - blue_mean)).item()
+            red_stdev = np.sqrt(red_res / pixel_count)
+            green_stdev = np.sqrt(green_res / pixel_count)
+            blue_stdev = np.sqrt(blue_res / pixel_count)
 
-red_stdev = np.sqrt(red_res / pixel_count)
-green_stdev = np.sqrt(green_res / pixel_count)
-blue_stdev = np.sqrt(blue_res / pixel_count)
+        print('stdevs: ')
+        print('red_stdev: ', red_stdev)
+        print('green_stdev: ', green_stdev)
+        print('blue_stdev: ', blue_stdev)
 
-print('stdevs: ')
-print('red_stdev: ', red_stdev)
-print('green_stdev: ', green_stdev)
-print('blue_stdev: ', blue_stdev)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Compressed storage for CLIP embeddings.
+A float32 embedding of every CelebA image is
+~400 MB, so embeddings can instead be kept as:
+
+    "float16": half precision, 2x smaller
+    "int8":    per-dimension scalar quantization, 4x smaller
+    "pq":      product quantization, PQ_SUBSPACES bytes
+               per image (64x smaller by default)
+
+compress(embeds, codec) returns an object
+holding the codes that computes linear SVM
+decision scores and nearest neighbors
+directly from them, a block of rows at a
+time, so the full float32 matrix is never
+rebuilt. "float32" wraps the embeddings
+as-is behind the same interface.
+
+report() compares each codec against float32
+on the memory used and on how well the top-k
+decision scores and nearest neighbors agree.
+"""
+
+import time
+import numpy as np
+
+CODECS = ["float32", "float16", "int8", "pq"]
+BLOCK_ROWS = 65536 # rows decoded at a time when scoring
+PQ_SUBSPACES = 64 # bytes per image with "pq", must divide the embedding dim
+PQ_CENTROIDS = 256 # centroids per subspace, so each code fits in a uint8
+PQ_TRAIN_ROWS = 50000 # rows sampled to fit the centroids
+SEED = 0
+
+class FloatCodes:
+
+    """
+    Embeddings stored as floats (float32 or
+    float16). Scored in float32 a block at a time.
+    """
+
+    def __init__(self, embeds, dtype):
+        self.codes = np.ascontiguousarray(embeds, dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the codes
+        """
+        return self.codes.nbytes
+
+    def decode(self, start:int, end:int) -> np.ndarray:
+        """
+        float32 embeddings of rows start:end
+        """
+        return self.codes[start:end].astype(np.float32, copy=False)
+
+    def decision_scores(self, coef, intercept:float) -> np.ndarray:
+        """
+        coef . x + intercept for every embedding x
+        """
+        coef = np.asarray(coef, dtype=np.float32)
+        return np.concatenate([self.decode(start, start + BLOCK_ROWS) @ coef + intercept \
+                               for start in range(0, len(self), BLOCK_ROWS)])
+
+    def sq_distances(self, queries, start:int, end:int) -> np.ndarray:
+        """
+        Squared distance from each query to
+        each embedding in rows start:end,
+        shape (num_queries, end - start)
+        """
+        block = self.decode(start, end)
+        return (queries ** 2).sum(1)[:, None] - 2 * queries @ block.T + \
+            (block ** 2).sum(1)[None, :]
+
+    def nearest(self, queries) -> np.ndarray:
+        """
+        Index of the nearest embedding
+        to each query point
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        best_dist = np.full(len(queries), np.inf, dtype=np.float32)
+        best_idx = np.zeros(len(queries), dtype=np.int64)
+        for start in range(0, len(self), BLOCK_ROWS):
+            dists = self.sq_distances(queries, start, min(start + BLOCK_ROWS, len(self)))
+            block_idx = dists.argmin(1)
+            block_dist = dists[np.arange(len(queries)), block_idx]
+            better = block_dist < best_dist
+            best_dist[better] = block_dist[better]
+            best_idx[better] = start + block_idx[better]
+        return best_idx
+
+class Int8Codes(FloatCodes):
+
+    """
+    Per-dimension scalar quantization: each
+    value is mapped linearly from its
+    dimension's [min, max] onto the 256 int8
+    levels. Since x = (code + 128) * scale + low,
+    coef . x = code . (scale * coef) + const,
+    so scores only need the int8 codes.
+    """
+
+    def __init__(self, embeds): # pylint:disable=super-init-not-called
+        embeds = np.asarray(embeds, dtype=np.float32)
+        self.low = embeds.min(0)
+        self.scale = np.maximum(embeds.max(0) - self.low, 1e-12) / 255
+        self.codes = np.empty(embeds.shape, dtype=np.int8)
+        for start in range(0, len(embeds), BLOCK_ROWS):
+            block = embeds[start:start+BLOCK_ROWS]
+            self.codes[start:start+BLOCK_ROWS] = \
+                np.rint((block - self.low) / self.scale - 128).clip(-128, 127)
+        # Squared norm of each decoded row, for distances
+        self.sq_norms = np.concatenate([(self.decode(start, start + BLOCK_ROWS) ** 2).sum(1) \
+                                        for start in range(0, len(self), BLOCK_ROWS)])
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.low.nbytes + self.scale.nbytes + self.sq_norms.nbytes
+
+    def decode(self, start:int, end:int) -> np.ndarray:
+        return (self.codes[start:end].astype(np.float32) + 128) * self.scale + self.low
+
+    def decision_scores(self, coef, intercept:float) -> np.ndarray:
+        coef = np.asarray(coef, dtype=np.float32)
+        scaled_coef = self.scale * coef
+        const = float(128 * scaled_coef.sum() + self.low @ coef + intercept)
+        return np.concatenate([self.codes[start:start+BLOCK_ROWS].astype(np.float32) @ scaled_coef \
+                               for start in range(0, len(self), BLOCK_ROWS)]) + const
+
+    def sq_distances(self, queries, start:int, end:int) -> np.ndarray:
+        # |q - x|^2 = |q|^2 - 2 q.x + |x|^2, with q.x
+        # computed on the codes like a decision score
+        scaled_q = queries * self.scale
+        q_dot_x = self.codes[start:end].astype(np.float32) @ scaled_q.T + \
+            (128 * scaled_q.sum(1) + queries @ self.low)[None, :]
+        return (queries ** 2).sum(1)[:, None] - 2 * q_dot_x.T + self.sq_norms[None, start:end]
+
+class PQCodes(FloatCodes):
+
+    """
+    Product quantization: each embedding is split
+    into PQ_SUBSPACES chunks, and each chunk is
+    stored as the index of its nearest of
+    PQ_CENTROIDS k-means centroids. Dot products
+    and distances are sums of per-chunk lookup
+    tables, so the codes are never decoded.
+    """
+
+    def __init__(self, embeds, num_subspaces:int=PQ_SUBSPACES): # pylint:disable=super-init-not-called
+        from sklearn.cluster import KMeans # pylint:disable=import-outside-toplevel
+        embeds = np.asarray(embeds, dtype=np.float32)
+        num_rows, dim = embeds.shape
+        assert dim % num_subspaces == 0, \
+            f"PQ_SUBSPACES ({num_subspaces}) must divide the embedding dim ({dim})"
+        self.sub_dim = dim // num_subspaces
+        rng = np.random.default_rng(SEED)
+        train = embeds[rng.choice(num_rows, min(num_rows, PQ_TRAIN_ROWS), replace=False)]
+        num_centroids = min(PQ_CENTROIDS, len(train))
+        # (num_subspaces, num_centroids, sub_dim)
+        self.centroids = np.stack([
+            KMeans(n_clusters=num_centroids, n_init=1, random_state=SEED)
+            .fit(train[:, sub*self.sub_dim:(sub+1)*self.sub_dim]).cluster_centers_
+            for sub in range(num_subspaces)]).astype(np.float32)
+        centroid_sq_norms = (self.centroids ** 2).sum(-1)
+        self.codes = np.empty((num_rows, num_subspaces), dtype=np.uint8)
+        for start in range(0, num_rows, BLOCK_ROWS):
+            block = embeds[start:start+BLOCK_ROWS]
+            for sub in range(num_subspaces):
+                chunk = block[:, sub*self.sub_dim:(sub+1)*self.sub_dim]
+                # |x - c|^2 without the |x|^2 term, which doesn't change the argmin
+                dists = centroid_sq_norms[sub][None, :] - 2 * chunk @ self.centroids[sub].T
+                self.codes[start:start+BLOCK_ROWS, sub] = dists.argmin(1)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.centroids.nbytes
+
+    def decode(self, start:int, end:int) -> np.ndarray:
+        codes = self.codes[start:end]
+        return self.centroids[np.arange(codes.shape[1])[None, :], codes].reshape(len(codes), -1)
+
+    def _lookup(self, tables, start:int, end:int) -> np.ndarray:
+        """
+        Sum over subspaces of tables[..., sub, code]
+        for the codes of rows start:end, with tables
+        of shape (..., num_subspaces, num_centroids).
+        Returns shape (..., end - start).
+        """
+        codes = self.codes[start:end]
+        out = np.zeros(tables.shape[:-2] + (len(codes),), dtype=np.float32)
+        for sub in range(codes.shape[1]):
+            out += tables[..., sub, codes[:, sub]]
+        return out
+
+    def decision_scores(self, coef, intercept:float) -> np.ndarray:
+        coef = np.asarray(coef, dtype=np.float32).reshape(-1, self.sub_dim)
+        tables = np.einsum('scd,sd->sc', self.centroids, coef)
+        return np.concatenate([self._lookup(tables, start, start + BLOCK_ROWS) \
+                               for start in range(0, len(self), BLOCK_ROWS)]) + intercept
+
+    def sq_distances(self, queries, start:int, end:int) -> np.ndarray:
+        # Asymmetric distance: the queries aren't
+        # quantized, only the stored embeddings
+        chunks = queries.reshape(len(queries), -1, self.sub_dim)
+        tables = (chunks ** 2).sum(-1)[:, :, None] + (self.centroids ** 2).sum(-1)[None] - \
+            2 * np.einsum('qsd,scd->qsc', chunks, self.centroids)
+        return self._lookup(tables, start, end)
+
+def compress(embeds, codec:str):
+    """
+    Store embeds with the given codec
+    (one of CODECS)
+    """
+    assert codec in CODECS, f"Unknown codec {codec}, expected one of {CODECS}"
+    if codec == "float32":
+        return FloatCodes(embeds, np.float32)
+    if codec == "float16":
+        return FloatCodes(embeds, np.float16)
+    if codec == "int8":
+        return Int8Codes(embeds)
+    return PQCodes(embeds)
+
+def spearman(a, b) -> float:
+    """
+    Spearman rank correlation of a and b
+    """
+    rank_a = np.argsort(np.argsort(a)).astype(np.float64)
+    rank_b = np.argsort(np.argsort(b)).astype(np.float64)
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+def report(embeds, coef, intercept:float, queries, k:int, codecs=CODECS) -> list[dict]:
+    """
+    Compress embeds with each codec and print
+    how much memory it saves and how closely its
+    results match float32: the overlap of the k
+    lowest and k highest decision scores, the
+    rank correlation of all the scores, and how
+    often the nearest neighbor of each query
+    point is the same image.
+    """
+    exact = compress(embeds, "float32")
+    exact_scores = exact.decision_scores(coef, intercept)
+    exact_order = np.argsort(exact_scores)
+    exact_nn = exact.nearest(queries)
+    rows = []
+    for codec in codecs:
+        start = time.perf_counter()
+        codes = compress(embeds, codec)
+        compress_s = time.perf_counter() - start
+        start = time.perf_counter()
+        scores = codes.decision_scores(coef, intercept)
+        score_s = time.perf_counter() - start
+        order = np.argsort(scores)
+        start = time.perf_counter()
+        nn = codes.nearest(queries)
+        nn_s = time.perf_counter() - start
+        rows.append({
+            "codec": codec, "mb": codes.nbytes / 2**20,
+            "saved": 1 - codes.nbytes / exact.nbytes,
+            "bottom_k_overlap": len(np.intersect1d(order[:k], exact_order[:k])) / k,
+            "top_k_overlap": len(np.intersect1d(order[-k:], exact_order[-k:])) / k,
+            "spearman": spearman(scores, exact_scores),
+            "nn_agreement": float((nn == exact_nn).mean()),
+            "compress_s": compress_s, "score_s": score_s, "nn_s": nn_s})
+
+    print(f"{len(embeds)} embeddings, k = {k}, {len(queries)} nearest-neighbor queries")
+    print("| Codec | MB | Saved | Bottom-k overlap | Top-k overlap | Spearman | NN agreement " +\
+          "| Score s | NN s |")
+    print("| --- | --- | --- | --- | --- | --- | --- | --- | --- |")
+    for row in rows:
+        print(f"| {row['codec']} | {row['mb']:.1f} | {row['saved']:.0%} " +\
+              f"| {row['bottom_k_overlap']:.3f} | {row['top_k_overlap']:.3f} " +\
+              f"| {row['spearman']:.4f} | {row['nn_agreement']:.3f} " +\
+              f"| {row['score_s']:.3f} | {row['nn_s']:.3f} |")
+    return rows
@@ -35,147 +35,77 @@ how well it captures the smiling failure
 direction (not as well).
 """
 
-import os
 import numpy as np
-from torch.utils.data import DataLoader
-from torch import nn
-import torchvision
-from torchvision import datasets, transforms
-import torch
-import clip
-import matplotlib.pyplot as plt
-from PIL import Image
-from sklearn import svm
-from sklearn.mixture import GaussianMixture
-from sklearn.cluster import KMeans, AgglomerativeClustering, DBSCAN
 from settings import *
-
-print('Initializing Models')
+from model_registry import encode_images, classify_images
+from manifest import load_manifest
+from embed_codes import compress, report
+from text_prompts import describe
+from report import Report
+import instrument
 
 # Misc vars
-SHOW_IMGS = False
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+REPORT_PATHS = False # add a montage of the images along each path to the HTML report
 MODES = ['old'] # ["old", "young"]
-BATCH_SIZE = 512
-OUT_FEATS = 2
+BATCH_SIZE = None # None to use each model's tuned batch size (batch_tuner.py)
 NUM_CLUSTS = 4 # number of subgroups on each side of the dividing hyperplane
 NUM_IMGS = 200 # max number of images to include in animate
+DESCRIBE_DIRECTIONS = True # label the SVM direction and each cluster with text prompts
+CODEC_REPORT = False # compare every embedding codec against float32 on this mode's SVM
+REPORT_K = 100
 
-# Custom model
-custom_model = torchvision.models.resnet18()
-custom_model.fc = nn.Linear(in_features=512, out_features=OUT_FEATS, bias=True)
-custom_model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE))
-custom_model.to(DEVICE)
-
-img_size = (IMG_WIDTH, IMG_HEIGHT)
-assert img_size == (75, 75), "Images must be 75x75"
-MEANS = TRAIN_MEANS_1_CORR if NUM_CORRS == 1 else TRAIN_MEANS_2_CORR
-STDEVS = TRAIN_STDEVS_1_CORR if NUM_CORRS == 1 else TRAIN_STDEVS_2_CORR
-data_transforms = transforms.Compose([
-    transforms.Resize(img_size),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=list(MEANS.values()), std=list(STDEVS.values()))
-])
-
-# Loaders
-val_loader_no_trans = DataLoader(datasets.ImageFolder(VAL_DIR), batch_size=1)
-NUM_VAL_IMGS = len(val_loader_no_trans)
-test_loader_no_trans = DataLoader(datasets.ImageFolder(TEST_DIR), batch_size=1)
-
-# CLIP
-EMBEDDING_DIM = 512
-clip_model, clip_preprocess = clip.load("ViT-B/32", device=DEVICE)
-
-svms = []
-
-for mode in MODES:
+def get_correctness(mode:str):
+    """
+    Whether the age classifier is correct
+    on each val image in class mode.
+    """
+    manifest = load_manifest(VAL_DIR)
+    idxs = manifest.class_idxs(mode)
+    with instrument.stage("classify", items=len(idxs)):
+        logits = classify_images(manifest.paths[idxs].tolist(), BATCH_SIZE)
+    preds = np.argmax(logits, axis=1)
+    return (preds == manifest.labels[idxs]).astype(np.int8)
 
-    current_class_num = 1 if mode == 'young' else 0
-    paths = [tup[0] for tup in val_loader_no_trans.dataset.samples \
-                if tup[1] == current_class_num]
-    num_imgs_this_class = len(paths)
-
-    cur_class_val_dir = os.path.join(VAL_DIR, mode) # ex: val/old
-    cur_class_val_data = datasets.ImageFolder(cur_class_val_dir, transform=data_transforms)
-    cur_class_val_loader = DataLoader(cur_class_val_data, batch_size=BATCH_SIZE)
-
-    # Age Classifier Correctness
-    print("Getting correctness for class ", mode)
-    correctness = torch.empty(num_imgs_this_class, device=DEVICE, dtype=torch.int8)
-    with torch.no_grad():
-        for i, (images, labels) in enumerate(cur_class_val_loader):
-            start_i = i * BATCH_SIZE
-            end_i = start_i + labels.size()[0]
-            images = images.to(DEVICE)
-            labels = labels.to(DEVICE)
-            out = custom_model(images)
-            preds = torch.argmax(out, dim=1)
-            corr = preds == labels
-            correctness[start_i:end_i] = corr
-
-    # CLIP
-    print("Getting clip embeds for class ", mode)
-    with torch.no_grad():
-        clip_model.eval()
-        pil_images = []
-        for path in paths:
-            pil_images.append(clip_preprocess(Image.open(path)))
-        image_input = torch.tensor(np.stack(pil_images), device=DEVICE)
-        clip_embeds = torch.empty((num_imgs_this_class, EMBEDDING_DIM), device=DEVICE)
-        for start_i in range(0, num_imgs_this_class, BATCH_SIZE):
-            end_i = start_i + BATCH_SIZE if start_i + BATCH_SIZE < num_imgs_this_class \
-                else num_imgs_this_class
-            clip_embeds[start_i:end_i] = clip_model.encode_image(image_input[start_i:end_i]).float()
-
-    # Train SVM
-    svm_classifier = svm.SVC(kernel='linear')
-    svm_classifier.fit(clip_embeds, correctness)
-    svms.append(svm_classifier)
-
-    # Find CLIP embeddings above/below
-    # decision boundary
-    ds_values = np.dot(svm_classifier.coef_[0], \
-            clip_embeds.cpu().numpy().transpose()) + \
-                svm_classifier.intercept_[0]
-    easy_idxs = np.where(ds_values >= 0)[0]
-    diff_idxs = np.where(ds_values < 0)[0]
-    easy_gm = GaussianMixture(n_components=NUM_CLUSTS, random_state=0).fit(clip_embeds[easy_idxs])
-    diff_gm = GaussianMixture(n_components=NUM_CLUSTS, random_state=0).fit(clip_embeds[diff_idxs])
-
-    # Loop over each combination of easy-diff centers
+def find_paths(clip_embeds, easy_gm, diff_gm):
+    """
+    For each combination of easy-diff cluster
+    centers, walk a straight line between the
+    centers and find the image closest to each
+    point along the way. clip_embeds can be an
+    array or compressed codes from embed_codes.
+    """
+    codes = clip_embeds if hasattr(clip_embeds, 'nearest') else compress(clip_embeds, "float32")
     anim_paths = {}
     for easy_i in range(NUM_CLUSTS):
         for diff_i in range(NUM_CLUSTS):
             cur_key = f"{easy_i}-{diff_i}"
-            anim_paths[cur_key] = []
             start_pt = easy_gm.means_[easy_i]
             end_pt = diff_gm.means_[diff_i]
             embed_path = np.linspace(start_pt, end_pt, num=NUM_IMGS)
-            for cur_pt in embed_path:
-                # find the img with closest embedding to cur_pt
-                min_dist = np.inf
-                best_idx = None
-                for idx, embed in enumerate(clip_embeds.cpu().numpy()):
-                    dist = np.linalg.norm(cur_pt - embed)
-                    if dist < min_dist:
-                        min_dist = dist
-                        best_idx = idx
-                anim_paths[cur_key].append(best_idx)
-            anim_paths[cur_key] = list(set(anim_paths[cur_key])) # remove non-unique path names
-
-    # Show imgs
-    if SHOW_IMGS:
-        for key, lis in anim_paths.items():
-            for img_idx in lis:
-                pil_img = Image.open(paths[img_idx])
-                plt.imshow(np.asarray(pil_img))
-                plt.title(f"{mode} {key} {paths[img_idx]}")
-                plt.show()
-
-
-    # Create NUM_CLUST clusters
-    # on the entire CLIP space,
-    # then compare by hard vs. easy
+            # find the img with closest embedding to each point
+            best_idxs = codes.nearest(embed_path)
+            # remove non-unique path names, keeping the order along the path
+            anim_paths[cur_key] = list(dict.fromkeys(best_idxs.tolist()))
+    return anim_paths
+
+def report_paths(html_report:Report, anim_paths, paths, mode):
+    """
+    Add a montage of the images
+    along each path to html_report
+    """
+    for key, lis in anim_paths.items():
+        html_report.add_montage(f"{mode} path {key} ({len(lis)} images)",
+                           [paths[img_idx] for img_idx in lis])
+
+def score_clusters(mode, subgroups, clip_embeds, svm_classifier):
+    """
+    Create NUM_CLUST clusters
+    on the entire CLIP space,
+    then compare by hard vs. easy.
+    subgroups holds each image's subgroup
+    name, ex: "old_female_smile"
+    """
+    from sklearn.mixture import GaussianMixture # pylint:disable=import-outside-toplevel
     # def test_acc(model, mode_desc):
     model = GaussianMixture(n_components=NUM_CLUSTS, random_state=0)
     mode_desc = 'Gaussian Mix'
@@ -185,9 +115,9 @@ for mode in MODES:
                         f'{mode}_male_no_smile': 0,
                         f'{mode}_male_smile': 0} 
                         for cluster in range(NUM_CLUSTS)}
-    for i, path in enumerate(paths):
-        sex = 'female' if 'female' in path else 'male'
-        smile = 'no_smile' if 'no_smile' in path else 'smile'
+    for i, subgroup in enumerate(subgroups):
+        sex = 'female' if 'female' in subgroup else 'male'
+        smile = 'no_smile' if 'no_smile' in subgroup else 'smile'
         cluster = full_clusters[i]
         key = f'{mode}_{"_".join([sex,smile])}'
         full_res[cluster][key] = full_res[cluster][key] + 1
@@ -251,3 +181,97 @@ for mode in MODES:
     # test_acc(KMeans(n_clusters = NUM_CLUSTS,  random_state = 0), 'KMeans')
     # test_acc(AgglomerativeClustering(n_clusters = NUM_CLUSTS), 'Graphical Clustering')
     # test_acc(DBSCAN(eps=0.8, min_samples=50), 'DBSCAN' )
+
+def run_mode(mode:str, html_report:Report):
+    """
+    Fit the SVM and GMMs for class
+    mode, then score the clusters
+    and the paths between them.
+    """
+    # pylint:disable=import-outside-toplevel
+    from sklearn import svm
+    from sklearn.mixture import GaussianMixture
+
+    with instrument.stage("list_paths"):
+        manifest = load_manifest(VAL_DIR)
+        idxs = manifest.class_idxs(mode)
+        paths = manifest.paths[idxs].tolist()
+
+    # Age Classifier Correctness
+    print("Getting correctness for class ", mode)
+    correctness = get_correctness(mode)
+
+    # CLIP
+    print("Getting clip embeds for class ", mode)
+    with instrument.stage("clip_embeds", items=len(paths)):
+        clip_embeds = encode_images(paths, BATCH_SIZE)
+
+    # Train SVM
+    with instrument.stage("svm_fit", items=len(paths)):
+        svm_classifier = svm.SVC(kernel='linear')
+        svm_classifier.fit(clip_embeds, correctness)
+
+    # Scoring and the path search below run
+    # on the embeddings stored as EMBED_CODEC
+    with instrument.stage("compress", items=len(paths)):
+        codes = compress(clip_embeds, EMBED_CODEC)
+
+    # Find CLIP embeddings above/below
+    # decision boundary
+    with instrument.stage("gmm_fit", items=len(paths)):
+        ds_values = codes.decision_scores(svm_classifier.coef_[0], svm_classifier.intercept_[0])
+        easy_idxs = np.where(ds_values >= 0)[0]
+        diff_idxs = np.where(ds_values < 0)[0]
+        easy_gm = GaussianMixture(n_components=NUM_CLUSTS, random_state=0).fit(clip_embeds[easy_idxs])
+        diff_gm = GaussianMixture(n_components=NUM_CLUSTS, random_state=0).fit(clip_embeds[diff_idxs])
+
+    if DESCRIBE_DIRECTIONS:
+        with instrument.stage("describe"):
+            coef = svm_classifier.coef_[0]
+            # Clusters are described by how their mean
+            # differs from the mean of every image
+            center = clip_embeds.mean(0)
+            names = ["SVM failure direction", "SVM correct direction",
+                     *[f"easy cluster {i}" for i in range(NUM_CLUSTS)],
+                     *[f"diff cluster {i}" for i in range(NUM_CLUSTS)]]
+            describe(names, np.concatenate([[-coef, coef], easy_gm.means_ - center,
+                                            diff_gm.means_ - center]))
+
+    if CODEC_REPORT:
+        path_pts = np.concatenate([np.linspace(start_pt, end_pt, num=NUM_IMGS) \
+                                   for start_pt in easy_gm.means_ for end_pt in diff_gm.means_])
+        report(clip_embeds, svm_classifier.coef_[0], float(svm_classifier.intercept_[0]),
+               path_pts, REPORT_K)
+
+    with instrument.stage("score_clusters", items=len(paths)):
+        score_clusters(mode, manifest.subgroup_keys(idxs), clip_embeds, svm_classifier)
+
+    # Everything left only needs the codes, so
+    # don't hold the float32 embeddings alongside them
+    del clip_embeds
+
+    # Loop over each combination of easy-diff centers
+    with instrument.stage("find_paths", items=NUM_CLUSTS * NUM_CLUSTS * NUM_IMGS):
+        anim_paths = find_paths(codes, easy_gm, diff_gm)
+
+    if REPORT_PATHS:
+        report_paths(html_report, anim_paths, paths, mode)
+    return svm_classifier
+
+def main():
+    """
+    Run the experiment for each class in MODES
+    """
+    with instrument.run("gmm"):
+        svms = []
+        html_report = Report("gmm")
+        for mode in MODES:
+            with instrument.stage(mode):
+                svms.append(run_mode(mode, html_report))
+        if html_report.figs:
+            with instrument.stage("report", items=len(html_report.figs)):
+                html_report.write()
+    return svms
+
+if __name__ == "__main__":
+    main()
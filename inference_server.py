@@ -0,0 +1,341 @@
+"""
+Long-lived local inference server that keeps
+CLIP and the age classifier at MODEL_PATH
+loaded (and warmed up) in memory, so repeated
+runs of top_k.py/gmm.py don't each pay to load
+the models before doing any work.
+
+The server listens on a unix socket in a
+private per-user directory ($XDG_RUNTIME_DIR,
+or a 0700 directory in the temp dir) unless
+INFERENCE_SOCKET is set, and accepts requests
+for CLIP embeddings, classifier logits, or SVM
+decision scores for a list of image paths.
+Clients must prove they know the authkey saved
+in that directory before anything is unpickled,
+and only use the server if it loaded the same
+models (and weights) as their own settings.
+Requests that arrive close together are
+micro-batched into a single model forward
+pass. Start it in its own terminal with:
+    python3 inference_server.py
+
+The functions in model_registry.py send
+their work here when the server is running
+(and USE_INFERENCE_SERVER is set), and fall
+back to loading the models in-process otherwise.
+"""
+
+import os
+import stat
+import time
+import queue
+import secrets
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from settings import INFERENCE_SOCKET, USE_INFERENCE_SERVER, MODEL_PATH, INFERENCE_MODE, CLIP_VIS, \
+    FAST_DECODE, NUM_CORRS, IMG_WIDTH, IMG_HEIGHT
+
+MAX_BATCH = 512 # max images per micro-batch
+MAX_WAIT_MS = 10 # how long to wait for more requests before running a micro-batch
+OPS = ("embed", "logits", "decision_scores")
+AUTHKEY_BYTES = 32
+
+def runtime_dir() -> str:
+    """
+    This user's private directory for the
+    socket and authkey. Raises RuntimeError
+    if it exists but others can access it.
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    dirn = os.path.join(base, f"spring23-{os.getuid()}")
+    os.makedirs(dirn, mode=0o700, exist_ok=True)
+    dir_stat = os.lstat(dirn)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or \
+            dir_stat.st_mode & 0o077:
+        raise RuntimeError(f"{dirn} must be a directory that only you can access")
+    return dirn
+
+def socket_path() -> str:
+    """
+    The unix socket the server listens on
+    """
+    return INFERENCE_SOCKET or os.path.join(runtime_dir(), "inference.sock")
+
+def _authkey_path() -> str:
+    return os.path.join(runtime_dir(), "authkey")
+
+def _read_authkey():
+    """
+    The server's authkey, or None
+    if no server has made one
+    """
+    try:
+        with open(_authkey_path(), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _create_authkey() -> bytes:
+    """
+    Make the authkey (readable only by this
+    user) if there isn't one yet, and return it
+    """
+    authkey = _read_authkey()
+    if authkey is None:
+        authkey = secrets.token_bytes(AUTHKEY_BYTES)
+        fd = os.open(_authkey_path(), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(authkey)
+    return authkey
+
+def model_config() -> dict:
+    """
+    The models this process's settings load,
+    when their weights were last saved, and
+    how images are preprocessed for them
+    (decode size, input size, and NUM_CORRS,
+    which picks the normalization stats). A
+    client only uses the server if the server's
+    (from when it loaded them) matches its own.
+    """
+    from model_registry import artifact_path # pylint:disable=import-outside-toplevel
+    weights = [MODEL_PATH]
+    if INFERENCE_MODE != "eager":
+        weights.append(artifact_path(MODEL_PATH, INFERENCE_MODE))
+    return {"model_path": os.path.abspath(MODEL_PATH), "inference_mode": INFERENCE_MODE,
+            "clip_vis": CLIP_VIS, "fast_decode": FAST_DECODE, "num_corrs": NUM_CORRS,
+            "img_size": [IMG_WIDTH, IMG_HEIGHT],
+            "weights_mtimes": [os.path.getmtime(path) if os.path.exists(path) else None \
+                               for path in weights]}
+
+class _Pending:
+
+    """
+    A single request waiting on
+    the micro-batching thread
+    """
+
+    def __init__(self, op:str, paths:list[str], coef=None, intercept=None):
+        self.op = op
+        self.paths = paths
+        self.coef = coef
+        self.intercept = intercept
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+def _run_batch(batch:list[_Pending], batch_size:int):
+    """
+    Run one forward pass per model over
+    every request in the batch, then hand
+    each request its slice of the output.
+    """
+    # pylint:disable=import-outside-toplevel
+    from model_registry import encode_images_local, classify_images_local
+    embed_reqs = [req for req in batch if req.op in ("embed", "decision_scores")]
+    logit_reqs = [req for req in batch if req.op == "logits"]
+    for reqs, run_model in ((embed_reqs, encode_images_local),
+                            (logit_reqs, classify_images_local)):
+        if not reqs:
+            continue
+        try:
+            out = run_model([path for req in reqs for path in req.paths], batch_size)
+        except Exception as err: # pylint:disable=broad-except
+            # Send the error back rather than killing the server
+            for req in reqs:
+                req.error = repr(err)
+                req.done.set()
+            continue
+        start_i = 0
+        for req in reqs:
+            end_i = start_i + len(req.paths)
+            req.result = out[start_i:end_i]
+            if req.op == "decision_scores":
+                req.result = np.dot(req.result, req.coef) + req.intercept
+            start_i = end_i
+            req.done.set()
+
+def _batcher(requests:queue.Queue):
+    """
+    Collect requests until MAX_BATCH images
+    are waiting or MAX_WAIT_MS has passed
+    since the first one, then run them.
+    """
+    while True:
+        batch = [requests.get()]
+        num_paths = len(batch[0].paths)
+        deadline = time.monotonic() + MAX_WAIT_MS / 1000
+        while num_paths < MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                req = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(req)
+            num_paths += len(req.paths)
+        _run_batch(batch, None) # each model uses its tuned batch size
+
+def _serve_connection(conn, requests:queue.Queue, config:dict):
+    """
+    Handle every request sent over a single
+    client connection until it is closed.
+    Requests are dicts with an "op" in OPS,
+    a list of "paths", and for decision_scores
+    the SVM's "coef" and "intercept". "ping"
+    returns the server's model_config.
+    """
+    with conn:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                break
+            if msg.get("op") == "ping":
+                conn.send({"ok": True, "result": {"config": config}})
+                continue
+            if msg.get("op") not in OPS:
+                conn.send({"ok": False, "error": f"Unknown op {msg.get('op')}"})
+                continue
+            req = _Pending(msg["op"], msg["paths"], msg.get("coef"), msg.get("intercept"))
+            requests.put(req)
+            req.done.wait()
+            if req.error is None:
+                conn.send({"ok": True, "result": req.result})
+            else:
+                conn.send({"ok": False, "error": req.error})
+
+def _check_not_running(path:str, authkey:bytes):
+    """
+    Exit if a server already answers on path,
+    else remove the stale socket left there by
+    a server that didn't shut down cleanly
+    """
+    if not os.path.exists(path):
+        return
+    try:
+        Client(path, family="AF_UNIX", authkey=authkey).close()
+    except AuthenticationError as err:
+        raise SystemExit(f"Another server (with a different authkey) is listening on {path}") \
+            from err
+    except OSError:
+        os.remove(path) # nothing listening
+        return
+    raise SystemExit(f"An inference server is already running on {path}")
+
+def serve():
+    """
+    Load and warm up the models,
+    then serve requests until interrupted.
+    """
+    # pylint:disable=import-outside-toplevel
+    from model_registry import get_model, warm_up
+    path = socket_path()
+    authkey = _create_authkey()
+    _check_not_running(path, authkey)
+
+    config = model_config()
+    get_model("resnet")
+    get_model("clip")
+    warm_up()
+
+    requests = queue.Queue()
+    threading.Thread(target=_batcher, args=(requests,), daemon=True).start()
+    old_umask = os.umask(0o177) # so the socket is never accessible to others, even briefly
+    try:
+        listener = Listener(path, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(old_umask)
+    with listener:
+        print(f"Inference server listening on {path}")
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as err:
+                    print(f"Rejected connection: {err!r}")
+                    continue
+                threading.Thread(target=_serve_connection,
+                                 args=(conn, requests, config), daemon=True).start()
+        except KeyboardInterrupt:
+            print("Shutting down inference server")
+
+# (pid, connection) for the current process,
+# so a forked child never reuses its parent's
+_client = (None, None)
+# pid of a process that found the server running
+# other models, so it doesn't ask again
+_mismatched_pid = None
+
+def _get_client():
+    """
+    Connect to the server, reusing the
+    connection within a process. Returns
+    None if the server isn't running, can't
+    be authenticated with, or loaded other
+    models than this process's settings.
+    """
+    global _client, _mismatched_pid # pylint:disable=global-statement
+    if not USE_INFERENCE_SERVER or _mismatched_pid == os.getpid():
+        return None
+    pid, conn = _client
+    if pid == os.getpid() and conn is not None:
+        return conn
+    try:
+        path = socket_path()
+    except RuntimeError as err:
+        print(f"Not using the inference server: {err}")
+        return None
+    authkey = _read_authkey()
+    if authkey is None or not os.path.exists(path):
+        return None
+    try:
+        conn = Client(path, family="AF_UNIX", authkey=authkey)
+        conn.send({"op": "ping"})
+        server_config = conn.recv()["result"]["config"]
+    except (OSError, EOFError, AuthenticationError):
+        return None
+    if server_config != model_config():
+        print("The inference server loaded other models than settings.py " +\
+              f"({server_config} vs {model_config()}), loading them in-process instead. " +\
+              "Restart inference_server.py to use the new models.")
+        conn.close()
+        _mismatched_pid = os.getpid()
+        return None
+    _client = (os.getpid(), conn)
+    return conn
+
+def request_server(op:str, paths:list[str], coef=None, intercept=None):
+    """
+    Ask the server to run op ("embed",
+    "logits", or "decision_scores") on the
+    images at paths. Returns a numpy array,
+    or None if the server isn't running, in
+    which case the caller should run the
+    model in-process instead.
+    """
+    global _client # pylint:disable=global-statement
+    conn = _get_client()
+    if conn is None:
+        return None
+    # The server may have a different working directory
+    msg = {"op": op, "paths": [os.path.abspath(path) for path in paths],
+           "coef": coef, "intercept": intercept}
+    try:
+        conn.send(msg)
+        reply = conn.recv()
+    except (OSError, EOFError):
+        # Server went away mid-request, fall back to in-process
+        _client = (None, None)
+        return None
+    if not reply["ok"]:
+        raise RuntimeError(f"Inference server error: {reply['error']}")
+    return reply["result"]
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,194 @@
+"""
+Lightweight stage-level instrumentation
+shared by the entry points. A script wraps
+its work in run(), and each step in stage():
+
+    with instrument.run("top_k"):
+        with instrument.stage("svm_fit", items=len(paths)):
+            ...
+
+Each stage records its wall and CPU time,
+items/s, and the process's peak RSS. Loops
+over a loader can be wrapped in timed_iter()
+to split the stage's time into waiting on
+data vs computing on it. Stages can be nested,
+and are named by their path, ex: "fit_svm_old/svm_fit".
+
+When the run finishes its stages are written
+to RUNS_DIR as <run>_<timestamp>.json, and
+appended to RUNS_DIR/stages.csv so regressions
+can be compared across runs. Setting
+PROFILE_STAGE in settings.py to a stage's name
+also saves a torch profiler trace for that stage.
+
+Outside of run(), stage() and timed_iter()
+do nothing, so instrumented functions can
+be called from anywhere.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import resource
+import contextlib
+from settings import RUNS_DIR, PROFILE_STAGE
+
+CSV_FIELDS = ["run_id", "stage", "parent", "start_s", "wall_s", "cpu_s",
+              "data_wait_s", "compute_s", "batches", "items", "items_per_s",
+              "peak_rss_mb"]
+
+class _Run:
+
+    """
+    Stage records for the active run
+    """
+
+    def __init__(self, name:str):
+        self.name = name
+        self.run_id = f"{name}_{time.strftime('%Y%m%d-%H%M%S')}"
+        self.start = time.perf_counter()
+        self.records = []
+        self.stack = [] # records of the stages currently open
+
+    def save(self, status:str):
+        """
+        Write this run's JSON log and
+        append its stages to the CSV.
+        """
+        os.makedirs(RUNS_DIR, exist_ok=True)
+        summary = {"run_id": self.run_id, "name": self.name, "status": status,
+                   "argv": sys.argv, "host": socket.gethostname(),
+                   "wall_s": time.perf_counter() - self.start,
+                   "peak_rss_mb": peak_rss_mb(), "stages": self.records}
+        with open(os.path.join(RUNS_DIR, f"{self.run_id}.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        csv_path = os.path.join(RUNS_DIR, "stages.csv")
+        write_header = not os.path.exists(csv_path)
+        with open(csv_path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            if write_header:
+                writer.writeheader()
+            for rec in self.records:
+                writer.writerow({"run_id": self.run_id, **rec})
+        print(f"Saved stage timings to {os.path.join(RUNS_DIR, self.run_id)}.json")
+
+# Set while inside run()
+_run = None
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of this
+    process so far, in MB
+    """
+    # ru_maxrss is in KB on Linux but bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+@contextlib.contextmanager
+def run(name:str):
+    """
+    Record every stage inside this
+    block and save them when it exits.
+    A run inside another run is
+    recorded as a stage of the outer one.
+    """
+    global _run # pylint:disable=global-statement
+    if _run is not None:
+        with stage(name):
+            yield
+        return
+    _run = _Run(name)
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _run.save(status)
+        _run = None
+
+@contextlib.contextmanager
+def stage(name:str, items:int=None):
+    """
+    Time the code inside this block as a
+    stage. Yields the stage's record (or
+    None outside of a run) so the number of
+    items can be filled in once it's known.
+    """
+    if _run is None:
+        yield None
+        return
+    parent = _run.stack[-1]["stage"] if _run.stack else None
+    full_name = f"{parent}/{name}" if parent else name
+    rec = {"stage": full_name, "parent": parent, "items": items,
+           "data_wait_s": 0.0, "compute_s": 0.0, "batches": 0}
+    _run.stack.append(rec)
+    profiler = _start_profiler(full_name)
+    rec["start_s"] = time.perf_counter() - _run.start
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield rec
+    finally:
+        rec["wall_s"] = time.perf_counter() - start_wall
+        rec["cpu_s"] = time.process_time() - start_cpu
+        if profiler is not None:
+            _stop_profiler(profiler, full_name)
+        rec["peak_rss_mb"] = peak_rss_mb()
+        if rec["items"] and rec["wall_s"] > 0:
+            rec["items_per_s"] = rec["items"] / rec["wall_s"]
+        _run.stack.pop()
+        _run.records.append(rec)
+
+def timed_iter(iterable):
+    """
+    Yield from iterable (ex: a DataLoader),
+    adding the time spent waiting for each
+    item to the current stage's data_wait_s
+    and the time spent on it to compute_s.
+    """
+    rec = _run.stack[-1] if _run is not None and _run.stack else None
+    if rec is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        wait_start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        compute_start = time.perf_counter()
+        rec["data_wait_s"] += compute_start - wait_start
+        rec["batches"] += 1
+        yield item
+        rec["compute_s"] += time.perf_counter() - compute_start
+
+def _start_profiler(full_name:str):
+    """
+    Start the torch profiler if this
+    is the stage chosen in PROFILE_STAGE
+    """
+    if PROFILE_STAGE != full_name:
+        return None
+    import torch # pylint:disable=import-outside-toplevel
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+    profiler.__enter__()
+    return profiler
+
+def _stop_profiler(profiler, full_name:str):
+    """
+    Stop the profiler and save a trace
+    viewable in chrome://tracing
+    """
+    profiler.__exit__(None, None, None)
+    os.makedirs(RUNS_DIR, exist_ok=True)
+    trace_path = os.path.join(RUNS_DIR, f"{_run.run_id}_{full_name.replace('/', '-')}.trace.json")
+    profiler.export_chrome_trace(trace_path)
+    print(f"Saved profiler trace to {trace_path}")
@@ -0,0 +1,230 @@
+"""
+A cached listing of every image in a
+data split (ex: data/val_2_corr), so the
+scripts don't each walk the whole nested
+old/female/smile/... tree through
+torchvision's ImageFolder.
+
+load_manifest(data_dir) returns the split's
+image paths (in the same order ImageFolder
+would give them), class labels (0 old,
+1 young), subgroup of each image (ex:
+"old_female_smile", from the directory it's
+in), and CelebA attributes (see
+utils.attr_table). Images with no row in the
+attributes csv are left out, with a warning
+naming them. The first call scans the
+directory and saves the manifest to
+MANIFEST_DIR. Later calls only stat the
+directories that were scanned and the
+attributes csv, and rescan if any of them
+changed (images added, removed, or moved,
+or the attributes edited).
+
+ManifestDataset wraps a manifest for use
+with a torch DataLoader, in place of
+ImageFolder. Images are opened with
+load_image, which can have the JPEG decoder
+skip straight to a smaller size.
+"""
+
+import os
+import numpy as np
+from settings import MANIFEST_DIR, CELEBA_ATTRS_CSV, FAST_DECODE, IMG_WIDTH, IMG_HEIGHT
+from utils import attr_table, attr_rows
+
+# Same extensions torchvision's ImageFolder accepts
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+
+class Manifest:
+
+    """
+    Paths, labels, subgroups, and
+    CelebA attributes of a split
+    """
+
+    def __init__(self, data_dir:str, arrays:dict):
+        self.data_dir = data_dir
+        self.paths = arrays['paths']
+        self.labels = arrays['labels']
+        self.classes = arrays['classes'].tolist()
+        self.subgroups = arrays['subgroups']
+        self.subgroup_names = arrays['subgroup_names'].tolist()
+        self.attrs = arrays['attrs']
+        self.attr_names = arrays['attr_names'].tolist()
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def class_idxs(self, mode:str) -> np.ndarray:
+        """
+        Indices of the images in class
+        mode ("old" or "young")
+        """
+        return np.flatnonzero(self.labels == self.classes.index(mode))
+
+    def attr(self, name:str) -> np.ndarray:
+        """
+        Each image's CelebA attribute
+        name, as 1 (has it) or 0
+        """
+        return (self.attrs[:, self.attr_names.index(name)] == 1).astype(np.int8)
+
+    def subgroup_keys(self, idxs=None) -> np.ndarray:
+        """
+        Each image's subgroup name,
+        ex: "old_female_smile"
+        """
+        subgroups = self.subgroups if idxs is None else self.subgroups[idxs]
+        return np.array(self.subgroup_names)[subgroups]
+
+def manifest_path(data_dir:str) -> str:
+    """
+    Where the manifest of data_dir is saved
+    """
+    name = os.path.normpath(data_dir).strip(os.sep).replace(os.sep, '_')
+    return os.path.join(MANIFEST_DIR, f'{name}.npz')
+
+def scan(data_dir:str) -> dict:
+    """
+    Walk data_dir and build its manifest arrays,
+    along with the mtime of every directory
+    walked and of the attributes csv, so changes
+    to either can be detected
+    """
+    classes = sorted(entry.name for entry in os.scandir(data_dir) if entry.is_dir())
+    paths, labels, subgroups, dirs = [], [], [], [data_dir]
+    subgroup_names = []
+    for class_num, class_name in enumerate(classes):
+        # Sorted the same way as ImageFolder, so
+        # indices match anything saved in that order
+        for root, _, fnames in sorted(os.walk(os.path.join(data_dir, class_name),
+                                              followlinks=True)):
+            dirs.append(root)
+            fnames = [fname for fname in sorted(fnames) if fname.lower().endswith(IMG_EXTENSIONS)]
+            if not fnames:
+                continue
+            subgroup = os.path.relpath(root, data_dir).replace(os.sep, '_') # ex: old_female_smile
+            if subgroup not in subgroup_names:
+                subgroup_names.append(subgroup)
+            paths.extend(os.path.join(root, fname) for fname in fnames)
+            labels.extend([class_num] * len(fnames))
+            subgroups.extend([subgroup_names.index(subgroup)] * len(fnames))
+
+    _, all_attrs, attr_names = attr_table(CELEBA_ATTRS_CSV)
+    rows = attr_rows(paths, missing_ok=True)
+    found = rows >= 0
+    if not found.all():
+        # Skipped, so a stray file doesn't stop the scripts
+        # that list images through the manifest
+        missing = [os.path.relpath(path, data_dir) for path in np.array(paths)[~found]]
+        print(f"WARNING: skipping {len(missing)} images in {data_dir} that aren't in " +\
+              f"{CELEBA_ATTRS_CSV}: {', '.join(missing[:10])}" +\
+              (", ..." if len(missing) > 10 else ""))
+    return {'paths': np.array(paths)[found], 'labels': np.array(labels, dtype=np.int8)[found],
+            'classes': np.array(classes),
+            'subgroups': np.array(subgroups, dtype=np.int16)[found],
+            'subgroup_names': np.array(subgroup_names),
+            'attrs': all_attrs[rows[found]], 'attr_names': np.array(attr_names),
+            'dirs': np.array(dirs),
+            'dir_mtimes': np.array([os.stat(dirn).st_mtime_ns for dirn in dirs], dtype=np.int64),
+            'csv_mtime': np.int64(os.stat(CELEBA_ATTRS_CSV).st_mtime_ns)}
+
+def _is_stale(arrays) -> bool:
+    """
+    Whether any directory the manifest was
+    built from, or the attributes csv its
+    attrs came from, has changed since.
+    Manifests saved before csv_mtime was
+    recorded count as stale.
+    """
+    stat_paths = [*arrays['dirs'], CELEBA_ATTRS_CSV]
+    mtimes = [*arrays['dir_mtimes'], arrays.get('csv_mtime')]
+    for path, mtime in zip(stat_paths, mtimes):
+        try:
+            if mtime is None or os.stat(path).st_mtime_ns != mtime:
+                return True
+        except FileNotFoundError:
+            return True
+    return False
+
+def decode_size():
+    """
+    The draft size to decode classifier inputs
+    at, or None for full size (FAST_DECODE off)
+    """
+    return (IMG_WIDTH, IMG_HEIGHT) if FAST_DECODE else None
+
+def load_image(path:str, draft_size=None):
+    """
+    Open an image as RGB (same as ImageFolder).
+    If draft_size (width, height) is given and the
+    image is a JPEG, the decoder downscales by
+    1/2, 1/4 or 1/8 in the DCT while decoding, to
+    the smallest size that is still at least
+    draft_size, which is much cheaper than
+    decoding at full size and resizing after.
+    """
+    from PIL import Image # pylint:disable=import-outside-toplevel
+    with open(path, 'rb') as f:
+        image = Image.open(f)
+        if draft_size is not None:
+            image.draft('RGB', draft_size) # does nothing for non-JPEGs
+        return image.convert('RGB')
+
+# data_dir -> Manifest, for this process
+_manifests = {}
+
+def load_manifest(data_dir:str) -> Manifest:
+    """
+    The manifest of data_dir, loaded from
+    MANIFEST_DIR unless it's missing or out
+    of date, in which case it's rebuilt.
+    """
+    cached = _manifests.get(data_dir)
+    if cached is not None and not _is_stale(cached[1]):
+        return cached[0]
+    path = manifest_path(data_dir)
+    arrays = None
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            arrays = {key: saved[key] for key in saved.files}
+        if _is_stale(arrays):
+            arrays = None
+    if arrays is None:
+        print(f'Scanning {data_dir} for images')
+        arrays = scan(data_dir)
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+    manifest = Manifest(data_dir, arrays)
+    _manifests[data_dir] = (manifest, {key: arrays[key] \
+                                       for key in ('dirs', 'dir_mtimes', 'csv_mtime')})
+    return manifest
+
+class ManifestDataset:
+
+    """
+    (image, label) pairs for the images in a
+    manifest (or just those at idxs), loaded
+    the same way as ImageFolder (or with a
+    JPEG draft_size, see load_image). Works
+    with torch's DataLoader.
+    """
+
+    def __init__(self, manifest:Manifest, transform=None, idxs=None, draft_size=None):
+        self.manifest = manifest
+        self.transform = transform
+        self.draft_size = draft_size
+        self.idxs = np.arange(len(manifest)) if idxs is None else np.asarray(idxs)
+
+    def __len__(self) -> int:
+        return len(self.idxs)
+
+    def __getitem__(self, item:int):
+        idx = self.idxs[item]
+        image = load_image(self.manifest.paths[idx], self.draft_size)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.manifest.labels[idx])
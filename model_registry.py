@@ -0,0 +1,292 @@
+"""
+Lazily initialized models shared by the
+experiment scripts. Nothing heavy (torch,
+torchvision, CLIP) is imported until a model
+is first asked for, and each model is only
+loaded once per process and then reused, so
+importing an experiment file or checking its
+config is fast and pipeline stages can be
+run back to back without reloading weights.
+
+Usage:
+    from model_registry import get_model, get_data_transforms
+    custom_model = get_model("resnet")
+    clip_model, clip_preprocess = get_model("clip")
+"""
+
+import os
+import functools
+from settings import INFERENCE_MODE, NUM_CORRS, MODEL_PATH, IMG_WIDTH, IMG_HEIGHT, CLIP_VIS, \
+    TRAIN_MEANS_1_CORR, TRAIN_MEANS_2_CORR, TRAIN_STDEVS_1_CORR, TRAIN_STDEVS_2_CORR
+from instrument import timed_iter
+from batch_tuner import batch_size_for, forward_with_backoff
+
+OUT_FEATS = 2
+EMBEDDING_DIM = 512
+
+# name -> function that builds the model
+_LOADERS = {}
+# name -> model, filled in by get_model
+_loaded = {}
+
+def register(name:str):
+    """
+    Decorator that adds a model
+    loading function to the registry.
+    """
+    def decorator(load_fn):
+        _LOADERS[name] = load_fn
+        return load_fn
+    return decorator
+
+@functools.lru_cache(maxsize=None)
+def get_device() -> str:
+    """
+    "cuda" if a GPU is available, else "cpu"
+    """
+    import torch # pylint:disable=import-outside-toplevel
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def get_model(name:str):
+    """
+    Load the named model the first time
+    it is asked for, then return the
+    same instance on every later call.
+    """
+    assert name in _LOADERS, \
+        f"Unknown model {name}, expected one of {list(_LOADERS)}"
+    if name not in _loaded:
+        print(f'Loading model: {name}')
+        _loaded[name] = _LOADERS[name]()
+    return _loaded[name]
+
+def artifact_path(weights_path:str, kind:str) -> str:
+    """
+    Where the exported inference artifact
+    of the given kind (ex: "frozen") for the
+    weights at weights_path is saved, ex:
+    resnet_models/resnet_2_corr.frozen.pt
+    """
+    return f"{os.path.splitext(weights_path)[0]}.{kind}.pt"
+
+# Scripts that create each kind of inference artifact
+ARTIFACT_SCRIPTS = {
+    "frozen": "resnet_models/export_inference.py",
+    "int8": "resnet_models/quantize_resnet.py",
+}
+
+def classifier_device(mode:str=INFERENCE_MODE) -> str:
+    """
+    The device the age classifier runs on
+    in the given inference mode. Exported
+    artifacts (quantized int8, and frozen,
+    whose optimize_for_inference pass may use
+    CPU-only MKLDNN ops) only run on the CPU,
+    so on a GPU machine "frozen" runs the
+    eager model on the GPU instead.
+    """
+    return "cpu" if mode == "int8" else get_device()
+
+def _load_artifact(kind:str):
+    """
+    Load the TorchScript artifact of the given
+    kind for MODEL_PATH, or return None if it
+    hasn't been exported since MODEL_PATH was
+    last saved.
+    """
+    import torch # pylint:disable=import-outside-toplevel
+    path = artifact_path(MODEL_PATH, kind)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(MODEL_PATH):
+        print(f'No up to date {kind} model at {path}, using the eager model. ' +\
+              f'Run {ARTIFACT_SCRIPTS[kind]} to create it.')
+        return None
+    return torch.jit.load(path, map_location="cpu")
+
+def load_classifier(mode:str=INFERENCE_MODE):
+    """
+    Load the ResNet18 age classifier saved at
+    MODEL_PATH, in eval mode. mode is "eager",
+    or the kind of exported inference artifact
+    to use if there is one ("frozen" or "int8",
+    both CPU only, see classifier_device).
+    Unlike get_model, this loads a new copy
+    on every call.
+    """
+    # pylint:disable=import-outside-toplevel
+    import torch
+    from torch import nn
+    import torchvision
+    assert mode == "eager" or mode in ARTIFACT_SCRIPTS, \
+        f"Unknown inference mode {mode}, expected eager or one of {list(ARTIFACT_SCRIPTS)}"
+    if mode == "frozen" and classifier_device(mode) != "cpu":
+        print(f'The frozen model only runs on the CPU, using the eager model on {get_device()}')
+    elif mode != "eager":
+        model = _load_artifact(mode)
+        if model is not None:
+            return model
+    model = torchvision.models.resnet18()
+    model.fc = nn.Linear(in_features=512, out_features=OUT_FEATS, bias=True)
+    model.load_state_dict(torch.load(MODEL_PATH, map_location=classifier_device(mode)))
+    model.to(classifier_device(mode))
+    model.eval()
+    return model
+
+@register("resnet")
+def _load_resnet():
+    """
+    The age classifier in INFERENCE_MODE
+    """
+    return load_classifier(INFERENCE_MODE)
+
+@register("clip")
+def _load_clip():
+    """
+    The CLIP model and its image
+    preprocessing function, as a tuple.
+    """
+    import clip # pylint:disable=import-outside-toplevel
+    clip_model, clip_preprocess = clip.load(CLIP_VIS, device=get_device())
+    clip_model.eval()
+    return clip_model, clip_preprocess
+
+@functools.lru_cache(maxsize=None)
+def get_data_transforms():
+    """
+    The transforms used to prepare
+    images for the age classifier.
+    """
+    from torchvision import transforms # pylint:disable=import-outside-toplevel
+    img_size = (IMG_WIDTH, IMG_HEIGHT)
+    assert img_size == (75, 75), "Images must be 75x75"
+    means = TRAIN_MEANS_1_CORR if NUM_CORRS == 1 else TRAIN_MEANS_2_CORR
+    stdevs = TRAIN_STDEVS_1_CORR if NUM_CORRS == 1 else TRAIN_STDEVS_2_CORR
+    return transforms.Compose([
+        transforms.Resize(img_size),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=list(means.values()), std=list(stdevs.values()))
+    ])
+
+def image_batches(paths:list[str], batch_size, preprocess, draft_size=None):
+    """
+    Yield (start index, end index, stacked tensor)
+    for each batch of batch_size images in paths,
+    where each image is opened and converted to
+    RGB (same loading as torchvision's ImageFolder,
+    or decoded at a reduced draft_size, see
+    manifest.load_image) and then passed through
+    preprocess. batch_size can be a
+    batch_tuner.BatchSize, in which case it is
+    re-read every batch.
+    """
+    # pylint:disable=import-outside-toplevel
+    import torch
+    from manifest import load_image
+    start_i = 0
+    while start_i < len(paths):
+        end_i = min(start_i + int(batch_size), len(paths))
+        yield start_i, end_i, torch.stack([preprocess(load_image(path, draft_size)) \
+                                           for path in paths[start_i:end_i]])
+        start_i = end_i
+
+def encode_images_local(paths:list[str], batch_size:int=None):
+    """
+    Get the CLIP embedding of every image
+    in paths, batch_size images at a time
+    (tuned for this machine if None),
+    using the in-process CLIP model.
+    Returns a float32 numpy array of shape
+    (len(paths), EMBEDDING_DIM).
+    """
+    # pylint:disable=import-outside-toplevel
+    import numpy as np
+    import torch
+    clip_model, clip_preprocess = get_model("clip")
+    batch_size = batch_size or batch_size_for("clip")
+    embeds = np.empty((len(paths), EMBEDDING_DIM), dtype=np.float32)
+    with torch.no_grad():
+        for start_i, end_i, image_input in \
+                timed_iter(image_batches(paths, batch_size, clip_preprocess)):
+            embeds[start_i:end_i] = forward_with_backoff(
+                clip_model.encode_image, image_input.to(get_device()), batch_size
+            ).float().cpu().numpy()
+    return embeds
+
+def classify_images_local(paths:list[str], batch_size:int=None):
+    """
+    Get the age classifier's logits for every
+    image in paths, batch_size images at a time
+    (tuned for this machine if None),
+    using the in-process model. Returns a float32
+    numpy array of shape (len(paths), OUT_FEATS).
+    """
+    # pylint:disable=import-outside-toplevel
+    import numpy as np
+    import torch
+    from manifest import decode_size
+    custom_model = get_model("resnet")
+    batch_size = batch_size or batch_size_for("resnet")
+    logits = np.empty((len(paths), OUT_FEATS), dtype=np.float32)
+    with torch.no_grad():
+        for start_i, end_i, images in \
+                timed_iter(image_batches(paths, batch_size, get_data_transforms(),
+                                         decode_size())):
+            logits[start_i:end_i] = forward_with_backoff(
+                custom_model, images.to(classifier_device()), batch_size
+            ).float().cpu().numpy()
+    return logits
+
+def warm_up(batch_size:int=8):
+    """
+    Run a dummy batch through each loaded
+    model so one-time setup costs (cuDNN
+    autotuning, allocator growth) are paid
+    before the first real request.
+    """
+    import torch # pylint:disable=import-outside-toplevel
+    with torch.no_grad():
+        if "resnet" in _loaded:
+            get_model("resnet")(torch.zeros(batch_size, 3, IMG_HEIGHT, IMG_WIDTH,
+                                            device=classifier_device()))
+        if "clip" in _loaded:
+            clip_model, _ = get_model("clip")
+            res = clip_model.visual.input_resolution
+            clip_model.encode_image(torch.zeros(batch_size, 3, res, res,
+                                                device=get_device(), dtype=clip_model.dtype))
+
+def encode_images(paths:list[str], batch_size:int=None):
+    """
+    Same as encode_images_local, but uses
+    the inference server if it is running.
+    """
+    from inference_server import request_server # pylint:disable=import-outside-toplevel
+    embeds = request_server("embed", paths)
+    if embeds is None:
+        embeds = encode_images_local(paths, batch_size)
+    return embeds
+
+def classify_images(paths:list[str], batch_size:int=None):
+    """
+    Same as classify_images_local, but uses
+    the inference server if it is running.
+    """
+    from inference_server import request_server # pylint:disable=import-outside-toplevel
+    logits = request_server("logits", paths)
+    if logits is None:
+        logits = classify_images_local(paths, batch_size)
+    return logits
+
+def decision_scores(paths:list[str], svm_c, batch_size:int=None):
+    """
+    The decision score of a fitted linear SVM
+    (svm_c) for the CLIP embedding of every
+    image in paths. Uses the inference server
+    if it is running.
+    """
+    # pylint:disable=import-outside-toplevel
+    import numpy as np
+    from inference_server import request_server
+    coef, intercept = np.asarray(svm_c.coef_[0]), float(svm_c.intercept_[0])
+    ds_values = request_server("decision_scores", paths, coef, intercept)
+    if ds_values is None:
+        ds_values = np.dot(encode_images_local(paths, batch_size), coef) + intercept
+    return ds_values
@@ -0,0 +1,170 @@
+"""
+Headless figures for unattended runs. Instead
+of opening a window with plt.show() (which
+blocks until it's closed), scripts add their
+figures to a Report, and write() renders them
+all in worker processes with matplotlib's
+non-interactive Agg backend into a single HTML
+page under REPORT_DIR:
+
+    report = Report("top_k")
+    report.add_curves("Female Flagged for Class old", curves, baseline=0.2, ...)
+    report.add_montage("old path 0-1", image_paths)
+    report.write() # ex: reports/top_k_20230412-101500/index.html
+
+Montages are grids of thumbnails. Each source
+image's thumbnail is decoded once and cached
+in THUMBS_DIR (keyed by the image's path,
+size, and mtime), so later reports reuse it.
+"""
+
+import os
+import time
+import html
+import shutil
+import hashlib
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from settings import REPORT_DIR
+
+THUMBS_DIR = os.path.join(REPORT_DIR, "thumbs")
+THUMB_SIZE = 96 # pixels, longest side
+MONTAGE_COLS = 10
+NUM_WORKERS = min(8, os.cpu_count() or 1)
+
+def thumb_path(path:str) -> str:
+    """
+    Where the thumbnail of the image at
+    path is cached. Changes if the image
+    is rewritten.
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return os.path.join(THUMBS_DIR, hashlib.sha1(key.encode()).hexdigest() + ".png")
+
+def make_thumbnail(path:str) -> str:
+    """
+    Decode the image at path (at a reduced
+    JPEG draft size) and cache its thumbnail.
+    Returns the thumbnail's path.
+    """
+    from manifest import load_image # pylint:disable=import-outside-toplevel
+    out_path = thumb_path(path)
+    if not os.path.exists(out_path):
+        image = load_image(path, (THUMB_SIZE, THUMB_SIZE))
+        image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        tmp_path = f"{out_path}.{os.getpid()}.tmp.png"
+        image.save(tmp_path)
+        os.replace(tmp_path, out_path) # workers may race on the same image
+    return out_path
+
+def render_curves(fig:dict, out_path:str):
+    """
+    Plot fig's curves (label -> y values)
+    and baseline to out_path
+    """
+    # pylint:disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    plt.figure()
+    for label, y_vals in fig["curves"].items():
+        plt.plot(range(len(y_vals)), y_vals, color=fig["colors"].get(label), label=label)
+    if fig["baseline"] is not None:
+        plt.axhline(y=fig["baseline"], color='r', label="Baseline")
+    plt.ylabel(fig["ylabel"])
+    plt.xlabel(fig["xlabel"])
+    plt.legend(loc="upper right")
+    plt.title(fig["title"])
+    plt.savefig(out_path)
+    plt.close()
+
+def render_montage(fig:dict, out_path:str):
+    """
+    Paste the cached thumbnails of fig's
+    images into a grid at out_path
+    """
+    from PIL import Image # pylint:disable=import-outside-toplevel
+    paths = fig["image_paths"]
+    cols = min(MONTAGE_COLS, len(paths))
+    rows = -(-len(paths) // cols)
+    grid = Image.new("RGB", (cols * THUMB_SIZE, rows * THUMB_SIZE), "white")
+    for i, path in enumerate(paths):
+        with Image.open(make_thumbnail(path)) as thumb:
+            grid.paste(thumb, ((i % cols) * THUMB_SIZE, (i // cols) * THUMB_SIZE))
+    grid.save(out_path)
+
+def _render(fig:dict, out_path:str) -> str:
+    if fig["kind"] == "curves":
+        render_curves(fig, out_path)
+    else:
+        render_montage(fig, out_path)
+    if fig.get("save_as"):
+        shutil.copy(out_path, fig["save_as"])
+    return out_path
+
+class Report:
+
+    """
+    Figures collected over a run,
+    rendered together by write()
+    """
+
+    def __init__(self, name:str):
+        self.name = name
+        self.figs = []
+
+    def add_curves(self, title:str, curves:dict, baseline=None, ylabel:str="",
+                   xlabel:str="", colors:dict=None, save_as:str=None):
+        """
+        A line plot of each curve in curves
+        (label -> y values), with an optional
+        horizontal baseline. If save_as is
+        given, the figure is also copied there.
+        """
+        self.figs.append({"kind": "curves", "title": title,
+                          "curves": dict(curves),
+                          "baseline": None if baseline is None else float(baseline),
+                          "ylabel": ylabel, "xlabel": xlabel, "colors": colors or {},
+                          "save_as": save_as})
+
+    def add_montage(self, title:str, image_paths:list[str]):
+        """
+        A grid of thumbnails of image_paths,
+        in order
+        """
+        if image_paths:
+            self.figs.append({"kind": "montage", "title": title,
+                              "image_paths": [str(path) for path in image_paths]})
+
+    def write(self, num_workers:int=NUM_WORKERS) -> str:
+        """
+        Render every figure in parallel and
+        write the report's index.html.
+        Returns the report's directory.
+        """
+        out_dir = os.path.join(REPORT_DIR, f"{self.name}_{time.strftime('%Y%m%d-%H%M%S')}")
+        os.makedirs(out_dir, exist_ok=True)
+        os.makedirs(THUMBS_DIR, exist_ok=True)
+        image_paths = {path for fig in self.figs for path in fig.get("image_paths", [])}
+        missing = [path for path in image_paths if not os.path.exists(thumb_path(path))]
+        files = [f"fig_{i:03d}.png" for i in range(len(self.figs))]
+        print(f"Rendering {len(self.figs)} figures ({len(missing)} new thumbnails) " +\
+              f"with {num_workers} workers")
+        # spawn, so workers don't inherit the parent's
+        # torch threads or an interactive backend
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 mp_context=get_context("spawn")) as pool:
+            # Decode each source image once up front, so
+            # montages sharing images don't both decode it
+            list(pool.map(make_thumbnail, missing, chunksize=32))
+            list(pool.map(_render, self.figs,
+                          [os.path.join(out_dir, file) for file in files]))
+
+        sections = [f"<h2>{html.escape(fig['title'])}</h2>\n<img src=\"{file}\">" \
+                    for fig, file in zip(self.figs, files)]
+        with open(os.path.join(out_dir, "index.html"), "w", encoding="utf-8") as f:
+            f.write(f"<!DOCTYPE html>\n<html><head><title>{html.escape(self.name)}</title>" +\
+                    "</head><body>\n" + "\n".join(sections) + "\n</body></html>\n")
+        print(f"Wrote report to {os.path.join(out_dir, 'index.html')}")
+        return out_dir
@@ -0,0 +1,144 @@
+"""
+Export an inference-optimized copy of a
+trained classifier. BatchNorm layers are
+folded into the layer they follow or feed
+wherever that is exact, then the model is
+scripted and frozen with TorchScript
+(torch.jit.freeze + optimize_for_inference)
+and saved next to the original weights, ex:
+    resnet_models/resnet_2_corr.pth ->
+    resnet_models/resnet_2_corr.frozen.pt
+
+Before saving, the exported model's outputs
+are checked against the eager model's, and
+the CPU throughput of both is printed.
+The evaluation scripts load the ResNet artifact
+when INFERENCE_MODE in settings.py is "frozen",
+and custom_age_model/age_model_train.py eval
+loads the custom_age one. The export runs on
+the CPU, and artifacts are only loaded on the
+CPU (optimize_for_inference may insert CPU-only
+MKLDNN ops).
+
+Run from the repo root, ex:
+    python3 resnet_models/export_inference.py resnet
+    python3 resnet_models/export_inference.py custom_age --weights smiling_age_model.pth
+"""
+
+import copy
+import time
+import argparse
+import torch
+from torch import nn
+import torchvision
+from torch.fx.experimental.optimization import fuse
+from settings import MODEL_PATH, IMG_WIDTH, IMG_HEIGHT
+from model_registry import OUT_FEATS, artifact_path
+from custom_age_model.age_model import CustomAgeNetwork
+
+PARITY_ATOL = 1e-4 # max allowed abs difference between eager and exported outputs
+BENCH_BATCH = 256
+BENCH_ITERS = 10
+# model name -> input shape (C, H, W)
+INPUT_SHAPES = {
+    "resnet": (3, IMG_HEIGHT, IMG_WIDTH),
+    "custom_age": (3, 82, 100), # age_model_train.py resizes to (82, 100)
+}
+
+def load_eager(name:str, weights:str) -> nn.Module:
+    """
+    Build the named model and load its
+    trained weights, in eval mode on the CPU.
+    """
+    if name == "resnet":
+        model = torchvision.models.resnet18()
+        model.fc = nn.Linear(in_features=512, out_features=OUT_FEATS, bias=True)
+    else:
+        model = CustomAgeNetwork()
+    model.load_state_dict(torch.load(weights, map_location="cpu"))
+    return model.eval()
+
+def fold_bn_into_linear(bn:nn.BatchNorm2d, linear:nn.Linear):
+    """
+    Fold a BatchNorm whose (flattened)
+    output is the input to linear into
+    linear's weights and bias, in place.
+    """
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        # the BN output is flattened channel-major,
+        # so each channel covers a run of inputs
+        spatial = linear.in_features // bn.num_features
+        scale = scale.repeat_interleave(spatial)
+        shift = shift.repeat_interleave(spatial)
+        linear.bias += linear.weight @ shift
+        linear.weight *= scale
+
+def fold_custom_age(model:CustomAgeNetwork) -> CustomAgeNetwork:
+    """
+    CustomAgeNetwork applies BatchNorm after
+    ReLU/max pool, so bn1-bn7 can't be folded
+    into the conv before them, and folding them
+    into the next conv isn't exact because of
+    its zero padding. bn8 feeds fc1 directly
+    (through a flatten), so it folds exactly.
+    """
+    model = copy.deepcopy(model)
+    fold_bn_into_linear(model.bn8, model.fc1)
+    model.bn8 = nn.Identity()
+    return model
+
+def export(name:str, weights:str):
+    """
+    Fold, script, freeze, check, and save
+    """
+    eager = load_eager(name, weights)
+    folded = fuse(eager) if name == "resnet" else fold_custom_age(eager)
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.script(folded.eval())))
+
+    # Numerical parity on random inputs
+    inputs = torch.randn(BENCH_BATCH, *INPUT_SHAPES[name])
+    with torch.no_grad():
+        eager_out = eager(inputs)
+        frozen_out = frozen(inputs)
+    max_diff = (eager_out - frozen_out).abs().max().item()
+    print(f"Max abs difference from eager model: {max_diff:.2e}")
+    assert max_diff < PARITY_ATOL, \
+        f"Exported model differs from eager model by {max_diff}, not saving"
+    preds_match = (eager_out.argmax(1) == frozen_out.argmax(1)).float().mean().item()
+    print(f"Prediction agreement with eager model: {preds_match:.4f}")
+
+    for desc, model in (("eager", eager), ("frozen", frozen)):
+        print(f"{desc} throughput: {throughput(model, inputs):.0f} images/s")
+
+    out_path = artifact_path(weights, "frozen")
+    torch.jit.save(frozen, out_path)
+    print(f"Saved inference model to {out_path}")
+
+def throughput(model, inputs) -> float:
+    """
+    Images per second over BENCH_ITERS
+    forward passes, after one warm-up pass
+    """
+    with torch.no_grad():
+        model(inputs)
+        start = time.perf_counter()
+        for _ in range(BENCH_ITERS):
+            model(inputs)
+    return BENCH_ITERS * len(inputs) / (time.perf_counter() - start)
+
+def main():
+    """
+    Parse which model to export
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", choices=list(INPUT_SHAPES))
+    parser.add_argument("--weights", default=MODEL_PATH,
+                        help="state dict to export (default MODEL_PATH)")
+    args = parser.parse_args()
+    export(args.model, args.weights)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Post-training static int8 quantization of
+the ResNet18 age classifier at MODEL_PATH,
+for faster offline scoring on the CPU.
+
+The trained weights are loaded into
+torchvision's quantizable ResNet18, its
+conv/bn/relu layers are fused, and observers
+are calibrated on a random sample of the
+training split before converting to int8.
+The quantized model is scripted and saved
+next to the weights, ex:
+    resnet_models/resnet_2_corr.int8.pt
+
+Afterwards the per-subgroup accuracy of the
+eager and int8 models on the val set is
+printed side by side (see test_evals.py),
+along with both models' CPU throughput.
+Set INFERENCE_MODE = "int8" in settings.py to
+use the quantized model in the evaluation scripts.
+
+Run from the repo root:
+    python3 resnet_models/quantize_resnet.py
+"""
+
+import time
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+from torchvision.models.quantization import resnet18 as quantizable_resnet18
+from torch.ao.quantization import get_default_qconfig, prepare, convert
+from settings import MODEL_PATH, TRAIN_DIR, VAL_DIR
+from model_registry import OUT_FEATS, artifact_path, get_data_transforms, load_classifier
+from manifest import load_manifest, ManifestDataset, decode_size
+from test_evals import loader, test_acc, print_comparison
+
+NUM_CALIB_IMGS = 2048 # training images used to calibrate the activation ranges
+CALIB_BATCH = 128
+SEED = 0
+BENCH_BATCH = 256
+BENCH_ITERS = 10
+
+def quant_backend() -> str:
+    """
+    The best quantized engine this
+    build of torch supports
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError(f"No supported quantized engine in {engines}")
+
+def calibration_loader() -> DataLoader:
+    """
+    A random sample of NUM_CALIB_IMGS
+    images from the training split
+    """
+    manifest = load_manifest(TRAIN_DIR)
+    gen = torch.Generator().manual_seed(SEED)
+    idxs = torch.randperm(len(manifest), generator=gen)[:NUM_CALIB_IMGS]
+    return DataLoader(ManifestDataset(manifest, get_data_transforms(), idxs.numpy(), decode_size()),
+                      batch_size=CALIB_BATCH)
+
+def quantize() -> torch.jit.ScriptModule:
+    """
+    Fuse, calibrate, and convert
+    the classifier to int8
+    """
+    backend = quant_backend()
+    torch.backends.quantized.engine = backend
+    model = quantizable_resnet18(weights=None, quantize=False)
+    model.fc = nn.Linear(in_features=512, out_features=OUT_FEATS, bias=True)
+    model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
+    model.eval()
+    model.fuse_model()
+    model.qconfig = get_default_qconfig(backend)
+    prepare(model, inplace=True)
+
+    print(f"Calibrating on {NUM_CALIB_IMGS} training images with the {backend} backend")
+    with torch.no_grad():
+        for images, _ in calibration_loader():
+            model(images)
+    convert(model, inplace=True)
+    return torch.jit.script(model)
+
+def throughput(model) -> float:
+    """
+    CPU images per second over BENCH_ITERS
+    forward passes, after one warm-up pass
+    """
+    inputs = torch.randn(BENCH_BATCH, 3, 75, 75)
+    with torch.no_grad():
+        model(inputs)
+        start = time.perf_counter()
+        for _ in range(BENCH_ITERS):
+            model(inputs)
+    return BENCH_ITERS * BENCH_BATCH / (time.perf_counter() - start)
+
+def main():
+    """
+    Quantize, save, and compare
+    against the eager model
+    """
+    int8_model = quantize()
+    out_path = artifact_path(MODEL_PATH, "int8")
+    torch.jit.save(int8_model, out_path)
+    print(f"Saved int8 model to {out_path}")
+
+    eager_model = load_classifier("eager").cpu()
+    eager_speed, int8_speed = throughput(eager_model), throughput(int8_model)
+    print(f"eager throughput: {eager_speed:.0f} images/s")
+    print(f"int8 throughput: {int8_speed:.0f} images/s ({int8_speed / eager_speed:.2f}x)")
+
+    val_loader = loader(VAL_DIR)
+    print("Eager model:")
+    eager_results = test_acc(val_loader, "val", eager_model, "cpu")
+    print("Int8 model:")
+    int8_results = test_acc(val_loader, "val", int8_model, "cpu")
+    print_comparison(eager_results, int8_results, "eager", "int8")
+
+if __name__ == "__main__":
+    main()
@@ -22,10 +22,27 @@ TRAIN_DIR = "data/train_2_corr"
 VAL_DIR = "data/val_2_corr"
 TEST_DIR = "data/test_2_corr"
 MODEL_PATH = "resnet_models/resnet_2_corr.pth" # destination path if training new resnet model
+INFERENCE_MODE = "frozen" # "eager", "frozen" (resnet_models/export_inference.py, CPU only, eager on a GPU), or "int8" (resnet_models/quantize_resnet.py)
 IMG_WIDTH = 75
 IMG_HEIGHT = 75
+FAST_DECODE = False # decode JPEGs at a reduced (DCT-scaled) size close to IMG_WIDTH x IMG_HEIGHT before resizing. Changes the pixels models see, so only turn on once benchmarks/bench_fast_decode.py --accuracy shows no per-subgroup regression
 NUM_CORRS = 2 # Should be 1 or 2
 CLIP_VIS = "ViT-B/32"
+EMBEDS_DIR = "embeds" # sharded CLIP embeddings from dataset_utils/extract_clip_embeds.py
+MANIFEST_DIR = "manifests" # cached image listings of each split, see manifest.py
+TEXT_EMBEDS_DIR = "embeds/text" # CLIP text embeddings of the prompts in text_prompts.py, per CLIP model
+EMBED_CODEC = "float32" # how gmm.py stores embeddings for scoring/search: "float32", "float16", "int8", or "pq" (see embed_codes.py)
+INFERENCE_SOCKET = None # unix socket for inference_server.py, None for one in a private per-user directory
+USE_INFERENCE_SERVER = True # use inference_server.py when it's running, else load models in-process
+RUNS_DIR = "runs" # stage timing logs written by instrument.py
+AUTOTUNE_BATCH = True # pick each model's batch size for this machine, see batch_tuner.py
+BATCH_SIZE_CACHE = "batch_sizes.json" # tuned batch size per (model, device, host)
+BATCH_MEMORY_FRAC = 0.5 # fraction of free memory a tuned batch may use
+PROFILE_STAGE = None # name of a stage to record a torch profiler trace for, ex: "fit_svm_old/svm_fit"
+RESULTS_DIR = "results/per_image" # per-image outputs saved by utils.save_results, one file per run
+RESULTS_FORMAT = "parquet" # "parquet", "feather", or "npz". parquet/feather need pyarrow, else npz is used
+SVM_STATE_DIR = "svm_state" # each class's linear SVM, saved between top_k.py runs when INCREMENTAL
+REPORT_DIR = "reports" # headless HTML reports of figures written by report.py
 TRAIN_MEANS_1_CORR = {
     "red":  0.5016617507657585,
     "green": 0.4204056117111792,
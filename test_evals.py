@@ -6,56 +6,56 @@ the model being used is one
 of the ResNet models. 
 """
 
-import torch
-from torch.utils.data import DataLoader
-from torch import nn
-import torchvision
-from torchvision import datasets, transforms
-from settings import NUM_CORRS, MODEL_PATH, IMG_WIDTH, IMG_HEIGHT, TRAIN_MEANS_1_CORR, \
-    TRAIN_MEANS_2_CORR, TRAIN_STDEVS_1_CORR, TRAIN_STDEVS_2_CORR, TRAIN_DIR, \
-    VAL_DIR, TEST_DIR, TRAIN_LIMS_1_CORR, TRAIN_LIMS_2_CORR
+import numpy as np
+from settings import NUM_CORRS, TRAIN_DIR, VAL_DIR, TEST_DIR, \
+    TRAIN_LIMS_1_CORR, TRAIN_LIMS_2_CORR, INFERENCE_MODE, FAST_DECODE, IMG_WIDTH, IMG_HEIGHT
+from model_registry import get_model, get_data_transforms, load_classifier, classifier_device
+from utils import save_results
+from manifest import load_manifest, ManifestDataset
+from batch_tuner import batch_size_for, forward_with_backoff
+import instrument
 
-BATCH_SIZE = 512
-DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-if torch.cuda.is_available():
-    map_location=lambda storage, loc: storage.cuda() # pylint:disable=unnecessary-lambda-assignment
-else:
-    map_location='cpu'
+BATCH_SIZE = None # None to use the classifier's tuned batch size (batch_tuner.py)
+# Set to another inference mode ("eager", "frozen", or "int8")
+# to print each subgroup's accuracy in INFERENCE_MODE next
+# to its accuracy in this mode, ex: to check quantization
+COMPARE_MODE = None
 
-# Load ResNet model
-OUT_FEATS = 2
-model = torchvision.models.resnet18()
-model.fc = nn.Linear(in_features=512, out_features=OUT_FEATS, bias=True)
-model.load_state_dict(torch.load(MODEL_PATH, map_location=map_location))
-model.to(DEVICE)
-
-MEANS = TRAIN_MEANS_1_CORR if NUM_CORRS == 1 else TRAIN_MEANS_2_CORR
-STDEVS = TRAIN_STDEVS_1_CORR if NUM_CORRS == 1 else TRAIN_STDEVS_2_CORR
-img_size = (IMG_WIDTH, IMG_HEIGHT)
-data_transforms = transforms.Compose([
-    transforms.Resize(img_size),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=list(MEANS.values()), std=list(STDEVS.values()))
-])
-
-def loader(dirn):
+def loader(dirn, fast_decode:bool=FAST_DECODE):
     """ 
-    Create data using torchvision 
-    ImageFolder and torch DataLoader.
+    Create data using the split's
+    manifest and torch DataLoader.
     For evaluation only, since this 
     sets shuffle as False.
     """
-    return DataLoader(datasets.ImageFolder(dirn, transform=data_transforms), \
-                      batch_size = BATCH_SIZE, shuffle=False)
+    from torch.utils.data import DataLoader # pylint:disable=import-outside-toplevel
+    batch_size = BATCH_SIZE or int(batch_size_for("resnet"))
+    draft_size = (IMG_WIDTH, IMG_HEIGHT) if fast_decode else None
+    return DataLoader(ManifestDataset(load_manifest(dirn), transform=get_data_transforms(),
+                                      draft_size=draft_size), \
+                      batch_size = batch_size, shuffle=False)
 
-def test_acc(data_loader, mode):
+def test_acc(data_loader, mode, model=None, device=None, save_name=None):
     """
     Loop through the data loader
     to calculate the accuracy 
     over the entire set of images.
     mode is a string in 
     {"train", "val", "test"}
+    Uses the registry's classifier unless
+    another model (and its device) is given.
+    Returns the 'correct' and 'total' counts
+    for each subgroup and for 'total'.
+    If save_name is given, each image's
+    correctness is saved with utils.save_results.
     """
+    import torch # pylint:disable=import-outside-toplevel
+    # Only the registry's classifier backs off its tuned batch
+    # size on OOM. Other models just split the failing batch.
+    tuned_size = None
+    if model is None:
+        model, device = get_model("resnet"), classifier_device()
+        tuned_size = batch_size_for("resnet")
 
     # results stores 'correct' and 'total' for each subgroup
     # uses the training limits dictionaries from settings to get
@@ -64,43 +64,72 @@ def test_acc(data_loader, mode):
             if NUM_CORRS == 1 else \
             {subgroup: {'correct': 0,'total': 0} for subgroup in TRAIN_LIMS_2_CORR}
 
-    total_correct, total_num = 0,0
+    correct_batches = []
     with torch.no_grad():
         model.eval()
-        epoch_correct, epoch_total = 0,0
-        for i, (images, labels) in enumerate(data_loader):
-            images = images.to(DEVICE)
-            labels = labels.to(DEVICE)
+        for images, labels in instrument.timed_iter(data_loader):
+            images = images.to(device)
+            labels = labels.to(device)
             # Custom model
-            logits = model(images)
+            logits = forward_with_backoff(model, images, tuned_size)
             pred = torch.argmax(logits, dim=1)
-            correct = pred == labels
-            epoch_correct += correct.sum()
-            epoch_total += labels.size()[0]
-            
-            start_idx = i * BATCH_SIZE
-            end_idx = start_idx + BATCH_SIZE
-            for f_idx, (f_path, class_num) in enumerate(data_loader.dataset.samples[start_idx:end_idx]):
-                # Use file path to get attributes val_orig/old/female
-                sex = "female" if "female" in f_path else "male"
-                age = "young" if "young" in f_path else "old"
-                full_key = "_".join([age, sex]) # ex: old_female
-                if NUM_CORRS == 2:
-                    smiling = "no_smile" if "no_smile" in f_path else "smile"
-                    full_key = "_".join([age,sex,smiling])
-                if correct[f_idx]:
-                    total_correct += 1
-                    results[full_key]['correct'] = results[full_key]['correct'] + 1
-                results[full_key]['total'] = results[full_key]['total'] + 1
-                total_num += 1
+            correct_batches.append((pred == labels).cpu())
+    correct = torch.cat(correct_batches).numpy()
+
+    # Tally each image's correctness by the subgroup
+    # (ex: old_female_smile) it's listed under
+    manifest = data_loader.dataset.manifest
+    subgroups = manifest.subgroups[data_loader.dataset.idxs]
+    num_subgroups = len(manifest.subgroup_names)
+    sub_correct = np.bincount(subgroups, weights=correct, minlength=num_subgroups)
+    sub_total = np.bincount(subgroups, minlength=num_subgroups)
+    for sub_idx, subgroup in enumerate(manifest.subgroup_names):
+        results[subgroup]['correct'] += int(sub_correct[sub_idx])
+        results[subgroup]['total'] += int(sub_total[sub_idx])
+    total_correct, total_num = int(correct.sum()), len(correct)
 
     print(f'TOTAL {mode.upper()} ACCURACY: ', round(100 * total_correct/ total_num) / 100)
     for key, val in results.items():
         print(key.upper(), " ACCURACY: ", \
             round(100 * val['correct'] / val['total']) / 100)
+    results['total'] = {'correct': total_correct, 'total': total_num}
+    if save_name is not None:
+        save_results(save_name, manifest.paths[data_loader.dataset.idxs].tolist(),
+                     correct=correct)
+    return results
 
-if __name__ == "__main__":
+def print_comparison(results:dict, other_results:dict, mode:str, other_mode:str):
+    """
+    Print a markdown table of each subgroup's
+    accuracy in two inference modes (as returned
+    by test_acc) and the difference between them
+    """
+    print(f"| Subgroup | {mode} | {other_mode} | Diff |")
+    print("| --- | --- | --- | --- |")
+    for key in ['total', *[k for k in results if k != 'total']]:
+        acc = results[key]['correct'] / results[key]['total']
+        other_acc = other_results[key]['correct'] / other_results[key]['total']
+        print(f"| {key.upper()} | {acc:.4f} | {other_acc:.4f} | {other_acc - acc:+.4f} |")
+
+def main():
+    """
+    Print the per-subgroup accuracy
+    on the val and test sets
+    """
     print("NUM_CORRS: ", NUM_CORRS)
-    # test_acc(loader(TRAIN_DIR), "train")
-    test_acc(loader(VAL_DIR), "val")
-    test_acc(loader(TEST_DIR), "test")
+    with instrument.run("test_evals"):
+        # test_acc(loader(TRAIN_DIR), "train")
+        for mode, dirn in [("val", VAL_DIR), ("test", TEST_DIR)]:
+            data_loader = loader(dirn)
+            with instrument.stage(mode, items=len(data_loader.dataset)):
+                results = test_acc(data_loader, mode,
+                                   save_name=f"test_evals_{mode}_{INFERENCE_MODE}")
+            if COMPARE_MODE is not None:
+                print(f"Evaluating {mode} set in {COMPARE_MODE} mode")
+                with instrument.stage(f"{mode}_{COMPARE_MODE}", items=len(data_loader.dataset)):
+                    other_results = test_acc(data_loader, mode, load_classifier(COMPARE_MODE),
+                                             classifier_device(COMPARE_MODE))
+                print_comparison(results, other_results, INFERENCE_MODE, COMPARE_MODE)
+
+if __name__ == "__main__":
+    main()
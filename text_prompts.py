@@ -0,0 +1,134 @@
+"""
+Name failure directions with text, Domino-style.
+A vocabulary of prompts (every CelebA attribute,
+and its absence, in a few templates) is encoded
+with CLIP's text encoder once per CLIP model and
+cached to TEXT_EMBEDS_DIR. Any number of
+directions in CLIP space (ex: an SVM's coef_,
+or a GMM cluster's mean) are then labeled with
+their most similar prompts by a single
+matrix multiply.
+
+    prompts, text_embeds = prompt_embeds()
+    for labels in rank_prompts(directions, prompts, text_embeds):
+        ...
+"""
+
+import os
+import numpy as np
+from settings import CELEBA_HEADER, CLIP_VIS, TEXT_EMBEDS_DIR
+
+TEMPLATES = ["a photo of a person {}.", "a face of someone {}.", "a celebrity {}."]
+# How to phrase attributes whose name doesn't read well after "a person".
+# (has it, doesn't have it)
+ATTR_PHRASES = {
+    'Male': ("who is a man", "who is a woman"),
+    'Young': ("who is young", "who is old"),
+    'Smiling': ("who is smiling", "who is not smiling"),
+    'Attractive': ("who is attractive", "who is unattractive"),
+    'Bald': ("who is bald", "with a full head of hair"),
+    'Chubby': ("who is chubby", "who is thin"),
+    'Blurry': ("in a blurry photo", "in a sharp photo"),
+    'Pale_Skin': ("with pale skin", "with dark skin"),
+    'Heavy_Makeup': ("wearing heavy makeup", "wearing no makeup"),
+    'No_Beard': ("with no beard", "with a beard"),
+    '5_o_Clock_Shadow': ("with a five o'clock shadow", "who is clean shaven"),
+}
+ENCODE_BATCH = 256
+TOP_N = 5 # prompts printed per direction
+
+def attr_phrases(attr:str) -> tuple[str, str]:
+    """
+    Phrases for having and not having
+    a CelebA attribute, ex: Wearing_Hat ->
+    ("wearing hat", "not wearing hat")
+    """
+    if attr in ATTR_PHRASES:
+        return ATTR_PHRASES[attr]
+    words = attr.replace('_', ' ').lower()
+    if words.startswith('wearing'):
+        return words, f"not {words}"
+    return f"with {words}", f"without {words}"
+
+def vocabulary() -> list[str]:
+    """
+    Every attribute phrase in every template
+    """
+    return [template.format(phrase) for attr in CELEBA_HEADER[1:] \
+            for phrase in attr_phrases(attr) for template in TEMPLATES]
+
+def cache_path(clip_model:str=CLIP_VIS) -> str:
+    """
+    Where the text embeddings for clip_model
+    are cached, ex: embeds/text/ViT-B-32.npz
+    """
+    return os.path.join(TEXT_EMBEDS_DIR, clip_model.replace('/', '-') + '.npz')
+
+def encode_text(prompts:list[str]) -> np.ndarray:
+    """
+    CLIP text embeddings of prompts, normalized
+    to unit length, as float32 (len(prompts), 512)
+    """
+    # pylint:disable=import-outside-toplevel
+    import clip
+    import torch
+    from model_registry import get_model, get_device
+    clip_model, _ = get_model("clip")
+    embeds = []
+    with torch.no_grad():
+        for start_i in range(0, len(prompts), ENCODE_BATCH):
+            tokens = clip.tokenize(prompts[start_i:start_i+ENCODE_BATCH]).to(get_device())
+            embeds.append(clip_model.encode_text(tokens).float().cpu().numpy())
+    embeds = np.concatenate(embeds)
+    return embeds / np.linalg.norm(embeds, axis=1, keepdims=True)
+
+def prompt_embeds(prompts:list[str]=None):
+    """
+    (prompts, embeddings) for prompts (default:
+    vocabulary()), loaded from the cache for
+    CLIP_VIS. Only prompts that aren't cached
+    yet are encoded, then added to the cache.
+    """
+    prompts = prompts or vocabulary()
+    path = cache_path()
+    cached = {}
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            cached = dict(zip(saved['prompts'].tolist(), saved['embeds']))
+    missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in cached]
+    if missing:
+        print(f'Encoding {len(missing)} text prompts with CLIP {CLIP_VIS}')
+        cached.update(zip(missing, encode_text(missing)))
+        os.makedirs(TEXT_EMBEDS_DIR, exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, prompts=np.array(list(cached)),
+                 embeds=np.stack(list(cached.values())).astype(np.float32))
+        os.replace(tmp_path, path)
+    return prompts, np.stack([cached[prompt] for prompt in prompts])
+
+def rank_prompts(directions, prompts:list[str], text_embeds, top_n:int=TOP_N):
+    """
+    For each row of directions (num_directions,
+    embed_dim), the top_n prompts whose embedding
+    is most similar to it, as a list of
+    (prompt, cosine similarity), best first.
+    """
+    directions = np.atleast_2d(np.asarray(directions, dtype=np.float32))
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    sims = directions @ text_embeds.T # (num_directions, num_prompts)
+    top_n = min(top_n, len(prompts))
+    best = np.argpartition(-sims, top_n - 1, axis=1)[:, :top_n]
+    ranked = []
+    for row, idxs in enumerate(best):
+        idxs = idxs[np.argsort(-sims[row, idxs])]
+        ranked.append([(prompts[idx], float(sims[row, idx])) for idx in idxs])
+    return ranked
+
+def describe(names:list[str], directions, top_n:int=TOP_N):
+    """
+    Print the top_n prompts for each
+    named direction
+    """
+    prompts, text_embeds = prompt_embeds()
+    for name, labels in zip(names, rank_prompts(directions, prompts, text_embeds, top_n)):
+        print(f'{name}: ' + ', '.join(f'"{prompt}" ({sim:.3f})' for prompt, sim in labels))
@@ -11,250 +11,631 @@ test images are ordered by decision score and
 by the original classifier's confidences to see
 which metric does a better job of surfacing 
 the minority subgroup(s) when ordering test images
-by that metric. Oh also PLOTS! :)
+by that metric. Oh also PLOTS! :) (written to
+an HTML report, see report.py)
 """
 
 import os
-import torch
-from torch.utils.data import DataLoader
-from torch import nn
-import torchvision
-from torchvision import datasets, transforms
-import clip
+import json
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-from sklearn import svm
-from settings import NUM_CORRS, MODEL_PATH, IMG_WIDTH, IMG_HEIGHT, \
-    TRAIN_MEANS_1_CORR, TRAIN_MEANS_2_CORR, TRAIN_STDEVS_1_CORR, \
-    TRAIN_STDEVS_2_CORR, VAL_DIR, TEST_DIR
+from settings import EMBEDS_DIR, NUM_CORRS, VAL_DIR, TEST_DIR, SVM_STATE_DIR
+from model_registry import encode_images, classify_images, decision_scores
+from utils import save_results, iter_clip_embeds
+from manifest import load_manifest
+from text_prompts import describe
+from report import Report
+import instrument
 
 assert NUM_CORRS in [1,2], \
     "Only 1 or 2 correlations currently supported."
 
 # Vars - Modify these to change experiment behavior
 CALC_SVM_ACC = True
-SAVE_FIGS = True
-BATCH_SIZE = 512
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+SAVE_FIGS = True # also copy each plot to the working directory
+DESCRIBE_DIRECTIONS = True # label each SVM's failure direction with text prompts
+SAVE_RESULTS = True # save each test image's scores with utils.save_results
+BATCH_SIZE = None # None to use each model's tuned batch size (batch_tuner.py)
 MODES = ["old", "young"]
+# Instead of scoring and sorting every test image, stream
+# decision scores and keep only the STREAM_K highest and
+# lowest scoring images. For pools too big to hold in memory.
+STREAMING = False
+STREAM_K = 2000
+STREAM_CHUNK = 16384 # images scored at a time when there are no cached embeddings
+# Also fit a nonlinear scorer: an RBF kernel approximated with
+# "rff" (random Fourier features) or "nystroem" features, then a
+# linear SVM on those features. Fit and scoring stay linear in
+# the number of images, and its curve is added to the plots.
+KERNEL_SCORER = None
+KERNEL_COMPONENTS = 2048 # number of approximate kernel features
+KERNEL_GAMMA = None # RBF gamma, None for 1 / (embed_dim * embeds.var())
+SCORER_LABELS = {"linear": "Decision Score", "rff": "RFF Decision Score",
+                 "nystroem": "Nystroem Decision Score"}
+# Save each class's linear SVM (coef_, intercept_, and support
+# vectors) to SVM_STATE_DIR. Later runs only embed and classify
+# the val images added since, and refit on the saved support
+# vectors plus those images, so an update takes time in
+# proportion to the new data rather than the whole val set.
+INCREMENTAL = False
+# Instead of fitting on val and testing on test, run CV_FOLDS-fold
+# cross validation of each class's SVM over the cached val
+# embeddings (dataset_utils/extract_clip_embeds.py), one fold per
+# worker process, to see how stable the SVM and its ranking are.
+CROSS_VALIDATE = False
+CV_FOLDS = 5
+CV_TOP_K = 100 # minority precision is measured over each fold's CV_TOP_K lowest scores
 
-print('Initializing Models and Loaders')
-
-# Custom model
-OUT_FEATS = 2
-custom_model = torchvision.models.resnet18()
-custom_model.fc = nn.Linear(in_features=512, out_features=OUT_FEATS, bias=True)
-custom_model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE))
-custom_model.to(DEVICE)
-
-img_size = (IMG_WIDTH, IMG_HEIGHT)
-assert img_size == (75, 75), "Images must be 75x75"
-MEANS = TRAIN_MEANS_1_CORR if NUM_CORRS == 1 else TRAIN_MEANS_2_CORR
-STDEVS = TRAIN_STDEVS_1_CORR if NUM_CORRS == 1 else TRAIN_STDEVS_2_CORR
-data_transforms = transforms.Compose([
-    transforms.Resize(img_size),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=list(MEANS.values()), std=list(STDEVS.values()))
-])
-
-# SVMs are trained on *val* set, Top_K is evaluated on *test* set
-# the loaders with batch size of 1 is a convenient way to get all
-# of the paths for images in a specific class
-val_loader_no_trans = DataLoader(datasets.ImageFolder(VAL_DIR), batch_size=1)
-NUM_VAL_IMGS = len(val_loader_no_trans)
-test_loader_no_trans = DataLoader(datasets.ImageFolder(TEST_DIR), batch_size=1)
-trained_svms = []
-
-# CLIP
-EMBEDDING_DIM = 512
-clip_model, clip_preprocess = clip.load("ViT-B/32", device=DEVICE)
-
-for mode in MODES:
-
-    current_class_num = 1 if mode == 'young' else 0
-    paths = [tup[0] for tup in val_loader_no_trans.dataset.samples \
-                if tup[1] == current_class_num]
-    num_imgs_this_class = len(paths)
-
-    with torch.no_grad():
-        print(f'Finding model correctness and clip embeds for {mode.upper()} val images')
-        custom_model.eval()
-        clip_model.eval()
-        correctness = torch.empty(num_imgs_this_class, dtype=torch.int8, device=DEVICE)
-        img_feature_stack = torch.empty(num_imgs_this_class, EMBEDDING_DIM)
-        pil_images = []
-        for path in paths:
-            pil_images.append(clip_preprocess(Image.open(path)))
-        cur_idx = 0
-        cur_class_val_dir = os.path.join(VAL_DIR, mode) # ex: val/old
-        cur_class_val_data = datasets.ImageFolder(cur_class_val_dir, transform=data_transforms)
-        cur_class_val_loader = DataLoader(cur_class_val_data, batch_size=BATCH_SIZE)
-        for i, (images, labels) in enumerate(cur_class_val_loader):
-            # Calc classifier correctness for batch
-            images = images.to(DEVICE)
-            labels = labels.to(DEVICE)
-            b_size = labels.size()[0]
-            model_output = custom_model(images)
-            preds = torch.argmax(model_output, dim=1)
-            correct = torch.where(preds==labels, 1, -1)
-            correctness[cur_idx:cur_idx+b_size] = correct
-
-            # Get CLIP embeds for batch
-            image_input = torch.tensor(np.stack(
-                pil_images[cur_idx:cur_idx+b_size]), device=DEVICE)
-            img_feature_stack[cur_idx:cur_idx+b_size] = \
-                clip_model.encode_image(image_input).float()
-
-            cur_idx += b_size
-        del cur_class_val_data,cur_class_val_loader
+assert not (INCREMENTAL and KERNEL_SCORER), \
+    "The kernel scorer needs every val embedding, so it can't be updated incrementally."
 
+def get_class_paths(data_dir:str, mode:str) -> list[str]:
+    """
+    Paths of every image in data_dir
+    that belongs to the class mode
+    ("old" or "young"), in the same
+    order ImageFolder loads them.
+    """
+    manifest = load_manifest(data_dir)
+    return manifest.paths[manifest.class_idxs(mode)].tolist()
+
+def classify_class_dir(data_dir:str, mode:str, idxs=None):
+    """
+    Run the age classifier over every image
+    in data_dir/mode (ex: val/old), or only
+    those at manifest indices idxs. Returns
+    numpy arrays of the classifier's
+    correctness (1 or -1) and confidence
+    for each image.
+    """
+    manifest = load_manifest(data_dir)
+    if idxs is None:
+        idxs = manifest.class_idxs(mode)
+    with instrument.stage("classify", items=len(idxs)):
+        logits = classify_images(manifest.paths[idxs].tolist(), BATCH_SIZE)
+    preds = np.argmax(logits, axis=1)
+    correctness = np.where(preds==manifest.labels[idxs], 1, -1).astype(np.int8)
+    confidences = np.max(logits, axis=1)
+    return correctness, confidences
+
+def fit_kernel_scorer(kind:str, embeds, correctness):
+    """
+    Fit a linear SVM on approximate RBF kernel
+    features ("rff" or "nystroem") of embeds
+    """
+    # pylint:disable=import-outside-toplevel
+    from sklearn.kernel_approximation import RBFSampler, Nystroem
+    from sklearn.pipeline import make_pipeline
+    from sklearn.svm import LinearSVC
+    gamma = KERNEL_GAMMA or 1 / (embeds.shape[1] * embeds.var())
+    if kind == "rff":
+        features = RBFSampler(gamma=gamma, n_components=KERNEL_COMPONENTS, random_state=0)
+    else:
+        features = Nystroem(gamma=gamma, n_components=min(KERNEL_COMPONENTS, len(embeds)),
+                            random_state=0)
+    return make_pipeline(features, LinearSVC(max_iter=5000)).fit(embeds, correctness)
+
+def fit_svm(mode:str) -> dict:
+    """
+    Fit an SVM on the CLIP embeddings of the
+    val images in class mode, using the
+    classifier's correctness as labels.
+    Returns {"linear": the SVM}, plus
+    {KERNEL_SCORER: its scorer} if set.
+    """
+    if INCREMENTAL:
+        return {"linear": fit_svm_incremental(mode)}
+    from sklearn import svm # pylint:disable=import-outside-toplevel
+    with instrument.stage("list_paths"):
+        paths = get_class_paths(VAL_DIR, mode)
+    print(f'Finding model correctness and clip embeds for {mode.upper()} val images')
+    correctness, _ = classify_class_dir(VAL_DIR, mode)
+    with instrument.stage("clip_embeds", items=len(paths)):
+        np_feat_stack = encode_images(paths, BATCH_SIZE) # using StandardScaler() decreased performance
     print('Finished getting clip embeddings and correctness scores.')
     print('Beginning to fit SVM classifier for class ', mode)
-    svm_classifier = svm.SVC(kernel="linear") # LinearSVC(max_iter=5000) had worse performance
-    np_feat_stack = img_feature_stack.cpu().numpy() # using StandardScaler() decreased performance
-    np_corr = np.array(correctness.cpu(), dtype=np.int8)
-    svm_classifier.fit(np_feat_stack, np_corr)
-    trained_svms.append(svm_classifier)
-
-assert len(MODES) == len(trained_svms), \
-    "Number of fitted SVMs not equal to number of classes"
-
-print("Finished training SVMs on validation data.")
-for mode, svm_c in zip(MODES, trained_svms):
-
-    current_class_num = 1 if mode == 'young' else 0
-    test_paths = [tup[0] for tup in test_loader_no_trans.dataset.samples \
-                    if tup[1] == current_class_num]
-    IMGS_THIS_CLASS = len(test_paths)
-    confidences = torch.empty(IMGS_THIS_CLASS)
-    if CALC_SVM_ACC:
-        test_correctness = torch.empty(IMGS_THIS_CLASS)
-    ds_values = None
-    pil_images = []
-    sexes = np.empty(IMGS_THIS_CLASS)
-    smiles = np.empty(IMGS_THIS_CLASS) if NUM_CORRS == 2 else None
-
-    with torch.no_grad():
-        print('Calculating model confidences for test images in class ', mode)
-        cur_idx = 0
-        cur_class_test_dir = os.path.join(TEST_DIR, mode) # ex: test/old
-        cur_class_test_data = datasets.ImageFolder(cur_class_test_dir, transform=data_transforms)
-        cur_class_test_loader = DataLoader(cur_class_test_data, batch_size=BATCH_SIZE)
-        for i, (images, labels) in enumerate(cur_class_test_loader):
-            images = images.to(DEVICE)
-            labels = labels.to(DEVICE)
-            b_size = labels.size()[0]
-            model_output = custom_model(images)
-            conf = torch.max(model_output, dim=1).values
-            confidences[cur_idx:cur_idx+b_size] = conf
-            if CALC_SVM_ACC:
-                preds = torch.argmax(model_output, dim=1)
-                correct = torch.where(preds==labels, 1, -1)
-                test_correctness[cur_idx:cur_idx+b_size] = correct
-            cur_idx += b_size
-
-    with torch.no_grad():
-        print("Getting CLIP embeddings, attributes, and decision scores " +\
-                "for test images in class ", mode)
-        for i, path in enumerate(test_paths):
-            pil_images.append(clip_preprocess(Image.open(path)))
-            # Also record sex/smiling of this test image
-            sexes[i] = 0 if 'female' in path else 1
-            if NUM_CORRS == 2:
-                smiles[i] = 0 if 'no_smile' in path else 1
-        test_feat_stack = torch.empty(IMGS_THIS_CLASS, EMBEDDING_DIM, device=DEVICE)
-        num_test_batches = int(np.ceil(IMGS_THIS_CLASS / BATCH_SIZE))
-        cur_idx = 0
-        for _ in range(num_test_batches):
-            end_idx = cur_idx + BATCH_SIZE
-            if end_idx > IMGS_THIS_CLASS:
-                end_idx = IMGS_THIS_CLASS
-            image_input = torch.stack(pil_images[cur_idx:end_idx])
-            test_feat_stack[cur_idx:end_idx] = \
-                clip_model.encode_image(image_input).float()
-            cur_idx += BATCH_SIZE
-        ds_values = np.dot(svm_c.coef_[0], \
-            test_feat_stack.cpu().numpy().transpose()) + \
-                svm_c.intercept_[0]
+    with instrument.stage("svm_fit", items=len(paths)):
+        svm_classifier = svm.SVC(kernel="linear") # LinearSVC(max_iter=5000) had worse performance
+        svm_classifier.fit(np_feat_stack, correctness)
+    scorers = {"linear": svm_classifier}
+    if KERNEL_SCORER is not None:
+        print(f'Fitting {KERNEL_SCORER} kernel scorer for class ', mode)
+        with instrument.stage(f"{KERNEL_SCORER}_fit", items=len(paths)):
+            scorers[KERNEL_SCORER] = fit_kernel_scorer(KERNEL_SCORER, np_feat_stack, correctness)
+    return scorers
+
+class SavedSVM:
+
+    """
+    A linear SVM loaded from SVM_STATE_DIR,
+    with the same coef_, intercept_, and
+    decision_function as the fitted SVC
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+
+    def decision_function(self, embeds):
+        """
+        Decision score of each row of embeds
+        """
+        return embeds @ self.coef_[0] + self.intercept_[0]
+
+def svm_state_path(mode:str) -> str:
+    """
+    Where the SVM for class mode of
+    VAL_DIR is saved, ex: svm_state/val_2_corr_old.npz
+    """
+    return os.path.join(SVM_STATE_DIR, f"{os.path.basename(os.path.normpath(VAL_DIR))}_{mode}.npz")
+
+def models_key() -> str:
+    """
+    The models (and their weights' mtimes and
+    preprocessing, see inference_server.model_config)
+    the saved SVMs' embeddings and labels came
+    from. A saved SVM is thrown away if any change,
+    ex: the classifier is retrained into MODEL_PATH.
+    """
+    from inference_server import model_config # pylint:disable=import-outside-toplevel
+    return json.dumps(model_config(), sort_keys=True)
+
+def load_svm_state(mode:str):
+    """
+    The saved SVM state for class mode as a
+    dict of arrays, or None if there isn't
+    one for the current models
+    """
+    path = svm_state_path(mode)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        state = {key: saved[key] for key in saved.files}
+    if str(state['models']) != models_key():
+        print(f'Saved SVM for class {mode} was fit with other models, refitting from scratch')
+        return None
+    return state
+
+def save_svm_state(mode:str, svm_c, embeds, labels, train_paths, seen_paths):
+    """
+    Save svm_c's coef_ and intercept_, the
+    embeddings, labels, and paths of its
+    support vectors, and every val path it
+    has seen
+    """
+    os.makedirs(SVM_STATE_DIR, exist_ok=True)
+    path = svm_state_path(mode)
+    tmp_path = path + '.tmp.npz'
+    support = svm_c.support_
+    np.savez(tmp_path, coef=svm_c.coef_, intercept=svm_c.intercept_,
+             sv_embeds=embeds[support], sv_labels=labels[support],
+             sv_paths=train_paths[support], seen_paths=seen_paths,
+             models=np.array(models_key()))
+    os.replace(tmp_path, path)
+
+def fit_svm_incremental(mode:str):
+    """
+    Update the saved SVM for class mode with
+    the val images added since it was saved.
+    Only the new images are classified and
+    embedded, and the SVM is refit on them
+    plus the saved support vectors (those of
+    images no longer in VAL_DIR are dropped).
+    Points that weren't support vectors don't
+    affect the solution, so this stays close to
+    refitting on every image. With nothing
+    saved, fits on every image.
+    """
+    from sklearn import svm # pylint:disable=import-outside-toplevel
+    with instrument.stage("list_paths"):
+        manifest = load_manifest(VAL_DIR)
+        idxs = manifest.class_idxs(mode)
+        paths = manifest.paths[idxs]
+    state = load_svm_state(mode)
+    if state is None:
+        state = {'seen_paths': np.array([], dtype=str), 'sv_paths': np.array([], dtype=str),
+                 'sv_embeds': np.zeros((0, 0), dtype=np.float32),
+                 'sv_labels': np.array([], dtype=np.int8)}
+    new_idxs = idxs[~np.isin(paths, state['seen_paths'])]
+    kept_sv = np.isin(state['sv_paths'], paths)
+    if len(new_idxs) == 0 and kept_sv.all() and 'coef' in state:
+        print(f'No new val images for class {mode}, using the saved SVM')
+        return SavedSVM(state['coef'], state['intercept'])
+
+    print(f'Finding model correctness and clip embeds for {len(new_idxs)} new ' +\
+          f'{mode.upper()} val images')
+    new_paths = manifest.paths[new_idxs]
+    if len(new_idxs) > 0:
+        new_correctness, _ = classify_class_dir(VAL_DIR, mode, new_idxs)
+        with instrument.stage("clip_embeds", items=len(new_idxs)):
+            new_embeds = encode_images(new_paths.tolist(), BATCH_SIZE)
+    else: # only images were removed
+        new_correctness = np.array([], dtype=np.int8)
+        new_embeds = state['sv_embeds'][:0]
+    sv_embeds = state['sv_embeds'][kept_sv] if kept_sv.any() else new_embeds[:0]
+    embeds = np.concatenate([sv_embeds, new_embeds])
+    labels = np.concatenate([state['sv_labels'][kept_sv], new_correctness])
+    train_paths = np.concatenate([state['sv_paths'][kept_sv], new_paths])
+
+    print(f'Refitting SVM for class {mode} on {kept_sv.sum()} saved support vectors ' +\
+          f'and {len(new_idxs)} new images')
+    with instrument.stage("svm_fit", items=len(embeds)):
+        svm_classifier = svm.SVC(kernel="linear")
+        svm_classifier.fit(embeds, labels)
+    save_svm_state(mode, svm_classifier, embeds, labels, train_paths, paths)
+    return svm_classifier
+
+def class_attrs(data_dir:str, mode:str):
+    """
+    Get the sex (1 for male) and
+    smiling (1 for smiling) attributes
+    of each image in class mode.
+    smiles is None if NUM_CORRS is 1.
+    """
+    manifest = load_manifest(data_dir)
+    idxs = manifest.class_idxs(mode)
+    sexes = manifest.attr('Male')[idxs]
+    smiles = manifest.attr('Smiling')[idxs] if NUM_CORRS == 2 else None
+    return sexes, smiles
+
+def minority_subgroups(mode:str, sexes, smiles) -> dict:
+    """
+    The minority subgroup(s) of class mode for
+    the correlations planted by NUM_CORRS, as
+    {attr name: (subgroup name, 1 for members)}.
+    sexes and smiles are from class_attrs.
+    """
+    subgroups = {"sex": ("Female", 1 - sexes) if mode == "old" else ("Male", sexes)}
+    if NUM_CORRS == 2:
+        subgroups["smiling"] = ("Smiling", smiles) if mode == "old" \
+            else ("Not Smiling", 1 - smiles)
+    return subgroups
+
+def top_k_fractions(sorted_attrs:np.ndarray) -> np.ndarray:
+    """
+    For each k, the fraction of the first
+    k entries of sorted_attrs that are 1.
+    """
+    num_imgs = len(sorted_attrs)
+    fracs = np.empty(num_imgs)
+    for num_people in range(1, num_imgs+1):
+        fracs[num_people-1] = sorted_attrs[:num_people].sum() / num_people
+    return fracs
+
+def plot_top_k(report:Report, curves:dict, baseline, minority, mode, attr_name):
+    """
+    Add a plot of the fraction of the minority
+    subgroup flagged in the top k when
+    ordering by confidence vs decision score
+    to report. curves maps each ordering's
+    label to its fractions.
+    """
+    report.add_curves(f"{minority} Flagged for Class {mode}", curves, baseline=baseline,
+                      ylabel=f'Fraction {minority}', xlabel="Top K Flagged",
+                      colors={"Confidence": 'g', SCORER_LABELS["linear"]: 'b'},
+                      save_as=f'new_{mode}_{attr_name}_{NUM_CORRS}_corr.png' if SAVE_FIGS else None)
+
+def evaluate_svm(mode:str, scorers:dict, report:Report):
+    """
+    Order the test images in class mode
+    by decision score (of each scorer from
+    fit_svm) and by confidence, then add
+    plots of how well each ordering surfaces
+    the minority subgroup(s) to report.
+    """
+    with instrument.stage("list_paths"):
+        test_paths = get_class_paths(TEST_DIR, mode)
+    num_imgs_this_class = len(test_paths)
+
+    print('Calculating model confidences for test images in class ', mode)
+    test_correctness, confidences = classify_class_dir(TEST_DIR, mode)
+
+    print("Getting CLIP embeddings, attributes, and decision scores " +\
+            "for test images in class ", mode)
+    sexes, smiles = class_attrs(TEST_DIR, mode)
+    with instrument.stage("decision_scores", items=num_imgs_this_class):
+        if list(scorers) == ["linear"]:
+            all_ds = {"linear": decision_scores(test_paths, scorers["linear"], BATCH_SIZE)}
+        else:
+            test_embeds = encode_images(test_paths, BATCH_SIZE)
+            all_ds = {kind: scorer.decision_function(test_embeds) \
+                      for kind, scorer in scorers.items()}
+
+    if SAVE_RESULTS:
+        save_results(f"top_k_{mode}", test_paths, confidence=confidences,
+                     correct=test_correctness,
+                     **{"decision_score" if kind == "linear" else f"{kind}_score": ds_values \
+                        for kind, ds_values in all_ds.items()})
 
     if CALC_SVM_ACC:
-        test_correctness = test_correctness.cpu().numpy()
-        ds_correctness = np.where(ds_values >= 0, 1, -1) # equivalent to np.sign but no 0s
-        total = len(test_correctness)
-        corr = (test_correctness == ds_correctness).sum()
-        print(f"SVM accuracy for class {mode}: {corr/total}")
+        for kind, ds_values in all_ds.items():
+            ds_correctness = np.where(ds_values >= 0, 1, -1) # equivalent to np.sign but no 0s
+            total = len(test_correctness)
+            corr = (test_correctness == ds_correctness).sum()
+            print(f"{SCORER_LABELS[kind]} SVM accuracy for class {mode}: {corr/total}")
 
     print('Plotting/saving results for class ', mode)
-    conf_sorted_idxs =  np.argsort(confidences.cpu().numpy())
-    ds_sorted_idxs = np.flip(np.argsort(ds_values))
-    conf_sorted_sexes = sexes[conf_sorted_idxs]
-    ds_sorted_sexes = sexes[ds_sorted_idxs]
-    conf_sorted_frac_male = np.empty(IMGS_THIS_CLASS)
-    ds_sorted_frac_male = np.empty(IMGS_THIS_CLASS)
-    if NUM_CORRS == 2:
-        conf_sorted_smiles = smiles[conf_sorted_idxs]
-        ds_sorted_smiles = smiles[ds_sorted_idxs]
-        conf_sorted_frac_smiles = np.empty(IMGS_THIS_CLASS)
-        ds_sorted_frac_smiles = np.empty(IMGS_THIS_CLASS)
-
-    for num_people in range(1, IMGS_THIS_CLASS+1):
-        conf_num_males = conf_sorted_sexes[:num_people].sum()
-        ds_num_males = ds_sorted_sexes[:num_people].sum()
-        conf_sorted_frac_male[num_people-1] = conf_num_males / num_people
-        ds_sorted_frac_male[num_people-1] = ds_num_males / num_people
-        if NUM_CORRS == 2:
-            conf_num_smiles = conf_sorted_smiles[:num_people].sum()
-            ds_num_smiles = ds_sorted_smiles[:num_people].sum()
-            conf_sorted_frac_smiles[num_people-1] = conf_num_smiles / num_people
-            ds_sorted_frac_smiles[num_people-1] = ds_num_smiles / num_people
-
-    if mode == "old":
-        minority_sex = "Female"
-        sex_y_conf = 1-conf_sorted_frac_male
-        sex_y_ds = 1-ds_sorted_frac_male
-        sex_baseline = 1 - (conf_num_males / IMGS_THIS_CLASS)
-        if NUM_CORRS == 2:
-            minority_smile = "Smiling"
-            smi_y_conf = conf_sorted_frac_smiles
-            smi_y_ds = ds_sorted_frac_smiles
-            smi_baseline = conf_num_smiles / IMGS_THIS_CLASS
-
-    elif mode == "young":
-        minority_sex = "Male"
-        sex_y_conf = conf_sorted_frac_male
-        sex_y_ds = ds_sorted_frac_male
-        sex_baseline = conf_num_males / IMGS_THIS_CLASS
-        if NUM_CORRS == 2:
-            minority_smile = "Not Smiling"
-            smi_y_conf = 1-conf_sorted_frac_smiles
-            smi_y_ds = 1-ds_sorted_frac_smiles
-            smi_baseline = 1 - (conf_num_smiles / IMGS_THIS_CLASS)
-
-    # Plot sex results for class
-    plt.plot(range(IMGS_THIS_CLASS), sex_y_conf, color='g', label="Confidence")
-    plt.plot(range(IMGS_THIS_CLASS), sex_y_ds, color='b', label="Decision Score")
-    plt.axhline(y=sex_baseline, color='r', label="Baseline")
-    plt.ylabel(f'Fraction {minority_sex}')
-    plt.xlabel("Top K Flagged")
-    plt.legend(loc="upper right")
-    plt.title(f"{minority_sex} Flagged for Class {mode}")
-    if SAVE_FIGS: plt.savefig(f'new_{mode}_sex_{NUM_CORRS}_corr.png')
-    plt.show()
-    plt.clf()
-    plt.close()
-
-    # Plot smiling results for class if needed
-    if NUM_CORRS == 2:
-        # Plot smiling results for class
-        plt.plot(range(IMGS_THIS_CLASS), smi_y_conf, color='g', label="Confidence")
-        plt.plot(range(IMGS_THIS_CLASS), smi_y_ds, color='b', label="Decision Score")
-        plt.axhline(y=smi_baseline, color='r', label="Baseline")
-        plt.ylabel(f'Fraction {minority_smile}')
-        plt.xlabel("Top K Flagged")
-        plt.legend(loc="upper right")
-        plt.title(f"{minority_smile} Flagged for Class {mode}")
-        if SAVE_FIGS: plt.savefig(f'new_{mode}_smiling_{NUM_CORRS}_corr.png')
-        plt.show()
-        plt.clf()
-        plt.close()
+    with instrument.stage("top_k_curves", items=num_imgs_this_class):
+        orderings = {"Confidence": np.argsort(confidences),
+                     **{SCORER_LABELS[kind]: np.flip(np.argsort(ds_values)) \
+                        for kind, ds_values in all_ds.items()}}
+        curves = {attr_name: {label: top_k_fractions(is_minority[order]) \
+                              for label, order in orderings.items()} \
+                  for attr_name, (_, is_minority) in minority_subgroups(mode, sexes, smiles).items()}
+
+    # Plot sex (and smiling, if NUM_CORRS is 2) results for class
+    for attr_name, (minority, is_minority) in minority_subgroups(mode, sexes, smiles).items():
+        plot_top_k(report, curves[attr_name], is_minority.mean(), minority, mode, attr_name)
+
+class ExtremesBuffer:
+
+    """
+    The k highest and k lowest scores seen
+    so far in a stream of scores, and the
+    indices they came from. Memory is O(k)
+    no matter how many scores are added.
+    """
+
+    def __init__(self, k:int):
+        self.k = k
+        self.top_scores, self.top_idxs = np.empty(0), np.empty(0, dtype=np.int64)
+        self.bottom_scores, self.bottom_idxs = np.empty(0), np.empty(0, dtype=np.int64)
+
+    def _keep(self, scores, idxs, largest:bool):
+        """
+        The k largest (or smallest) scores
+        and their indices, unsorted
+        """
+        if len(scores) <= self.k:
+            return scores, idxs
+        kept = np.argpartition(-scores if largest else scores, self.k - 1)[:self.k]
+        return scores[kept], idxs[kept]
+
+    def add(self, scores, idxs):
+        """
+        Add a batch of scores and the
+        index of each one
+        """
+        self.top_scores, self.top_idxs = self._keep(
+            np.concatenate([self.top_scores, scores]),
+            np.concatenate([self.top_idxs, idxs]), largest=True)
+        self.bottom_scores, self.bottom_idxs = self._keep(
+            np.concatenate([self.bottom_scores, scores]),
+            np.concatenate([self.bottom_idxs, idxs]), largest=False)
+
+    def top(self):
+        """
+        (scores, indices) of the k highest
+        scores, highest first
+        """
+        order = np.argsort(-self.top_scores)
+        return self.top_scores[order], self.top_idxs[order]
+
+    def bottom(self):
+        """
+        (scores, indices) of the k lowest
+        scores, lowest first
+        """
+        order = np.argsort(self.bottom_scores)
+        return self.bottom_scores[order], self.bottom_idxs[order]
+
+def has_cached_embeds(split:str) -> bool:
+    """
+    Whether dataset_utils/extract_clip_embeds.py
+    has saved embeddings for split
+    """
+    return os.path.exists(os.path.join(EMBEDS_DIR, split, 'index.json'))
+
+def iter_class_embeds(split:str, data_dir:str, mode:str):
+    """
+    Yield (manifest indices, embeddings) for
+    the images in class mode from the split's
+    cached CLIP embeddings, a shard at a time
+    """
+    manifest = load_manifest(data_dir)
+    in_class = manifest.labels == manifest.classes.index(mode)
+    # Shards are saved in manifest order. Every path
+    # is checked, so a shard with an image swapped,
+    # added, or removed is caught, not just its last one.
+    start_i = 0
+    for shard_paths, shard_embeds in iter_clip_embeds(split):
+        end_i = start_i + len(shard_paths)
+        assert shard_paths == manifest.paths[start_i:end_i].tolist(), \
+            f"Cached {split} embeddings don't match {data_dir}. " +\
+            "Re-run dataset_utils/extract_clip_embeds.py"
+        mask = in_class[start_i:end_i]
+        yield start_i + np.flatnonzero(mask), shard_embeds[mask]
+        start_i = end_i
+
+def stream_decision_scores(split:str, data_dir:str, mode:str, svm_c):
+    """
+    Yield (manifest indices, decision scores)
+    for the images in class mode, a batch at
+    a time. Scores come from the split's cached
+    CLIP embedding shards if they exist, else
+    STREAM_CHUNK images are embedded at a time.
+    svm_c is a linear SVM, or a kernel scorer
+    from fit_kernel_scorer.
+    """
+    linear = hasattr(svm_c, 'coef_')
+    if has_cached_embeds(split):
+        if linear:
+            coef, intercept = np.asarray(svm_c.coef_[0]), float(svm_c.intercept_[0])
+        for idxs, class_embeds in iter_class_embeds(split, data_dir, mode):
+            yield idxs, \
+                class_embeds @ coef + intercept if linear else svm_c.decision_function(class_embeds)
+        return
+    manifest = load_manifest(data_dir)
+    class_idxs = manifest.class_idxs(mode)
+    for start_i in range(0, len(class_idxs), STREAM_CHUNK):
+        idxs = class_idxs[start_i:start_i+STREAM_CHUNK]
+        paths = manifest.paths[idxs].tolist()
+        if linear:
+            yield idxs, decision_scores(paths, svm_c, BATCH_SIZE)
+        else:
+            yield idxs, svm_c.decision_function(encode_images(paths, BATCH_SIZE))
+
+def stream_extremes(mode:str, svm_c, k:int=STREAM_K):
+    """
+    Find the k test images in class mode the
+    SVM (or kernel scorer) scores as most likely to be failures
+    (lowest decision score) and most likely
+    to be correct (highest), without holding
+    every score or embedding in memory, then
+    save their paths, scores, and attributes.
+    """
+    manifest = load_manifest(TEST_DIR)
+    buffer = ExtremesBuffer(k)
+    num_scored = 0
+    with instrument.stage("stream_scores") as rec:
+        for idxs, scores in stream_decision_scores("test", TEST_DIR, mode, svm_c):
+            buffer.add(scores, idxs)
+            num_scored += len(idxs)
+        if rec is not None:
+            rec["items"] = num_scored
+
+    bottom_scores, bottom_idxs = buffer.bottom()
+    top_scores, top_idxs = buffer.top()
+    # Masks over the whole manifest, since idxs index it
+    subgroups = minority_subgroups(mode, manifest.attr('Male'),
+                                   manifest.attr('Smiling') if NUM_CORRS == 2 else None)
+    for minority, is_minority in subgroups.values():
+        for desc, idxs in (("likely failures", bottom_idxs), ("likely correct", top_idxs)):
+            frac_minority = is_minority[idxs].mean()
+            print(f"{minority} fraction of the {len(idxs)} {desc} in class {mode} " +\
+                  f"(of {num_scored}): {frac_minority:.3f}")
+
+    idxs = np.concatenate([bottom_idxs, top_idxs])
+    save_results(f"top_k_{mode}_extremes", manifest.paths[idxs].tolist(),
+                 decision_score=np.concatenate([bottom_scores, top_scores]),
+                 extreme=np.array(["bottom"] * len(bottom_idxs) + ["top"] * len(top_idxs)),
+                 rank=np.concatenate([np.arange(len(bottom_idxs)), np.arange(len(top_idxs))]))
+
+def _cv_fold(embeds_path:str, labels, is_minority:dict, train_idxs, test_idxs) -> dict:
+    """
+    Fit an SVM on one fold's train rows of the
+    embeddings memmapped from embeds_path and
+    score its test rows. is_minority maps each
+    attr name to its minority subgroup's mask.
+    """
+    from sklearn import svm # pylint:disable=import-outside-toplevel
+    embeds = np.load(embeds_path, mmap_mode='r') # shared through the page cache, not pickled
+    svm_classifier = svm.SVC(kernel="linear")
+    svm_classifier.fit(embeds[train_idxs], labels[train_idxs])
+    ds_values = svm_classifier.decision_function(embeds[test_idxs])
+    accuracy = (np.where(ds_values >= 0, 1, -1) == labels[test_idxs]).mean()
+    top_k = min(CV_TOP_K, len(test_idxs))
+    flagged = np.argpartition(ds_values, top_k - 1)[:top_k] # lowest scores, likely failures
+    return {"accuracy": float(accuracy),
+            "minority_precision": {attr_name: float(mask[test_idxs][flagged].mean()) \
+                                   for attr_name, mask in is_minority.items()},
+            "direction": svm_classifier.coef_[0] / np.linalg.norm(svm_classifier.coef_[0])}
+
+def cross_validate(mode:str, folds:int=CV_FOLDS) -> dict:
+    """
+    Stratified k-fold cross validation of the
+    SVM for class mode over the cached val
+    embeddings. The embeddings are written once
+    to a memmapped .npy that every worker opens
+    read-only. Prints and returns the mean and
+    spread of fold accuracy and top-k minority
+    precision (for each minority subgroup from
+    minority_subgroups), and the cosine similarity
+    between the folds' failure directions.
+    """
+    # pylint:disable=import-outside-toplevel
+    import tempfile
+    from multiprocessing import get_context
+    from concurrent.futures import ProcessPoolExecutor
+    from sklearn.model_selection import StratifiedKFold
+    assert has_cached_embeds("val"), \
+        "Cross validation runs on cached val embeddings. " +\
+        "Run dataset_utils/extract_clip_embeds.py val first."
+    manifest = load_manifest(VAL_DIR)
+    class_idxs = manifest.class_idxs(mode)
+    assert len(class_idxs) > 0, f"No {mode} images in {VAL_DIR} to cross validate on."
+    labels, _ = classify_class_dir(VAL_DIR, mode)
+    for label, desc in ((1, "correct"), (-1, "incorrect")):
+        num_label = int((labels == label).sum())
+        assert num_label >= folds, \
+            f"The classifier is {desc} on only {num_label} {mode} val images, " +\
+            f"too few for {folds} folds. Lower CV_FOLDS or add val images."
+    subgroups = minority_subgroups(mode, *class_attrs(VAL_DIR, mode))
+    is_minority = {attr_name: mask for attr_name, (_, mask) in subgroups.items()}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        embeds_path = os.path.join(tmp_dir, f"val_{mode}.npy")
+        with instrument.stage("clip_embeds", items=len(class_idxs)):
+            embeds = None
+            start_i = 0
+            for _, shard_embeds in iter_class_embeds("val", VAL_DIR, mode):
+                if embeds is None:
+                    embeds = np.lib.format.open_memmap(
+                        embeds_path, mode='w+', dtype=np.float32,
+                        shape=(len(class_idxs), shard_embeds.shape[1]))
+                embeds[start_i:start_i+len(shard_embeds)] = shard_embeds
+                start_i += len(shard_embeds)
+            assert embeds is not None and start_i == len(class_idxs), \
+                f"Cached val embeddings cover {start_i} of the {len(class_idxs)} {mode} images " +\
+                f"in {VAL_DIR}. Re-run dataset_utils/extract_clip_embeds.py val."
+            embeds.flush()
+            del embeds
+
+        splits = list(StratifiedKFold(folds, shuffle=True, random_state=0) \
+                      .split(np.zeros(len(labels)), labels))
+        print(f"Cross validating the SVM for class {mode} over {len(labels)} val images " +\
+              f"in {folds} folds")
+        # spawn, so workers don't inherit torch's threads from classify
+        with instrument.stage("cv_folds", items=folds * len(labels)), \
+                ProcessPoolExecutor(max_workers=min(folds, os.cpu_count() or 1),
+                                    mp_context=get_context("spawn")) as pool:
+            fold_results = list(pool.map(_cv_fold, [embeds_path] * folds, [labels] * folds,
+                                         [is_minority] * folds, *zip(*splits)))
+
+    accuracies = np.array([res["accuracy"] for res in fold_results])
+    precisions = {attr_name: np.array([res["minority_precision"][attr_name] \
+                                       for res in fold_results]) for attr_name in subgroups}
+    directions = np.stack([res["direction"] for res in fold_results])
+    cosines = (directions @ directions.T)[np.triu_indices(folds, k=1)]
+    print(f"Class {mode} fold accuracy: {accuracies.mean():.4f} +/- {accuracies.std():.4f} " +\
+          f"(variance {accuracies.var():.6f})")
+    for attr_name, (minority, mask) in subgroups.items():
+        print(f"Class {mode} {minority} fraction of each fold's {CV_TOP_K} lowest scores: " +\
+              f"{precisions[attr_name].mean():.4f} +/- {precisions[attr_name].std():.4f} " +\
+              f"(baseline {mask.mean():.4f})")
+    print(f"Class {mode} cosine similarity between fold directions: " +\
+          f"mean {cosines.mean():.4f}, min {cosines.min():.4f}")
+    return {"accuracy": accuracies, "minority_precision": precisions, "direction_cosine": cosines}
+
+def main():
+    """
+    SVMs are trained on *val* set,
+    Top_K is evaluated on *test* set
+    """
+    with instrument.run("top_k"):
+        if CROSS_VALIDATE:
+            for mode in MODES:
+                with instrument.stage(f"cross_validate_{mode}"):
+                    cross_validate(mode)
+            return
+        trained_scorers = []
+        for mode in MODES:
+            with instrument.stage(f"fit_svm_{mode}"):
+                trained_scorers.append(fit_svm(mode))
+        print("Finished training SVMs on validation data.")
+        if DESCRIBE_DIRECTIONS:
+            with instrument.stage("describe"):
+                describe([f"{mode} failure direction" for mode in MODES],
+                         [-scorers["linear"].coef_[0] for scorers in trained_scorers])
+        report = Report("top_k")
+        for mode, scorers in zip(MODES, trained_scorers):
+            with instrument.stage(f"evaluate_{mode}"):
+                if STREAMING:
+                    stream_extremes(mode, scorers[KERNEL_SCORER or "linear"])
+                else:
+                    evaluate_svm(mode, scorers, report)
+        if report.figs:
+            with instrument.stage("report", items=len(report.figs)):
+                report.write()
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,171 @@ throughout the project.
 """
 
 import os
+import json
+import time
+import functools
 import numpy as np
 import pandas as pd
-from settings import CELEBA_ATTRS_CSV
+from settings import CELEBA_ATTRS_CSV, EMBEDS_DIR, RESULTS_DIR, RESULTS_FORMAT
+
+@functools.lru_cache(maxsize=None)
+def attr_table(csv_path:str=None):
+    """
+    The CelebA attributes csv as (filenames,
+    attrs, columns), where filenames is sorted
+    so rows can be looked up by binary search
+    (see attr_rows) and attrs is an int8 array
+    of the -1/1 attribute values in the same
+    order. The first call parses the csv and
+    caches the arrays next to it as
+    <csv name>.index.npz, which later runs load
+    instead whenever it's newer than the csv.
+    """
+    csv_path = csv_path or CELEBA_ATTRS_CSV
+    cache_path = os.path.splitext(csv_path)[0] + '.index.npz'
+    if os.path.exists(cache_path) and \
+        os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        with np.load(cache_path) as cache:
+            return cache['filenames'], cache['attrs'], cache['columns'].tolist()
+
+    celeba_df = pd.read_csv(csv_path).sort_values('filename')
+    filenames = celeba_df['filename'].to_numpy().astype(str)
+    columns = [col for col in celeba_df.columns if col != 'filename']
+    attrs = celeba_df[columns].to_numpy(dtype=np.int8)
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, filenames=filenames, attrs=attrs, columns=np.array(columns))
+    os.replace(tmp_path, cache_path)
+    return filenames, attrs, columns
+
+def attr_rows(file_names, csv_path:str=None, missing_ok:bool=False) -> np.ndarray:
+    """
+    Row of each image in attr_table, looked
+    up by file name. Paths are accepted too,
+    since only the base name is used. Images
+    not in the csv raise a KeyError naming
+    them, or get row -1 if missing_ok.
+    """
+    filenames = attr_table(csv_path or CELEBA_ATTRS_CSV)[0]
+    # Not cast to filenames.dtype, which would truncate
+    # longer names into false matches
+    keys = np.array([os.path.basename(name) for name in file_names], dtype=str)
+    rows = np.searchsorted(filenames, keys).clip(max=len(filenames) - 1)
+    missing = filenames[rows] != keys
+    if missing_ok:
+        rows[missing] = -1
+    elif missing.any():
+        raise KeyError(f"{missing.sum()} images not in the attributes csv " +\
+                       f"{csv_path or CELEBA_ATTRS_CSV}: {', '.join(keys[missing][:10])}" +\
+                       (", ..." if missing.sum() > 10 else ""))
+    return rows
+
+def _results_columns(file_names, save_celeb_attrs:bool, kwargs:dict) -> dict:
+    """
+    filename, then the per-image data in
+    kwargs, then (optionally) each image's
+    CelebA attributes, joined by file name
+    """
+    columns = {'filename': np.array([os.path.basename(name) for name in file_names])}
+    for key, values in kwargs.items():
+        values = np.asarray(values)
+        assert len(values) == len(file_names), \
+            f"{key} has {len(values)} values for {len(file_names)} images"
+        columns[key] = values
+    if save_celeb_attrs:
+        _, attrs, attr_names = attr_table(CELEBA_ATTRS_CSV)
+        image_attrs = attrs[attr_rows(file_names)]
+        for col_idx, attr_name in enumerate(attr_names):
+            columns[attr_name] = image_attrs[:, col_idx]
+    return columns
+
+def save_results(run_name:str, file_names:list[str], save_celeb_attrs:bool=True,
+                 results_dir:str=None, **kwargs) -> str:
+    """
+    Save per-image outputs (ex: scores,
+    correctness, cluster ids) given as
+    flat lists/arrays in kwargs, in the same
+    order as file_names, along with each
+    image's CelebA attributes.
+
+    Each call writes a new file to results_dir
+    named after run_name, the time, and a
+    counter (ex: top_k_eager_20230412-101500_00),
+    so runs are appended rather than overwritten,
+    even when saved in the same second. The
+    file is parquet or feather (RESULTS_FORMAT)
+    when pyarrow is installed, else npz.
+    Read them back with load_results.
+    Returns the path written.
+    """
+    results_dir = results_dir or RESULTS_DIR
+    os.makedirs(results_dir, exist_ok=True)
+    columns = _results_columns(file_names, save_celeb_attrs, kwargs)
+    fmt = RESULTS_FORMAT
+    if fmt in ('parquet', 'feather'):
+        try:
+            import pyarrow # pylint:disable=import-outside-toplevel,unused-import
+        except ImportError:
+            fmt = 'npz'
+    out_base = os.path.join(results_dir, f"{run_name}_{time.strftime('%Y%m%d-%H%M%S')}")
+    tmp_path = f"{out_base}.{os.getpid()}.tmp.{fmt}"
+    if fmt == 'npz':
+        np.savez_compressed(tmp_path, **columns)
+    else:
+        # pylint:disable=import-outside-toplevel
+        import pyarrow as pa
+        from pyarrow import parquet, feather
+        table = pa.table(columns)
+        if fmt == 'parquet':
+            parquet.write_table(table, tmp_path)
+        else:
+            feather.write_feather(table, tmp_path)
+    # Claim the first free name, hard linking so a
+    # concurrent run can't take the same one
+    for counter in range(100):
+        out_path = f"{out_base}_{counter:02d}.{fmt}"
+        try:
+            os.link(tmp_path, out_path)
+            break
+        except FileExistsError:
+            continue
+    else:
+        os.remove(tmp_path)
+        raise FileExistsError(f"100 runs already saved as {out_base}_*.{fmt}")
+    os.remove(tmp_path)
+    print(f"Saved results for {len(file_names)} images to {out_path}")
+    return out_path
+
+def load_results(prefix:str='', results_dir:str=None) -> pd.DataFrame:
+    """
+    Every run saved by save_results whose name
+    starts with prefix, as one DataFrame with
+    a 'run' column naming the file each row
+    came from. Raises a FileNotFoundError if
+    results_dir has no such runs.
+    """
+    results_dir = results_dir or RESULTS_DIR
+    if not os.path.isdir(results_dir):
+        raise FileNotFoundError(f"No results saved in {results_dir} yet, " +\
+                                "see utils.save_results")
+    frames = []
+    for name in sorted(os.listdir(results_dir)):
+        path = os.path.join(results_dir, name)
+        if not name.startswith(prefix) or '.tmp.' in name:
+            continue
+        if name.endswith('.npz'):
+            with np.load(path) as data:
+                frame = pd.DataFrame({key: data[key] for key in data.files})
+        elif name.endswith('.parquet'):
+            frame = pd.read_parquet(path)
+        elif name.endswith('.feather'):
+            frame = pd.read_feather(path)
+        else:
+            continue
+        frame.insert(0, 'run', os.path.splitext(name)[0])
+        frames.append(frame)
+    if not frames:
+        raise FileNotFoundError(f"No runs starting with '{prefix}' in {results_dir}")
+    return pd.concat(frames, ignore_index=True)
 
 def save_to_csv(csv_file_path:str, file_names:list[str],
                 save_celeb_attrs:bool=True, **kwargs):
@@ -16,16 +178,48 @@ def save_to_csv(csv_file_path:str, file_names:list[str],
     to a csv file. This function will
     overwrite any existing file at that
     path. It is assumed that data in
-    kwargs are flat lists or numpy arrays.
+    kwargs are flat lists or numpy arrays
+    in the same order as file_names.
 
     'filename' is col 0, so data in kwargs
     is inserted in columns right after that.
-    """ 
-    celeba_df = pd.read_csv(CELEBA_ATTRS_CSV)
-    df_for_paths = celeba_df[celeba_df['filename'].isin(file_names)]
-    for col_idx, (key, list_val) in enumerate(kwargs.items()):
-        df_for_paths.insert(col_idx+1, key, list_val)
-    if save_celeb_attrs:
-        df_for_paths.to_csv(csv_file_path)
-    else:
-        df_for_paths[['filename', *kwargs.keys()]].to_csv(csv_file_path)
+    Prefer save_results, which is much faster
+    and smaller on disk for large sets.
+    """
+    columns = _results_columns(file_names, save_celeb_attrs, kwargs)
+    pd.DataFrame(columns).to_csv(csv_file_path)
+
+def iter_clip_embeds(split:str):
+    """
+    Yield (paths, embeds) for each shard of
+    the CLIP embeddings saved by
+    dataset_utils/extract_clip_embeds.py for
+    the given split ("train", "val", "test"),
+    in order, one shard in memory at a time.
+    """
+    split_dir = os.path.join(EMBEDS_DIR, split)
+    shard_names = sorted(name for name in os.listdir(split_dir) \
+                         if name.startswith('shard_') and name.endswith('.npz'))
+    with open(os.path.join(split_dir, 'index.json'), encoding='utf-8') as f:
+        num_shards = json.load(f)['num_shards']
+    assert len(shard_names) == num_shards, \
+        f"Only {len(shard_names)}/{num_shards} shards found in {split_dir}. " +\
+        "Re-run dataset_utils/extract_clip_embeds.py to finish them."
+    for name in shard_names:
+        with np.load(os.path.join(split_dir, name)) as shard:
+            yield shard['paths'].tolist(), shard['embeds']
+
+def load_clip_embeds(split:str):
+    """
+    Read back the sharded CLIP embeddings
+    saved by dataset_utils/extract_clip_embeds.py
+    for the given split ("train", "val", "test").
+    Returns (paths, embeds) where embeds is a
+    float32 array of shape (num_images, embed_dim)
+    in the same order as paths.
+    """
+    paths, embeds = [], []
+    for shard_paths, shard_embeds in iter_clip_embeds(split):
+        paths.extend(shard_paths)
+        embeds.append(shard_embeds)
+    return paths, np.concatenate(embeds)